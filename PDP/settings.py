@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -47,10 +48,12 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'group_police.instrumentation.QueryInstrumentationMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'group_police.permissions.EffectivePermissionsMiddleware',
     'django_otp.middleware.OTPMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
@@ -80,12 +83,35 @@ WSGI_APPLICATION = 'PDP.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# По умолчанию SQLite (в режиме WAL, см. group_police/db.py). Для продакшена задается POSTGRES_DB
+# и остальные POSTGRES_* переменные окружения. Соединения с PostgreSQL переиспользуются между запросами
+# (DB_CONN_MAX_AGE секунд); при работе через PgBouncer в режиме transaction нужно DB_DISABLE_SERVER_SIDE_CURSORS=1
+
+if os.environ.get('POSTGRES_DB'):
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ['POSTGRES_DB'],
+            'USER': os.environ.get('POSTGRES_USER', 'postgres'),
+            'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+            'HOST': os.environ.get('POSTGRES_HOST', '127.0.0.1'),
+            'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+            'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', 60)),
+            'CONN_HEALTH_CHECKS': True,
+            'DISABLE_SERVER_SIDE_CURSORS': os.environ.get('DB_DISABLE_SERVER_SIDE_CURSORS', '') == '1',
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db.sqlite3',
+            'OPTIONS': {
+                # Сколько секунд ждать блокировку записи, прежде чем вернуть "database is locked"
+                'timeout': 20,
+            },
+        }
     }
-}
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -125,3 +151,149 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Access policies
+# Скомпилированные AccessPolicy перечитываются из БД не реже, чем раз в указанное число секунд
+
+ACCESS_POLICY_CACHE_TTL = 30
+HOST_POLICY_CACHE_TTL = 30
+
+# Audit log
+# Журналы аудита пишутся пачками из фонового потока, чтобы не блокировать запросы
+
+AUDIT_LOG_ASYNC = True
+AUDIT_LOG_BATCH_SIZE = 500
+AUDIT_LOG_FLUSH_INTERVAL = 1.0
+AUDIT_LOG_QUEUE_SIZE = 100000
+
+# MQTT ingestion
+
+MQTT_BROKER_HOST = '127.0.0.1'
+MQTT_BROKER_PORT = 1883
+MQTT_INGEST_CLIENT_ID = 'pdp-ingest'
+MQTT_INGEST_BATCH_SIZE = 1000
+MQTT_INGEST_FLUSH_INTERVAL = 0.2
+MQTT_INGEST_MAX_PENDING = 20000
+MQTT_INGEST_DEVICE_CACHE_TTL = 60
+# Принимать данные устройств только с действительным JWT в свойстве Authorization
+MQTT_INGEST_REQUIRE_JWT = False
+# Пользовательское свойство MQTT v5 с адресом клиента, по которому применяются RBACPolicy (hosts).
+# Его должен добавлять брокер (правило или плагин), заменяя одноименное свойство от клиента; без него
+# политики не применяются (счетчик unchecked). REDIRECT только учитывается: перенаправление - дело сети
+MQTT_INGEST_SOURCE_PROPERTY = 'source-ip'
+# manage.py mqtt_ingest_workers: процессы приема делят поток через общую подписку $share/<группа>/...;
+# упавший процесс перезапускается с задержкой, растущей до MQTT_INGEST_RESTART_MAX_DELAY секунд
+MQTT_INGEST_WORKERS = 4
+MQTT_INGEST_SHARE_GROUP = 'pdp-ingest'
+MQTT_INGEST_RESTART_DELAY = 1
+MQTT_INGEST_RESTART_MAX_DELAY = 30
+# Спул: принятые сообщения сначала пишутся в файлы MQTT_INGEST_SPOOL_DIR/<client id> и подтверждаются
+# брокеру, а в БД переносятся, когда она доступна. Сверх MQTT_INGEST_SPOOL_MAX_BYTES сообщения не подтверждаются
+MQTT_INGEST_SPOOL_ENABLED = True
+MQTT_INGEST_SPOOL_DIR = BASE_DIR / 'spool'
+MQTT_INGEST_SPOOL_SEGMENT_SIZE = 16 * 1024 * 1024
+MQTT_INGEST_SPOOL_MAX_BYTES = 1024 * 1024 * 1024
+
+# Отправка команд устройствам: соединений в пуле процесса, неподтвержденных публикаций
+# на соединение, размер очереди и время ожидания PUBACK, после которого команда считается неподтвержденной
+# (доставка еще возможна). Пул и очередь - у каждого процесса веб-сервера свои, а не общие
+MQTT_DISPATCH_POOL_SIZE = 2
+MQTT_DISPATCH_MAX_INFLIGHT = 100
+MQTT_DISPATCH_QUEUE_SIZE = 10000
+MQTT_DISPATCH_ACK_TIMEOUT = 30
+
+# Время последней активности устройств: запись в БД и публикация в кэш для веб-процессов.
+# Чтобы веб-процессы видели значения процесса приема сообщений, CACHES должен быть общим (memcached, redis);
+# иначе список устройств показывает значение из БД, отстающее не больше чем на LAST_SEEN_FLUSH_INTERVAL
+
+LAST_SEEN_FLUSH_INTERVAL = 30
+LAST_SEEN_PUBLISH_INTERVAL = 1
+
+# Тексты сообщений устройств длиннее MESSAGE_COMPRESSION_MIN_LENGTH символов хранятся сжатыми (IoTMessage.body)
+
+MESSAGE_COMPRESSION = True
+MESSAGE_COMPRESSION_MIN_LENGTH = 64
+
+# Количество сообщений на странице истории устройства
+
+DEVICE_MESSAGES_PAGE_SIZE = 50
+
+# Числовые поля сообщений устройств, которые не агрегируются в IoTMetricRollup
+
+ROLLUP_IGNORED_FIELDS = ('sent_at',)
+
+# Retention
+# Правила хранения: manage.py prune_data удаляет строки старше days, при archive=True
+# предварительно выгружая их в RETENTION_ARCHIVE_DIR в виде jsonl.gz. Для отдельных типов устройств
+# добавляется правило с filter, например {'device__device_type': 'temperature_sensor'}
+
+RETENTION_POLICIES = [
+    {'model': 'group_police.IoTMessage', 'time_field': 'receive_time', 'days': 30, 'archive': True},
+    {'model': 'group_police.IoTMetricRollup', 'time_field': 'bucket', 'days': 7, 'filter': {'resolution': 'minute'},
+     'name': 'minute rollups'},
+    {'model': 'group_police.IoTMetricRollup', 'time_field': 'bucket', 'days': 90, 'filter': {'resolution': 'hour'},
+     'name': 'hour rollups'},
+    {'model': 'group_police.UserToDeviceLog', 'time_field': 'at_time', 'days': 180, 'archive': True},
+    {'model': 'group_police.IoTDeviceLog', 'time_field': 'at_time', 'days': 180, 'archive': True},
+    {'model': 'group_police.UserLog', 'time_field': 'at_time', 'days': 365, 'archive': True},
+]
+RETENTION_ARCHIVE_DIR = BASE_DIR / 'archive'
+RETENTION_CHUNK_SIZE = 5000
+RETENTION_CHUNK_PAUSE = 0.05
+RETENTION_INTERVAL = 3600
+
+# Cache
+# Через кэш между процессами передаются сброс кэша видимых устройств и время активности устройств, поэтому
+# в работе с несколькими процессами (веб-сервер и прием сообщений) он должен быть общим (redis, memcached).
+# Кэш в памяти процесса годится только для разработки: manage.py check --deploy отклоняет его (group_police.E001)
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+# Device list
+# Размер страницы списка устройств и время жизни кэша видимых пользователю устройств
+
+DEVICE_LIST_PAGE_SIZE = 50
+VISIBLE_DEVICES_CACHE_TTL = 300
+
+# Кэш эффективных прав пользователей (группы, роли, группы устройств) в памяти процесса
+
+PERMISSION_CACHE_SIZE = 10000
+PERMISSION_CACHE_TTL = 300
+
+# JWT
+# Кольцо ключей подписи: новые токены подписываются JWT_ACTIVE_KEY_ID, а проверка идет по kid
+# из заголовка токена. При ротации новый ключ добавляется и делается активным, старый удаляется
+# после истечения выданных им refresh-токенов
+
+JWT_SIGNING_KEYS = {
+    'k1': os.environ.get('JWT_SECRET_KEY', SECRET_KEY),
+}
+JWT_ACTIVE_KEY_ID = 'k1'
+# Срок токена устройства, секунд; устройство повторяет регистрацию до его истечения (expires_in в ответе)
+DEVICE_TOKEN_LIFETIME = 24 * 60 * 60
+JWT_VERIFY_CACHE_SIZE = 100000
+
+# Live stream
+# Страница устройства получает новые сообщения через Server-Sent Events (нужен ASGI-сервер,
+# например uvicorn PDP.asgi:application). Поток закрывается через LIVE_STREAM_MAX_AGE секунд,
+# браузер переподключается через LIVE_STREAM_RETRY миллисекунд. Сообщения для страниц публикует прием
+# после сохранения в топик pdp/live/<uid> (LIVE_STREAM_PUBLISH)
+
+LIVE_STREAM_QUEUE_SIZE = 100
+LIVE_STREAM_HEARTBEAT = 15
+LIVE_STREAM_MAX_AGE = 300
+LIVE_STREAM_RETRY = 3000
+LIVE_STREAM_PUBLISH = True
+
+# Request metrics
+# Число SQL-запросов, время в БД и время ответа по каждому запросу: заголовок Server-Timing и гистограммы
+# по имени URL на metrics/requests/ (только с REQUEST_METRICS_ALLOWED_IPS). Выключенный middleware не подключается
+
+REQUEST_METRICS_ENABLED = os.environ.get('REQUEST_METRICS_ENABLED', '') == '1'
+REQUEST_METRICS_ALLOWED_IPS = ('127.0.0.1', '::1')
+REQUEST_METRICS_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500)  # миллисекунды
+REQUEST_METRICS_QUERY_BUCKETS = (1, 5, 10, 20, 50, 100, 200)
@@ -3,8 +3,9 @@ from django.urls import path, re_path
 from django_otp.views import login
 
 from group_police.admin import admin_site
+from group_police.instrumentation import request_metrics_view
 from group_police.views import RegisterView, create_user, confirm_register, IoTDeviceView, IoTDeviceListView, \
-    logout_user
+    IoTDeviceMessagesView, IoTDeviceMetricView, device_stream, IoTDevicesAPIView, logout_user
 
 urlpatterns = [
     path('admin_2fa/', admin_site.urls),
@@ -17,5 +18,9 @@ urlpatterns = [
     path('devices/', IoTDeviceListView.as_view(), name='device_list'),
     path('devices/<int:pk>/', IoTDeviceView.as_view(), name='device'),
     path('devices/<int:pk>/', IoTDeviceView.as_view(), name='device'),
-    # path('api/send_to_device/', IoTDevicesAPIView.as_view(), name='send_to_device'),
+    path('devices/<int:pk>/messages/', IoTDeviceMessagesView.as_view(), name='device_messages'),
+    path('devices/<int:pk>/stream/', device_stream, name='device_stream'),
+    path('devices/<int:pk>/metrics/<str:metric>/', IoTDeviceMetricView.as_view(), name='device_metric'),
+    path('metrics/requests/', request_metrics_view, name='request_metrics'),
+    path('api/send_to_device/', IoTDevicesAPIView.as_view(), name='send_to_device'),
 ]
@@ -7,4 +7,6 @@ class GroupPoliceConfig(AppConfig):
     verbose_name = 'Групповые политики'
 
     def ready(self):
+        import group_police.checks
+        import group_police.db
         import group_police.signals
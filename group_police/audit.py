@@ -0,0 +1,124 @@
+import atexit
+import logging
+import queue
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import close_old_connections, DatabaseError
+
+logger = logging.getLogger(__name__)
+
+
+class AuditLogWriter:
+    """
+    Буферизованная запись журналов аудита (UserLog, IoTDeviceLog, UserToDeviceLog).
+
+    Записи складываются в очередь в памяти, а фоновый поток сохраняет их через
+    bulk_create, когда набирается AUDIT_LOG_BATCH_SIZE записей или проходит
+    AUDIT_LOG_FLUSH_INTERVAL секунд. При штатном завершении процесса очередь дописывается.
+    """
+
+    def __init__(self, background=True):
+        self.background = background
+        self._queue = queue.Queue(maxsize=getattr(settings, 'AUDIT_LOG_QUEUE_SIZE', 100000))
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def batch_size(self):
+        return getattr(settings, 'AUDIT_LOG_BATCH_SIZE', 500)
+
+    @property
+    def flush_interval(self):
+        return getattr(settings, 'AUDIT_LOG_FLUSH_INTERVAL', 1.0)
+
+    def write(self, record):
+        """ Принимает несохраненный экземпляр модели журнала """
+        if not getattr(settings, 'AUDIT_LOG_ASYNC', True):
+            type(record).objects.bulk_create([record])
+            return
+        # При переполнении очереди запрос ждет, пока фоновый поток ее разберет
+        self._queue.put(record)
+        if self.background:
+            self._ensure_started()
+            if self._queue.qsize() >= self.batch_size:
+                self._wake.set()
+
+    def write_many(self, records):
+        """ Несколько записей сразу: в синхронном режиме по одному bulk_create на модель """
+        if getattr(settings, 'AUDIT_LOG_ASYNC', True):
+            for record in records:
+                self.write(record)
+            return
+        by_model = defaultdict(list)
+        for record in records:
+            by_model[type(record)].append(record)
+        for model, batch in by_model.items():
+            model.objects.bulk_create(batch, batch_size=self.batch_size)
+
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name='audit-log-writer', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Audit log flush failed')
+        close_old_connections()
+
+    def _drain(self):
+        records = []
+        while True:
+            try:
+                records.append(self._queue.get_nowait())
+            except queue.Empty:
+                return records
+
+    def flush(self):
+        """ Сохраняет все накопленные записи, по одному bulk_create на модель """
+        with self._flush_lock:
+            records = self._drain()
+            if not records:
+                return 0
+            close_old_connections()
+            by_model = defaultdict(list)
+            for record in records:
+                by_model[type(record)].append(record)
+            for model, batch in by_model.items():
+                try:
+                    model.objects.bulk_create(batch, batch_size=self.batch_size)
+                except DatabaseError:
+                    # Одна запись с нарушенной ссылкой не должна лишать журнала всю пачку
+                    logger.exception('Bulk audit write failed, retrying %s records one by one', len(batch))
+                    for record in batch:
+                        try:
+                            model.objects.bulk_create([record])
+                        except DatabaseError:
+                            logger.exception('Audit record dropped: %s', record.description)
+            return len(records)
+
+    def stop(self):
+        self._stopping.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+
+audit_log = AuditLogWriter()
+atexit.register(audit_log.stop)
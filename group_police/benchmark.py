@@ -0,0 +1,180 @@
+import json
+import statistics
+import time
+from datetime import timedelta
+from typing import NamedTuple
+
+from django.contrib.auth.models import Group, Permission
+from django.test import Client
+from django.urls import reverse
+from django.utils import timezone
+
+from group_police.audit import audit_log
+from group_police.decision import decision_point
+from group_police.instrumentation import track_queries
+from group_police.models import AccessPolicy, IoTDevice, IoTGroup, IoTMessage, IoTUser
+from group_police.signals import bulk_import
+
+
+class SeedSize(NamedTuple):
+    users: int = 100
+    groups: int = 20
+    policies: int = 50
+    devices: int = 1000
+    messages: int = 20000
+
+
+class BenchmarkResult(NamedTuple):
+    name: str
+    iterations: int
+    p50_ms: float
+    p99_ms: float
+    mean_ms: float
+    queries: float  # запросов к БД на одну итерацию
+    throughput: float  # операций (или сообщений) в секунду
+
+    def as_dict(self):
+        return self._asdict()
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def measure(name, func, iterations, units=1):
+    """ Задержки и число запросов на вызов func; units - сколько операций выполняет один вызов """
+    func()  # прогрев кэшей, чтобы первый вызов не искажал перцентили
+    samples = []
+    with track_queries() as queries:
+        for _ in range(iterations):
+            started = time.perf_counter()
+            func()
+            samples.append(time.perf_counter() - started)
+    total = sum(samples)
+    return BenchmarkResult(
+        name=name,
+        iterations=iterations,
+        p50_ms=percentile(samples, 0.5) * 1000,
+        p99_ms=percentile(samples, 0.99) * 1000,
+        mean_ms=statistics.fmean(samples) * 1000,
+        queries=queries.count / iterations,
+        throughput=iterations * units / total if total else 0.0,
+    )
+
+
+def seed(size):
+    """
+    Заполняет БД данными для измерений. Пользователь bench-user-0 проходит только по
+    последней политике, поэтому проверка доступа перебирает все политики.
+    """
+    with bulk_import(description='Данные для бенчмарка'):
+        role = Group.objects.create(name='bench-operator')
+        other_role = Group.objects.create(name='bench-guest')
+        role.permissions.add(Permission.objects.get(name='can view device information'))
+
+        groups = IoTGroup.objects.bulk_create(
+            IoTGroup(name=f'bench-group-{i}', description='') for i in range(size.groups)
+        )
+        policies = AccessPolicy.objects.bulk_create(
+            AccessPolicy(name=f'bench-policy-{i}') for i in range(size.policies)
+        )
+        AccessPolicy.allowed_roles.through.objects.bulk_create(
+            AccessPolicy.allowed_roles.through(accesspolicy_id=policy.id, group_id=other_role.id)
+            for policy in policies[:-1]
+        )
+        if policies:
+            policies[-1].allowed_roles.add(role)
+
+        users = IoTUser.objects.bulk_create(
+            IoTUser(username=f'bench-user-{i}', password='!') for i in range(size.users)
+        )
+        IoTUser.roles.through.objects.bulk_create(
+            IoTUser.roles.through(iotuser_id=user.id, group_id=role.id) for user in users
+        )
+        IoTUser.groups.through.objects.bulk_create(
+            IoTUser.groups.through(iotuser_id=user.id, group_id=role.id) for user in users
+        )
+        IoTUser.allowed_iot_groups.through.objects.bulk_create(
+            IoTUser.allowed_iot_groups.through(iotuser_id=user.id, iotgroup_id=group.id)
+            for user in users for group in groups[:max(1, len(groups) // 2)]
+        )
+
+        now = timezone.now()
+        devices = IoTDevice.objects.bulk_create(
+            IoTDevice(device_name=f'bench-{i}', uid=f'bench-{i}', device_type='temperature_sensor',
+                      last_seen=now - timedelta(seconds=i))
+            for i in range(size.devices)
+        )
+        if groups:
+            IoTDevice.groups.through.objects.bulk_create(
+                IoTDevice.groups.through(iotdevice_id=device.id, iotgroup_id=groups[i % len(groups)].id)
+                for i, device in enumerate(devices)
+            )
+        if devices:
+            IoTMessage.objects.bulk_create(
+                (
+                    IoTMessage(
+                        device_id=devices[i % len(devices)].id,
+                        topic=f'devices/{devices[i % len(devices)].uid}/data',
+                        msg=json.dumps({'temperature': 20 + i % 10}),
+                        receive_time=now - timedelta(seconds=i),
+                    )
+                    for i in range(size.messages)
+                ),
+                batch_size=1000,
+            )
+    decision_point.invalidate()
+    return users[0] if users else None, devices
+
+
+def bench_ingestion(devices, messages, batch_size=1000):
+    from mqtt_broker.ingest import IncomingMessage, MessageIngestor
+
+    ingestor = MessageIngestor(batch_size=batch_size)
+    ingestor.devices.load()
+    now = timezone.now()
+    batch = [
+        IncomingMessage(
+            i, 1, f'devices/{devices[i % len(devices)].uid}/data',
+            json.dumps({'temperature': i % 40}).encode(), now,
+        )
+        for i in range(batch_size)
+    ]
+    iterations = max(1, messages // batch_size)
+    return measure('ingestion_batch', lambda: ingestor.store(batch), iterations, units=batch_size)
+
+
+def run_benchmarks(size, iterations=50):
+    """ Все измерения: веб-страницы, проверка доступа и прием сообщений """
+    user, devices = seed(size)
+    audit_log.flush()
+    client = Client()
+    client.force_login(user)
+    device = devices[0]
+    device_list_url = reverse('device_list')
+    device_url = reverse('device', kwargs={'pk': device.pk})
+    results = [
+        measure('device_list_view', lambda: client.get(device_list_url), iterations),
+        measure('device_view', lambda: client.get(device_url), iterations),
+        measure('check_access', lambda: decision_point.check_access(user, device), iterations * 10),
+        bench_ingestion(devices, size.messages),
+    ]
+    audit_log.flush()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """ Регрессии относительно предыдущего прогона: p99 или число запросов выросли больше чем на tolerance """
+    previous = {item['name']: item for item in baseline.get('results', ())}
+    regressions = []
+    for result in results:
+        before = previous.get(result.name)
+        if before is None:
+            continue
+        if result.p99_ms > before['p99_ms'] * (1 + tolerance):
+            regressions.append(f'{result.name}: p99 {before["p99_ms"]:.2f} -> {result.p99_ms:.2f} ms')
+        if result.queries > before['queries']:
+            regressions.append(f'{result.name}: queries {before["queries"]:.1f} -> {result.queries:.1f}')
+    return regressions
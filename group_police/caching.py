@@ -0,0 +1,46 @@
+import threading
+import time
+
+from django.conf import settings
+
+
+class CachedIndex:
+    """
+    Индекс политик в памяти процесса. Сбрасывается invalidate() по сигналам, а изменения
+    из других процессов подхватываются не позже, чем через ttl_setting секунд (None - без срока).
+    Подклассы задают ttl_setting и build_index().
+    """
+
+    ttl_setting = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._index = None
+        self._built_at = 0.0
+        self._generation = 0
+
+    def build_index(self):
+        raise NotImplementedError
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._index = None
+
+    def _expired(self):
+        ttl = getattr(settings, self.ttl_setting, 30)
+        return ttl is not None and time.monotonic() - self._built_at > ttl
+
+    def get_index(self):
+        index = self._index
+        if index is not None and not self._expired():
+            return index
+        with self._lock:
+            generation = self._generation
+        index = self.build_index()
+        with self._lock:
+            # Если за время сборки политики поменялись, индекс используется один раз и не сохраняется
+            if generation == self._generation:
+                self._index = index
+                self._built_at = time.monotonic()
+        return index
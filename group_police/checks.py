@@ -0,0 +1,27 @@
+from django.conf import settings
+from django.core.cache import DEFAULT_CACHE_ALIAS
+from django.core.checks import Error, Tags, register
+
+# Кэши в памяти одного процесса: то, что в них положил один процесс, другим не видно
+PROCESS_LOCAL_CACHES = ('django.core.cache.backends.locmem.LocMemCache',)
+
+
+def shared_cache(alias=DEFAULT_CACHE_ALIAS):
+    return settings.CACHES[alias]['BACKEND'] not in PROCESS_LOCAL_CACHES
+
+
+@register(Tags.caches, deploy=True)
+def check_shared_cache(app_configs, **kwargs):
+    """
+    Сброс кэша видимых устройств (visibility) и время активности от процесса приема (last_seen)
+    передаются между процессами через кэш Django. С кэшем в памяти процесса остальные веб-процессы
+    держат устаревшие наборы видимых устройств до VISIBLE_DEVICES_CACHE_TTL
+    """
+    if shared_cache():
+        return []
+    return [Error(
+        'The default cache is local to each process, so device visibility invalidation and '
+        'last_seen values are not shared between web and ingestion processes.',
+        hint='Configure a shared CACHES backend (redis, memcached or database).',
+        id='group_police.E001',
+    )]
@@ -0,0 +1,39 @@
+import zlib
+
+from django.conf import settings
+
+# Первый байт IoTMessage.body - способ сжатия, чтобы старые строки читались после смены словаря
+ZLIB_DICT_V1 = 1
+
+# Предустановленный словарь zlib: частые ключи и значения сообщений датчиков. Короткие сообщения
+# сами по себе почти не сжимаются, а со словарем повторяющиеся ключи кодируются ссылками.
+# Словарь нельзя менять: для нового нужен новый номер способа сжатия
+ZDICT_V1 = (
+    b'"device_type":"temperature_sensor""wet_sensor""pressure_sensor""status":"ok""message":'
+    b'"No auth token available""Processing your request""device_data":{"mac":"ip":"serial":'
+    b'"jwt":"eyJhbGciOiJIUzI1NiIsImtpZCI6ImsxIiwidHlwIjoiSldUIn0.eyJ'
+    b'"battery":"voltage":"rssi":"co2":"pressure":"humidity":"sent_at":"device_id":"temperature":'
+)
+
+
+def compress(text):
+    compressor = zlib.compressobj(level=6, zdict=ZDICT_V1)
+    return bytes([ZLIB_DICT_V1]) + compressor.compress(text.encode('utf-8')) + compressor.flush()
+
+
+def decompress(body):
+    body = bytes(body)
+    if body[0] != ZLIB_DICT_V1:
+        raise ValueError(f'Unknown compression scheme: {body[0]}')
+    decompressor = zlib.decompressobj(zdict=ZDICT_V1)
+    return (decompressor.decompress(body[1:]) + decompressor.flush()).decode('utf-8')
+
+
+def storage_fields(text):
+    """ Значения (msg, body) IoTMessage: сжатое тело, если сжатие включено и дает выигрыш, иначе текст """
+    if not settings.MESSAGE_COMPRESSION or len(text) < settings.MESSAGE_COMPRESSION_MIN_LENGTH:
+        return text, None
+    body = compress(text)
+    if len(body) >= len(text.encode('utf-8')):
+        return text, None
+    return '', body
@@ -0,0 +1,169 @@
+from collections import defaultdict
+from typing import NamedTuple
+
+from group_police.audit import audit_log
+from group_police.caching import CachedIndex
+from group_police.models import AccessPolicy, UserLog, log_user_to_device
+from group_police.permissions import permission_cache
+
+REASON_ROLES = 'Несоответствие ролей'
+REASON_CONTEXT = 'Несоответствие контекста'
+REASON_ATTRIBUTES = 'Несоответствие атрибутов'
+
+# Политика, по которой в этой сессии уже записано разрешение на список устройств
+LIST_ACCESS_SESSION_KEY = 'device_list_policy'
+
+
+class CompiledPolicy(NamedTuple):
+    position: int
+    id: int
+    name: str
+    roles: frozenset
+    conditions: tuple
+
+
+class PolicyIndex(NamedTuple):
+    policies: tuple  # все политики в порядке pk
+    by_role: dict  # имя роли -> позиции политик, разрешающих эту роль
+
+
+class Decision(NamedTuple):
+    allowed: bool
+    policy: CompiledPolicy
+    denials: tuple  # (политика, причина) для политик, проверенных до решения
+
+
+def compile_policies():
+    """ Собирает все AccessPolicy в индекс в памяти за два запроса """
+    rows = AccessPolicy.objects.order_by('pk').values_list('id', 'name', 'conditions')
+    roles = defaultdict(set)
+    for policy_id, role_name in AccessPolicy.allowed_roles.through.objects.values_list(
+            'accesspolicy_id', 'group__name'):
+        roles[policy_id].add(role_name)
+
+    policies = []
+    by_role = defaultdict(list)
+    for position, (policy_id, name, conditions) in enumerate(rows):
+        policy = CompiledPolicy(
+            position=position,
+            id=policy_id,
+            name=name,
+            roles=frozenset(roles[policy_id]),
+            conditions=tuple((conditions or {}).items()),
+        )
+        policies.append(policy)
+        for role in policy.roles:
+            by_role[role].append(position)
+    return PolicyIndex(
+        policies=tuple(policies),
+        by_role={role: tuple(positions) for role, positions in by_role.items()},
+    )
+
+
+def _condition_failure(policy, user, context):
+    for key, value in policy.conditions:
+        if key in context and context[key] != value:
+            return REASON_CONTEXT
+    for key, value in policy.conditions:
+        if user.attributes.get(key) != value:
+            return REASON_ATTRIBUTES
+    return None
+
+
+class PolicyDecisionPoint(CachedIndex):
+    """
+    Точка принятия решений по AccessPolicy.
+
+    Политики компилируются в индекс по ролям один раз и дальше решение
+    принимается без обращений к БД. Индекс сбрасывается сигналами при изменении
+    политик, а в остальных процессах устаревает не позже ACCESS_POLICY_CACHE_TTL секунд.
+    Роли пользователя берутся из кэша эффективных прав.
+    """
+
+    ttl_setting = 'ACCESS_POLICY_CACHE_TTL'
+
+    def build_index(self):
+        return compile_policies()
+
+    def user_roles(self, user):
+        return permission_cache.get(user).roles
+
+    def evaluate(self, user, context=None):
+        """ Решение по RBAC и ABAC с той же семантикой, что и перебор AccessPolicy.check_access """
+        if context is None:
+            context = {}
+        index = self.get_index()
+        candidates = sorted({
+            position
+            for role in self.user_roles(user)
+            for position in index.by_role.get(role, ())
+        })
+        denials = []
+        checked = 0
+        for position in candidates:
+            policy = index.policies[position]
+            denials.extend((skipped, REASON_ROLES) for skipped in index.policies[checked:position])
+            checked = position + 1
+            reason = _condition_failure(policy, user, context)
+            if reason is None:
+                return Decision(allowed=True, policy=policy, denials=tuple(denials))
+            denials.append((policy, reason))
+        denials.extend((skipped, REASON_ROLES) for skipped in index.policies[checked:])
+        return Decision(allowed=False, policy=None, denials=tuple(denials))
+
+    def check_access(self, user, device, context=None):
+        """ Проверка доступа пользователя к устройству с записью в журнал """
+        decision = self.evaluate(user, context)
+        for policy, reason in decision.denials:
+            log_user_to_device(
+                device=device,
+                user=user,
+                status='Отказано',
+                description=f'Отказано в доступе согласно политике [{policy.name}] по причине: {reason}'
+            )
+        if decision.allowed:
+            log_user_to_device(
+                device=device,
+                user=user,
+                status='Разрешено',
+                description=f'Разрешено в доступе согласно политике [{decision.policy.name}]'
+            )
+        return decision.allowed
+
+    def allowed_devices(self, user, devices, context=None, session=None):
+        """
+        Пакетная проверка: какие из устройств (queryset или набор id) доступны пользователю.
+
+        Условия AccessPolicy не зависят от конкретного устройства, поэтому решение
+        принимается один раз на пакет, а в журнал пишется одна сводная запись. С session
+        (request.session) разрешение пишется один раз за сессию, а не на каждую страницу списка;
+        отказ пишется всегда.
+        """
+        if hasattr(devices, 'values_list'):
+            devices = devices.values_list('id', flat=True)
+        device_ids = frozenset(devices)
+        decision = self.evaluate(user, context)
+        if not decision.allowed:
+            if session is not None:
+                session.pop(LIST_ACCESS_SESSION_KEY, None)
+            audit_log.write(UserLog(
+                status='Отказано',
+                user=user,
+                description=(f'Пакетная проверка доступа: отказано для {len(device_ids)} устройств, '
+                             f'проверено политик: {len(decision.denials)}'),
+            ))
+            return frozenset()
+        if session is not None:
+            if session.get(LIST_ACCESS_SESSION_KEY) == decision.policy.id:
+                return device_ids
+            session[LIST_ACCESS_SESSION_KEY] = decision.policy.id
+        audit_log.write(UserLog(
+            status='Разрешено',
+            user=user,
+            description=(f'Пакетная проверка доступа: разрешено {len(device_ids)} устройств '
+                         f'согласно политике [{decision.policy.name}]'),
+        ))
+        return device_ids
+
+
+decision_point = PolicyDecisionPoint()
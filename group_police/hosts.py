@@ -0,0 +1,136 @@
+import ipaddress
+import logging
+import re
+from collections import defaultdict
+from typing import NamedTuple
+
+from group_police.caching import CachedIndex
+from group_police.models import RBACPolicy
+
+logger = logging.getLogger(__name__)
+
+ALLOW, DROP, REDIRECT = 'A', 'D', 'R'
+
+
+class HostMatch(NamedTuple):
+    action: str
+    policy_id: int
+    policy_name: str
+    prefix_len: int
+    redirect_hosts: tuple
+
+
+def parse_hosts(text):
+    """ Адреса и подсети из текстового поля: через пробелы, переводы строк, запятые или точки с запятой """
+    networks = []
+    for token in re.split(r'[\s,;]+', text or ''):
+        if not token:
+            continue
+        try:
+            networks.append(ipaddress.ip_network(token, strict=False))
+        except ValueError:
+            logger.warning('Skipping invalid host %r in RBAC policy', token)
+    return networks
+
+
+class PrefixTrie:
+    """ Двоичное префиксное дерево: поиск самого длинного совпавшего префикса за длину адреса """
+
+    def __init__(self, bits):
+        self.bits = bits
+        self.root = [None, None, None]  # потомок по биту 0, по биту 1, значение узла
+
+    def insert(self, network, value, better):
+        node = self.root
+        address = int(network.network_address)
+        for i in range(network.prefixlen):
+            bit = (address >> (self.bits - 1 - i)) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+        if node[2] is None or better(value, node[2]):
+            node[2] = value
+
+    def longest_match(self, address):
+        node = self.root
+        found = node[2]
+        for i in range(self.bits):
+            node = node[(address >> (self.bits - 1 - i)) & 1]
+            if node is None:
+                break
+            if node[2] is not None:
+                found = node[2]
+        return found
+
+
+def _earlier_policy(candidate, current):
+    return candidate.policy_id < current.policy_id
+
+
+def _better_match(candidate, current):
+    if current is None:
+        return True
+    return (candidate.prefix_len, -candidate.policy_id) > (current.prefix_len, -current.policy_id)
+
+
+class HostPolicyIndex:
+    def __init__(self, tries):
+        self._tries = tries  # id группы IoT-устройств -> {4: PrefixTrie, 6: PrefixTrie}
+
+    @classmethod
+    def build(cls):
+        # Адреса каждой политики разбираются один раз, а не для каждой ее группы
+        matches = {}
+        for policy in RBACPolicy.objects.all():
+            redirect_hosts = tuple(parse_hosts(policy.redirect_hosts))
+            matches[policy.id] = [
+                (network, HostMatch(policy.action, policy.id, policy.name, network.prefixlen, redirect_hosts))
+                for network in parse_hosts(policy.hosts)
+            ]
+        tries = defaultdict(lambda: {4: PrefixTrie(32), 6: PrefixTrie(128)})
+        for policy_id, group_id in RBACPolicy.iot_groups.through.objects.values_list('rbacpolicy_id', 'iotgroup_id'):
+            # Политика, созданная между двумя запросами, попадет в индекс при следующей пересборке
+            for network, match in matches.get(policy_id, ()):
+                tries[group_id][network.version].insert(network, match, _earlier_policy)
+        return cls(dict(tries))
+
+    def __bool__(self):
+        return bool(self._tries)
+
+    def match(self, address, group_ids):
+        """
+        Действие для адреса источника в группах устройств: побеждает самый длинный
+        префикс, при равных - политика с меньшим id. None, если ни одна политика не подходит.
+        """
+        if not self._tries:
+            return None
+        if isinstance(address, str):
+            try:
+                address = ipaddress.ip_address(address)
+            except ValueError:
+                return None
+        value = int(address)
+        best = None
+        for group_id in group_ids:
+            tries = self._tries.get(group_id)
+            if tries is None:
+                continue
+            match = tries[address.version].longest_match(value)
+            if match is not None and _better_match(match, best):
+                best = match
+        return best
+
+
+class HostPolicyEngine(CachedIndex):
+    """ Индекс RBACPolicy, пересобираемый по сигналам и не реже, чем раз в HOST_POLICY_CACHE_TTL секунд """
+
+    ttl_setting = 'HOST_POLICY_CACHE_TTL'
+
+    def build_index(self):
+        return HostPolicyIndex.build()
+
+    def match(self, address, group_ids):
+        return self.get_index().match(address, group_ids)
+
+
+host_policies = HostPolicyEngine()
@@ -0,0 +1,121 @@
+from datetime import timedelta
+from typing import Callable, NamedTuple
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.utils import timezone
+
+from group_police.models import (
+    IoTDevice, IoTDeviceLog, IoTMessage, IoTMetricRollup, IoTUser, UserLog, UserToDeviceLog,
+)
+from group_police.visibility import visible_devices
+
+# Идентификаторы для построения запросов: план не зависит от того, есть ли такие строки
+SAMPLE_ID = 1
+SAMPLE_UIDS = ['sensor-1', 'sensor-2']
+ADMIN_PAGE_SIZE = 100
+
+
+class HotQuery(NamedTuple):
+    name: str
+    source: str  # где выполняется запрос
+    build: Callable
+    scan_expected: bool = False  # полный проход ожидаем, например ORDER BY pk с LIMIT
+
+
+class QueryPlan(NamedTuple):
+    query: HotQuery
+    plan: str
+    full_scans: list  # таблицы, читаемые целиком
+    sorts: int  # сортировок, не покрытых индексом
+
+    @property
+    def ok(self):
+        return self.query.scan_expected or not (self.full_scans or self.sorts)
+
+
+def _message_page():
+    # Как в pagination.message_page, вместе с условием курсора
+    now = timezone.now()
+    return IoTMessage.objects.filter(device_id=SAMPLE_ID).filter(
+        receive_time__lte=now,
+    ).order_by('-receive_time', '-id')[:settings.DEVICE_MESSAGES_PAGE_SIZE + 1]
+
+
+def _device_list():
+    return visible_devices(IoTUser(pk=SAMPLE_ID)).values(
+        'id', 'device_name', 'device_type', 'last_seen',
+    ).order_by('-last_seen')[:settings.DEVICE_LIST_PAGE_SIZE]
+
+
+def _metric_series():
+    end = timezone.now()
+    return IoTMetricRollup.objects.filter(
+        device_id=SAMPLE_ID, metric='temperature', resolution='minute',
+        bucket__gte=end - timedelta(hours=1), bucket__lt=end,
+    ).order_by('bucket')
+
+
+def _admin_changelist(model):
+    # ModelAdmin без ordering сортирует по убыванию pk
+    return lambda: model.objects.order_by('-pk')[:ADMIN_PAGE_SIZE]
+
+
+HOT_QUERIES = [
+    HotQuery('device messages', 'views.IoTDeviceMessagesView', _message_page),
+    HotQuery('device list', 'views.IoTDeviceListView', _device_list),
+    HotQuery('device by uid', 'views.IoTDevicesAPIView', lambda: IoTDevice.objects.filter(uid=SAMPLE_UIDS[0])),
+    HotQuery('metric series', 'views.IoTDeviceMetricView', _metric_series),
+    HotQuery('ingest uid lookup', 'mqtt_broker.ingest',
+             lambda: IoTDevice.objects.filter(uid__in=SAMPLE_UIDS).values_list('uid', 'id')),
+    HotQuery('user audit events', 'UserToDeviceLog by user',
+             lambda: UserToDeviceLog.objects.filter(user_id=SAMPLE_ID).order_by('-at_time')[:ADMIN_PAGE_SIZE]),
+    HotQuery('device audit events', 'UserToDeviceLog by device',
+             lambda: UserToDeviceLog.objects.filter(device_id=SAMPLE_ID).order_by('-at_time')[:ADMIN_PAGE_SIZE]),
+    HotQuery('user log', 'UserLog by user',
+             lambda: UserLog.objects.filter(user_id=SAMPLE_ID).order_by('-at_time')[:ADMIN_PAGE_SIZE]),
+    HotQuery('device log', 'IoTDeviceLog by device',
+             lambda: IoTDeviceLog.objects.filter(device_id=SAMPLE_ID).order_by('-at_time')[:ADMIN_PAGE_SIZE]),
+    HotQuery('admin user log', 'admin.UserLogAdmin', _admin_changelist(UserLog), scan_expected=True),
+    HotQuery('admin user to device log', 'admin.UserToDeviceAdmin', _admin_changelist(UserToDeviceLog),
+             scan_expected=True),
+    HotQuery('admin device log', 'admin.IoTDeviceLogAdmin', _admin_changelist(IoTDeviceLog), scan_expected=True),
+]
+
+
+def analyse_plan(plan, vendor):
+    """ Таблицы, читаемые полным проходом, и число сортировок без индекса в тексте EXPLAIN """
+    full_scans, sorts = [], 0
+    for line in plan.splitlines():
+        if vendor == 'sqlite':
+            # Строки вида "<id> <parent> <notused> <detail>"
+            detail = line.split(' ', 3)[-1]
+            if detail.startswith('SCAN ') and 'USING' not in detail:
+                full_scans.append(detail.split()[1])
+            elif detail.startswith('USE TEMP B-TREE FOR'):
+                sorts += 1
+        elif vendor == 'postgresql':
+            node = line.strip().lstrip('->').strip()
+            if node.startswith(('Seq Scan on ', 'Parallel Seq Scan on ')):
+                full_scans.append(node.split(' on ', 1)[1].split()[0])
+            elif node.startswith('Sort ') or node.startswith('Incremental Sort '):
+                sorts += 1
+    return full_scans, sorts
+
+
+def explain(query, using='default'):
+    connection = connections[using]
+    queryset = query.build().using(using)
+    with transaction.atomic(using=using):
+        if connection.vendor == 'postgresql':
+            # На маленьких таблицах планировщик и так выберет Seq Scan; запрет показывает, есть ли подходящий индекс
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+        plan = queryset.explain()
+    full_scans, sorts = analyse_plan(plan, connection.vendor)
+    return QueryPlan(query, plan, full_scans, sorts)
+
+
+def advise(queries=None, using='default'):
+    """ Планы горячих запросов; у QueryPlan.ok == False есть полный проход таблицы или сортировка без индекса """
+    return [explain(query, using) for query in (queries or HOT_QUERIES)]
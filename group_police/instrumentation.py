@@ -0,0 +1,149 @@
+import bisect
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_http_methods
+
+
+class QueryStats:
+    """ Число запросов, суммарное время в БД и самый медленный запрос; подключается через execute_wrapper """
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.slowest_sql = None
+        self.slowest_seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.count += 1
+            self.seconds += elapsed
+            if elapsed > self.slowest_seconds:
+                self.slowest_seconds = elapsed
+                self.slowest_sql = sql
+
+
+@contextmanager
+def track_queries():
+    """ Статистика запросов ко всем БД внутри блока """
+    stats = QueryStats()
+    with ExitStack() as stack:
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(stats))
+        yield stats
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # последняя ячейка - больше верхней границы
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def as_dict(self):
+        labels = [f'le_{bound}' for bound in self.buckets] + ['inf']
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'buckets': dict(zip(labels, self.counts)),
+        }
+
+
+class RequestMetrics:
+    """ Агрегаты по имени URL: гистограммы времени ответа, времени в БД и числа запросов """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._routes = {}
+
+    def record(self, route, view_ms, db_ms, queries, slowest_sql, slowest_ms):
+        with self._lock:
+            metrics = self._routes.get(route)
+            if metrics is None:
+                buckets = settings.REQUEST_METRICS_BUCKETS
+                metrics = self._routes[route] = {
+                    'view_ms': Histogram(buckets),
+                    'db_ms': Histogram(buckets),
+                    'queries': Histogram(settings.REQUEST_METRICS_QUERY_BUCKETS),
+                    'slowest_sql': None,
+                    'slowest_ms': 0.0,
+                }
+            metrics['view_ms'].observe(view_ms)
+            metrics['db_ms'].observe(db_ms)
+            metrics['queries'].observe(queries)
+            if slowest_ms > metrics['slowest_ms']:
+                metrics['slowest_ms'] = slowest_ms
+                metrics['slowest_sql'] = slowest_sql
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                route: {
+                    key: value.as_dict() if isinstance(value, Histogram) else value
+                    for key, value in metrics.items()
+                }
+                for route, metrics in self._routes.items()
+            }
+
+    def reset(self):
+        with self._lock:
+            self._routes.clear()
+
+
+request_metrics = RequestMetrics()
+
+
+class QueryInstrumentationMiddleware:
+    """
+    Число запросов, время в БД и время обработки каждого запроса: заголовок Server-Timing
+    и гистограммы по имени URL. При REQUEST_METRICS_ENABLED = False исключается из цепочки
+    middleware при старте и ничего не стоит.
+    """
+
+    def __init__(self, get_response):
+        if not settings.REQUEST_METRICS_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        started = time.perf_counter()
+        with track_queries() as stats:
+            response = self.get_response(request)
+        view_ms = (time.perf_counter() - started) * 1000
+        db_ms = stats.seconds * 1000
+        slowest_ms = stats.slowest_seconds * 1000
+        match = request.resolver_match
+        route = match.view_name if match is not None else 'unresolved'
+        request_metrics.record(route, view_ms, db_ms, stats.count, stats.slowest_sql, slowest_ms)
+        response['Server-Timing'] = (
+            f'db;dur={db_ms:.1f};desc="{stats.count} queries", '
+            f'slowest-query;dur={slowest_ms:.1f}, '
+            f'view;dur={view_ms:.1f}'
+        )
+        return response
+
+
+@csrf_exempt
+@require_http_methods(['GET', 'DELETE'])
+def request_metrics_view(request):
+    """ Агрегированные метрики запросов (DELETE - сброс); доступны только с адресов REQUEST_METRICS_ALLOWED_IPS """
+    if request.META.get('REMOTE_ADDR') not in settings.REQUEST_METRICS_ALLOWED_IPS:
+        return JsonResponse({'error': 'Отказано в доступе'}, status=403)
+    if request.method == 'DELETE':
+        request_metrics.reset()
+    return JsonResponse({'enabled': settings.REQUEST_METRICS_ENABLED, 'routes': request_metrics.snapshot()})
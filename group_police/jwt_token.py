@@ -1,34 +1,124 @@
+import hashlib
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
 import jwt
-from datetime import datetime, timedelta
+from django.conf import settings
+
+ALGORITHM = "HS256"
+
+ACCESS_TOKEN_LIFETIME = timedelta(minutes=15)
+REFRESH_TOKEN_LIFETIME = timedelta(days=7)
 
-secret_key = "your-secret-key"
-payload = {
-    "user_id": 123,
-    "exp": datetime.utcnow() + timedelta(minutes=15)  # Токен действителен 15 минут
-}
 
-token = jwt.encode(payload, secret_key, algorithm="HS256")
+def _encode(claims):
+    # Подписываем активным ключом и указываем его kid, чтобы после ротации токен еще проверялся
+    kid = settings.JWT_ACTIVE_KEY_ID
+    return jwt.encode(claims, settings.JWT_SIGNING_KEYS[kid], algorithm=ALGORITHM, headers={"kid": kid})
 
 
 def create_access_token(user_id):
-    return jwt.encode({
+    return _encode({
         "user_id": user_id,
-        "exp": datetime.utcnow() + timedelta(minutes=15)
-    }, secret_key, algorithm="HS256")
+        "jti": uuid.uuid4().hex,
+        "exp": datetime.now(timezone.utc) + ACCESS_TOKEN_LIFETIME  # Токен действителен 15 минут
+    })
+
+
+def create_device_token(uid):
+    """ Токен устройства на DEVICE_TOKEN_LIFETIME секунд: claim device - его uid, прием сверяет его с топиком """
+    return _encode({
+        "device": uid,
+        "jti": uuid.uuid4().hex,
+        "exp": datetime.now(timezone.utc) + timedelta(seconds=settings.DEVICE_TOKEN_LIFETIME)
+    })
+
 
 # Генерация Refresh Token
 def create_refresh_token(user_id):
-    return jwt.encode({
+    return _encode({
         "user_id": user_id,
-        "exp": datetime.utcnow() + timedelta(days=7)
-    }, secret_key, algorithm="HS256")
+        "jti": uuid.uuid4().hex,
+        "exp": datetime.now(timezone.utc) + REFRESH_TOKEN_LIFETIME
+    })
+
+
+class TokenVerifier:
+    """
+    Проверка JWT с кэшем успешных проверок.
+
+    Результат кэшируется по SHA-256 токена до истечения его exp в LRU на
+    JWT_VERIFY_CACHE_SIZE записей. Ключ подписи выбирается по kid из JWT_SIGNING_KEYS,
+    отозванные jti хранятся до истечения exp токена и проверяются и для кэшированных токенов.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._revoked = {}  # jti -> exp отозванного токена
+
+    def _key_for(self, token):
+        kid = jwt.get_unverified_header(token).get("kid", settings.JWT_ACTIVE_KEY_ID)
+        try:
+            return kid, settings.JWT_SIGNING_KEYS[kid]
+        except KeyError:
+            raise jwt.InvalidTokenError(f"Unknown key id: {kid}")
+
+    def verify(self, token):
+        """ Возвращает claims токена или поднимает jwt.InvalidTokenError """
+        if isinstance(token, str):
+            token = token.encode()
+        digest = hashlib.sha256(token).digest()
+        now = time.time()
+        with self._lock:
+            cached = self._cache.get(digest)
+            if cached is not None:
+                # Токен, подписанный уже удаленным из кольца ключом, проверяется заново и отклоняется
+                if cached[0] > now and cached[1] in settings.JWT_SIGNING_KEYS:
+                    self._cache.move_to_end(digest)
+                    claims = cached[2]
+                else:
+                    del self._cache[digest]
+                    cached = None
+        if cached is None:
+            kid, key = self._key_for(token)
+            claims = jwt.decode(token, key, algorithms=[ALGORITHM])
+        if claims.get("jti") in self._revoked:
+            raise jwt.InvalidTokenError("Token has been revoked")
+        if cached is None and "exp" in claims:
+            with self._lock:
+                self._cache[digest] = (claims["exp"], kid, claims)
+                while len(self._cache) > settings.JWT_VERIFY_CACHE_SIZE:
+                    self._cache.popitem(last=False)
+        return claims
+
+    def revoke(self, jti, exp=None):
+        """ Отзывает токен до его exp; без exp - на время жизни самого долгого токена (refresh) """
+        now = time.time()
+        if exp is None:
+            exp = now + REFRESH_TOKEN_LIFETIME.total_seconds()
+        with self._lock:
+            # Истекший токен отклоняется и без списка отзыва
+            self._revoked = {revoked: until for revoked, until in self._revoked.items() if until > now}
+            self._revoked[jti] = exp
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
+token_verifier = TokenVerifier()
+
 
 # Обновление Access Token через Refresh Token
 def refresh_tokens(refresh_token):
     try:
-        decoded = jwt.decode(refresh_token, secret_key, algorithms=["HS256"])
+        decoded = token_verifier.verify(refresh_token)
         new_access_token = create_access_token(decoded["user_id"])
         return new_access_token
     except jwt.ExpiredSignatureError:
         # Refresh Token тоже истек, требуется перелогин
-        return None
\ No newline at end of file
+        return None
@@ -0,0 +1,58 @@
+import json
+import platform
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+from django.utils import timezone
+
+from group_police.benchmark import SeedSize, compare, run_benchmarks
+
+
+class Command(BaseCommand):
+    help = ('Заполняет отдельную тестовую БД и измеряет задержки (p50/p99) и число запросов '
+            'списка устройств, страницы устройства, проверки доступа и приема сообщений')
+
+    def add_arguments(self, parser):
+        defaults = SeedSize()
+        for field in SeedSize._fields:
+            parser.add_argument(f'--{field}', type=int, default=getattr(defaults, field),
+                                help=f'Количество {field} в тестовых данных')
+        parser.add_argument('--iterations', type=int, default=50, help='Повторов каждого измерения')
+        parser.add_argument('--output', help='Файл для результатов в JSON')
+        parser.add_argument('--baseline', help='JSON предыдущего прогона для поиска регрессий')
+        parser.add_argument('--tolerance', type=float, default=0.2, help='Допустимый рост p99, доля')
+
+    def handle(self, *args, **options):
+        size = SeedSize(**{field: options[field] for field in SeedSize._fields})
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            # Журналы пишутся синхронно, чтобы фоновый поток не влиял на замеры
+            with override_settings(AUDIT_LOG_ASYNC=False):
+                results = run_benchmarks(size, options['iterations'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        self.stdout.write(f'{"name":<20} {"p50 ms":>10} {"p99 ms":>10} {"queries":>8} {"ops/s":>12}')
+        for result in results:
+            self.stdout.write(f'{result.name:<20} {result.p50_ms:>10.2f} {result.p99_ms:>10.2f} '
+                              f'{result.queries:>8.1f} {result.throughput:>12.0f}')
+
+        report = {
+            'created_at': timezone.now().isoformat(),
+            'python': platform.python_version(),
+            'database': connection.vendor,
+            'seed': size._asdict(),
+            'results': [result.as_dict() for result in results],
+        }
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as output:
+                json.dump(report, output, indent=2)
+        if options['baseline']:
+            with open(options['baseline'], encoding='utf-8') as baseline:
+                regressions = compare(results, json.load(baseline), options['tolerance'])
+            if regressions:
+                raise CommandError('Regressions found:\n' + '\n'.join(regressions))
+            self.stdout.write(self.style.SUCCESS('No regressions against baseline'))
@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from group_police.index_advisor import HOT_QUERIES, advise
+
+
+class Command(BaseCommand):
+    help = ('Выполняет EXPLAIN для горячих запросов (страницы устройств, журналы аудита, админка, прием сообщений) '
+            'и сообщает о полных проходах таблиц и сортировках без индекса')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='default', help='Псевдоним БД')
+        parser.add_argument('--query', action='append', help='Только запросы с этим именем (можно несколько)')
+        parser.add_argument('--plan', action='store_true', help='Печатать планы целиком')
+        parser.add_argument('--strict', action='store_true', help='Код возврата 1, если есть проблемные запросы')
+
+    def handle(self, *args, **options):
+        queries = HOT_QUERIES
+        if options['query']:
+            queries = [query for query in HOT_QUERIES if query.name in options['query']]
+            if not queries:
+                raise CommandError(f'Неизвестный запрос, доступны: {", ".join(q.name for q in HOT_QUERIES)}')
+        results = advise(queries, using=options['database'])
+        for result in results:
+            problems = []
+            if result.full_scans:
+                problems.append(f'full scan: {", ".join(result.full_scans)}')
+            if result.sorts:
+                problems.append(f'{result.sorts} sort(s) without index')
+            line = f'{result.query.name:<28} {result.query.source:<32} {"; ".join(problems) or "index"}'
+            if result.ok:
+                self.stdout.write(line if not problems else f'{line} (expected)')
+            else:
+                self.stdout.write(self.style.WARNING(line))
+            if options['plan']:
+                self.stdout.write(result.plan + '\n')
+        bad = [result for result in results if not result.ok]
+        summary = f'{len(results) - len(bad)}/{len(results)} queries without unexpected scans or sorts'
+        if bad and options['strict']:
+            raise CommandError(summary)
+        self.stdout.write(self.style.SUCCESS(summary) if not bad else self.style.WARNING(summary))
@@ -0,0 +1,35 @@
+import time
+
+import jwt
+from django.core.management.base import BaseCommand
+
+from group_police.jwt_token import ALGORITHM, TokenVerifier, create_access_token
+
+
+class Command(BaseCommand):
+    help = 'Сравнивает скорость проверки JWT без кэша и с кэшем TokenVerifier'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tokens', type=int, default=1000, help='Количество различных токенов')
+        parser.add_argument('--rounds', type=int, default=20, help='Сколько раз проверяется каждый токен')
+
+    def measure(self, verify, tokens, rounds):
+        started = time.perf_counter()
+        for _ in range(rounds):
+            for token in tokens:
+                verify(token)
+        seconds = time.perf_counter() - started
+        return len(tokens) * rounds / seconds
+
+    def handle(self, *args, **options):
+        tokens = [create_access_token(user_id) for user_id in range(options['tokens'])]
+        verifier = TokenVerifier()
+        key_for = verifier._key_for
+
+        cold = self.measure(
+            lambda token: jwt.decode(token, key_for(token)[1], algorithms=[ALGORITHM]), tokens, options['rounds'],
+        )
+        cached = self.measure(verifier.verify, tokens, options['rounds'])
+        self.stdout.write(f'cold:   {cold:,.0f} verifications/s')
+        self.stdout.write(f'cached: {cached:,.0f} verifications/s')
+        self.stdout.write(self.style.SUCCESS(f'speedup: x{cached / cold:.1f}'))
@@ -0,0 +1,37 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from group_police.retention import prune_all
+
+
+class Command(BaseCommand):
+    help = 'Удаляет (и при необходимости архивирует) устаревшие сообщения и журналы согласно RETENTION_POLICIES'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Только посчитать строки к удалению')
+        parser.add_argument('--chunk-size', type=int, help='Строк в одном DELETE')
+        parser.add_argument('--pause', type=float, help='Пауза между порциями, секунд')
+        parser.add_argument('--loop', action='store_true', help='Запускаться периодически, как фоновая задача')
+        parser.add_argument('--interval', type=float, default=None, help='Период запуска в режиме --loop, секунд')
+
+    def handle(self, *args, **options):
+        interval = options['interval'] or settings.RETENTION_INTERVAL
+        while True:
+            results = prune_all(
+                chunk_size=options['chunk_size'],
+                pause=options['pause'],
+                dry_run=options['dry_run'],
+            )
+            for result in results:
+                line = f'{result.name}: {result.rows} rows, {result.chunks} chunks, {result.seconds:.2f}s'
+                if result.archive:
+                    line += f', archive {result.archive}'
+                self.stdout.write(line)
+            total = sum(result.rows for result in results)
+            seconds = sum(result.seconds for result in results)
+            self.stdout.write(self.style.SUCCESS(f'Total: {total} rows in {seconds:.2f}s'))
+            if not options['loop']:
+                break
+            time.sleep(interval)
@@ -0,0 +1,17 @@
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('group_police', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='usertodevicelog',
+            name='at_time',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+    ]
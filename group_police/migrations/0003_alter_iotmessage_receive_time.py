@@ -0,0 +1,17 @@
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('group_police', '0002_alter_usertodevicelog_at_time'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='iotmessage',
+            name='receive_time',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+    ]
@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('group_police', '0003_alter_iotmessage_receive_time'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='iotmessage',
+            index=models.Index(fields=['device', '-receive_time', '-id'], name='iotmessage_device_time_idx'),
+        ),
+    ]
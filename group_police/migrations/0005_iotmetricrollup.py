@@ -0,0 +1,36 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('group_police', '0004_iotmessage_iotmessage_device_time_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IoTMetricRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('metric', models.CharField(max_length=64, verbose_name='Показатель')),
+                ('resolution', models.CharField(choices=[('minute', 'Минута'), ('hour', 'Час'), ('day', 'День')], max_length=8, verbose_name='Разрешение')),
+                ('bucket', models.DateTimeField(verbose_name='Начало интервала')),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('min', models.FloatField()),
+                ('max', models.FloatField()),
+                ('sum', models.FloatField()),
+                ('last', models.FloatField()),
+                ('last_time', models.DateTimeField()),
+                ('device', models.ForeignKey(on_delete=django.db.models.deletion.DO_NOTHING, related_name='metric_rollups', to='group_police.iotdevice')),
+            ],
+            options={
+                'verbose_name': 'Агрегат телеметрии',
+                'verbose_name_plural': 'Агрегаты телеметрии',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='iotmetricrollup',
+            constraint=models.UniqueConstraint(fields=('device', 'metric', 'resolution', 'bucket'), name='unique_metric_rollup'),
+        ),
+    ]
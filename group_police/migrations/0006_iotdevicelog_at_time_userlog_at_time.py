@@ -0,0 +1,22 @@
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('group_police', '0005_iotmetricrollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='iotdevicelog',
+            name='at_time',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+        migrations.AddField(
+            model_name='userlog',
+            name='at_time',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+    ]
@@ -0,0 +1,19 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('group_police', '0006_iotdevicelog_at_time_userlog_at_time'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='iotdevice',
+            index=models.Index(fields=['last_seen'], name='iotdevice_last_seen_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='iotdevice',
+            index=models.Index(fields=['device_name'], name='iotdevice_device_name_idx'),
+        ),
+    ]
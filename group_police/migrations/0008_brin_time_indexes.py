@@ -0,0 +1,34 @@
+from django.db import migrations
+
+# BRIN-индексы по времени для таблиц, в которые строки пишутся в порядке времени.
+# Они в сотни раз меньше B-tree и почти не замедляют вставку; есть только в PostgreSQL,
+# поэтому на других СУБД миграция ничего не делает.
+BRIN_INDEXES = [
+    ('group_police_iotmessage', 'receive_time', 'iotmessage_receive_time_brin'),
+    ('group_police_usertodevicelog', 'at_time', 'usertodevicelog_at_time_brin'),
+]
+
+
+def create_brin_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for table, column, name in BRIN_INDEXES:
+        schema_editor.execute(f'CREATE INDEX IF NOT EXISTS {name} ON {table} USING brin ({column})')
+
+
+def drop_brin_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for table, column, name in BRIN_INDEXES:
+        schema_editor.execute(f'DROP INDEX IF EXISTS {name}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('group_police', '0007_iotdevice_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_brin_indexes, drop_brin_indexes),
+    ]
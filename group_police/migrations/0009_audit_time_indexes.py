@@ -0,0 +1,48 @@
+from django.db import migrations, models
+
+# Покрывающий индекс списка устройств: сортировка по last_seen и нужные таблице столбцы прямо
+# в индексе, без обращения к строкам таблицы. INCLUDE есть только в PostgreSQL
+COVERING_INDEXES = [
+    ('group_police_iotdevice', 'last_seen DESC', 'id, device_name, device_type', 'iotdevice_last_seen_covering'),
+]
+
+
+def create_covering_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for table, columns, include, name in COVERING_INDEXES:
+        schema_editor.execute(f'CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns}) INCLUDE ({include})')
+
+
+def drop_covering_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for table, columns, include, name in COVERING_INDEXES:
+        schema_editor.execute(f'DROP INDEX IF EXISTS {name}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('group_police', '0008_brin_time_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='userlog',
+            index=models.Index(fields=['user', '-at_time'], name='userlog_user_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='iotdevicelog',
+            index=models.Index(fields=['device', '-at_time'], name='iotdevicelog_device_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='usertodevicelog',
+            index=models.Index(fields=['user', '-at_time'], name='usertodevicelog_user_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='usertodevicelog',
+            index=models.Index(fields=['device', '-at_time'], name='usertodevicelog_dev_time_idx'),
+        ),
+        migrations.RunPython(create_covering_indexes, drop_covering_indexes),
+    ]
@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('group_police', '0009_audit_time_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='iotmessage',
+            name='body',
+            field=models.BinaryField(editable=False, null=True),
+        ),
+        migrations.AlterField(
+            model_name='iotmessage',
+            name='msg',
+            field=models.TextField(blank=True),
+        ),
+    ]
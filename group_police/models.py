@@ -3,15 +3,19 @@ from email.policy import default
 
 from django.contrib.auth.models import AbstractUser, Group, Permission
 from django.db import models
+from django.utils import timezone
+
+from group_police.audit import audit_log
+from group_police.compression import decompress
 
 
 def log_user_to_device(device, user, status, description):
-    UserToDeviceLog.objects.create(
+    audit_log.write(UserToDeviceLog(
         status=status,
         device=device,
         user=user,
         description=description,
-    )
+    ))
 
 
 class IoTUser(AbstractUser):
@@ -111,6 +115,11 @@ class IoTDevice(models.Model):
     class Meta:
         verbose_name = 'IoT-устройство'
         verbose_name_plural = 'IoT-устройства'
+        indexes = [
+            # Сортировка списка устройств
+            models.Index(fields=['last_seen'], name='iotdevice_last_seen_idx'),
+            models.Index(fields=['device_name'], name='iotdevice_device_name_idx'),
+        ]
 
     def __str__(self):
         return f'{self.device_name} [{self.device_type}]'
@@ -119,41 +128,104 @@ class IoTDevice(models.Model):
 class UserLog(models.Model):
     status = models.CharField(max_length=16, db_index=True)
     user = models.ForeignKey('IoTUser', on_delete=models.DO_NOTHING)
+    at_time = models.DateTimeField(default=timezone.now, editable=False)
     description = models.TextField()
 
     class Meta:
         verbose_name = 'События сгенерированные изменением групповых политик'
         verbose_name_plural = 'События сгенерированные изменением групповых политик'
+        indexes = [
+            # Журнал пользователя от новых событий к старым
+            models.Index(fields=['user', '-at_time'], name='userlog_user_time_idx'),
+        ]
 
 
 class IoTDeviceLog(models.Model):
     status = models.CharField(max_length=16, db_index=True)
     device = models.ForeignKey('IoTDevice', on_delete=models.DO_NOTHING)
+    at_time = models.DateTimeField(default=timezone.now, editable=False)
     description = models.TextField()
 
     class Meta:
         # db_table = 'RBACPolicy'
         verbose_name = 'События сгенерированные IoT-устройствами'
         verbose_name_plural = 'События сгенерированные IoT-устройствами'
+        indexes = [
+            models.Index(fields=['device', '-at_time'], name='iotdevicelog_device_time_idx'),
+        ]
 
 
 class UserToDeviceLog(models.Model):
     status = models.CharField(max_length=16, db_index=True)
     device = models.ForeignKey('IoTDevice', on_delete=models.DO_NOTHING)
     user = models.ForeignKey('IoTUser', on_delete=models.DO_NOTHING)
-    at_time = models.DateTimeField(auto_now_add=True)
+    at_time = models.DateTimeField(default=timezone.now, editable=False)  # время события, а не записи в БД
     description = models.TextField()
 
     class Meta:
         verbose_name = 'События сгенерированные изменением групп IoT-устройств'
         verbose_name_plural = 'События сгенерированные изменением групп IoT-устройств'
+        indexes = [
+            # Журналы аудита по пользователю и по устройству от новых событий к старым
+            models.Index(fields=['user', '-at_time'], name='usertodevicelog_user_time_idx'),
+            models.Index(fields=['device', '-at_time'], name='usertodevicelog_dev_time_idx'),
+        ]
 
 
 class IoTMessage(models.Model):
     device = models.ForeignKey(IoTDevice, on_delete=models.DO_NOTHING, db_index=True, related_name='device_msg')
-    receive_time = models.DateTimeField(auto_now_add=True)
+    receive_time = models.DateTimeField(default=timezone.now, editable=False)  # время приема брокером
     topic = models.CharField(max_length=50, db_index=True)
-    msg = models.TextField()
+    msg = models.TextField(blank=True)
+    body = models.BinaryField(null=True, editable=False)  # сжатый текст сообщения, msg при этом пустой
+
+    class Meta:
+        indexes = [
+            # История сообщений устройства постранично от новых к старым
+            models.Index(fields=['device', '-receive_time', '-id'], name='iotmessage_device_time_idx'),
+        ]
+
+    @property
+    def text(self):
+        return self.msg if self.body is None else decompress(self.body)
+
+    @staticmethod
+    def archive_row(row):
+        """ Строка .values() для архива retention: тело распаковывается в msg """
+        body = row.pop('body', None)
+        if body is not None:
+            row['msg'] = decompress(body)
+        return row
+
+    def __str__(self):
+        return f'msg: [{self.text}] received at {self.receive_time} from topic: {self.topic}'
+
+
+
+class IoTMetricRollup(models.Model):
+    RESOLUTIONS = [('minute', 'Минута'), ('hour', 'Час'), ('day', 'День')]
+
+    device = models.ForeignKey(IoTDevice, on_delete=models.DO_NOTHING, related_name='metric_rollups')
+    metric = models.CharField(max_length=64, verbose_name='Показатель')
+    resolution = models.CharField(max_length=8, choices=RESOLUTIONS, verbose_name='Разрешение')
+    bucket = models.DateTimeField(verbose_name='Начало интервала')
+    count = models.PositiveIntegerField(default=0)
+    min = models.FloatField()
+    max = models.FloatField()
+    sum = models.FloatField()
+    last = models.FloatField()
+    last_time = models.DateTimeField()
+
+    class Meta:
+        verbose_name = 'Агрегат телеметрии'
+        verbose_name_plural = 'Агрегаты телеметрии'
+        constraints = [
+            models.UniqueConstraint(fields=['device', 'metric', 'resolution', 'bucket'], name='unique_metric_rollup'),
+        ]
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else None
 
     def __str__(self):
-        return f'msg: [{self.msg}] received at {self.receive_time} from topic: {self.topic}'
+        return f'{self.metric} [{self.resolution} {self.bucket}] = {self.mean}'
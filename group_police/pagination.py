@@ -0,0 +1,49 @@
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db.models import Q
+
+from group_police.models import IoTMessage
+
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+# Границы курсора: время - в пределах datetime, id - в пределах знакового 64-битного целого БД
+MAX_CURSOR_MICROS = (datetime.max.replace(tzinfo=dt_timezone.utc) - EPOCH) // timedelta(microseconds=1)
+MAX_CURSOR_ID = 2 ** 63 - 1
+
+
+def encode_cursor(message):
+    """ Курсор вида <микросекунды receive_time>_<id> для сообщения, на котором закончилась страница """
+    micros = (message.receive_time - EPOCH) // timedelta(microseconds=1)
+    return f'{micros}_{message.id}'
+
+
+def decode_cursor(cursor):
+    """ Разбор курсора encode_cursor; подделанный или поврежденный курсор приводит к ValueError """
+    micros, _, message_id = cursor.partition('_')
+    micros, message_id = int(micros), int(message_id)
+    if not 0 <= micros <= MAX_CURSOR_MICROS or not 0 <= message_id <= MAX_CURSOR_ID:
+        raise ValueError(f'cursor out of range: {cursor!r}')
+    return EPOCH + timedelta(microseconds=micros), message_id
+
+
+def message_page(device, before=None, limit=None):
+    """
+    Страница истории сообщений устройства, от новых к старым.
+
+    Используется поиск по ключу (device, receive_time, id) вместо OFFSET, поэтому
+    стоимость страницы не зависит от длины истории. Возвращает сообщения и курсор
+    следующей страницы (None, если сообщений больше нет). Некорректный курсор
+    приводит к ValueError.
+    """
+    limit = limit or settings.DEVICE_MESSAGES_PAGE_SIZE
+    messages = IoTMessage.objects.filter(device=device)
+    if before:
+        receive_time, message_id = decode_cursor(before)
+        messages = messages.filter(
+            Q(receive_time__lt=receive_time) | Q(receive_time=receive_time, id__lt=message_id)
+        )
+    page = list(messages.order_by('-receive_time', '-id')[:limit + 1])
+    if len(page) > limit:
+        page = page[:limit]
+        return page, encode_cursor(page[-1])
+    return page, None
@@ -0,0 +1,79 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import NamedTuple
+
+from django.conf import settings
+from django.utils.functional import SimpleLazyObject
+
+
+class EffectivePermissions(NamedTuple):
+    names: frozenset  # имена разрешений групп пользователя
+    roles: frozenset  # имена ролей (IoTUser.roles)
+    iot_group_ids: frozenset  # разрешенные группы IoT-устройств
+
+    def __contains__(self, name):
+        return name in self.names
+
+
+NO_PERMISSIONS = EffectivePermissions(frozenset(), frozenset(), frozenset())
+
+
+def load_permissions(user):
+    return EffectivePermissions(
+        names=frozenset(
+            name for name in user.groups.values_list('permissions__name', flat=True) if name is not None
+        ),
+        roles=frozenset(user.roles.values_list('name', flat=True)),
+        iot_group_ids=frozenset(user.allowed_iot_groups.values_list('id', flat=True)),
+    )
+
+
+class PermissionCache:
+    """
+    Эффективные права пользователей в памяти процесса: LRU на PERMISSION_CACHE_SIZE
+    пользователей, запись живет PERMISSION_CACHE_TTL секунд или до сигнала об изменении.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, user):
+        if not user.is_authenticated:
+            return NO_PERMISSIONS
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user.pk)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(user.pk)
+                return entry[1]
+        permissions = load_permissions(user)
+        with self._lock:
+            self._entries[user.pk] = (now + settings.PERMISSION_CACHE_TTL, permissions)
+            self._entries.move_to_end(user.pk)
+            while len(self._entries) > settings.PERMISSION_CACHE_SIZE:
+                self._entries.popitem(last=False)
+        return permissions
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+permission_cache = PermissionCache()
+
+
+class EffectivePermissionsMiddleware:
+    """ Добавляет request.effective_permissions; права загружаются при первом обращении """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.effective_permissions = SimpleLazyObject(lambda: permission_cache.get(request.user))
+        return self.get_response(request)
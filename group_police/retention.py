@@ -0,0 +1,108 @@
+import gzip
+import json
+import logging
+import time
+from datetime import timedelta
+from pathlib import Path
+from typing import NamedTuple
+
+from django.apps import apps
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+
+class PruneResult(NamedTuple):
+    name: str
+    rows: int
+    chunks: int
+    seconds: float
+    archive: str
+
+
+class RetentionPolicy:
+    """
+    Правило хранения для одной таблицы.
+
+    model - метка модели ('group_police.IoTMessage'), time_field - поле времени,
+    days - сколько дней хранить, filter/exclude - дополнительные условия (например,
+    {'device__device_type': 'temperature_sensor'}), archive - выгружать ли строки
+    в сжатый JSONL перед удалением.
+    """
+
+    def __init__(self, model, time_field, days, filter=None, exclude=None, archive=False, name=None):
+        self.model = apps.get_model(model)
+        self.time_field = time_field
+        self.days = days
+        self.filter = filter or {}
+        self.exclude = exclude or {}
+        self.archive = archive
+        self.name = name or self.model._meta.label
+
+    def expired(self, now=None):
+        cutoff = (now or timezone.now()) - timedelta(days=self.days)
+        queryset = self.model.objects.filter(**{f'{self.time_field}__lt': cutoff}, **self.filter)
+        if self.exclude:
+            queryset = queryset.exclude(**self.exclude)
+        return queryset
+
+
+def load_policies():
+    return [RetentionPolicy(**policy) for policy in settings.RETENTION_POLICIES]
+
+
+def archive_path(policy, now):
+    directory = Path(settings.RETENTION_ARCHIVE_DIR)
+    directory.mkdir(parents=True, exist_ok=True)
+    slug = policy.name.replace('.', '_').replace(' ', '_').lower()
+    return directory / f'{slug}-{now:%Y%m%d}.jsonl.gz'
+
+
+def prune(policy, chunk_size=None, pause=None, dry_run=False, now=None):
+    """
+    Удаляет устаревшие строки порциями по chunk_size первичных ключей.
+
+    Каждая порция - отдельный короткий DELETE, между порциями делается пауза,
+    чтобы прием сообщений и запросы не ждали блокировку БД.
+    """
+    chunk_size = chunk_size or settings.RETENTION_CHUNK_SIZE
+    pause = settings.RETENTION_CHUNK_PAUSE if pause is None else pause
+    now = now or timezone.now()
+    started = time.monotonic()
+    expired = policy.expired(now).order_by('pk')
+    if dry_run:
+        return PruneResult(policy.name, expired.count(), 0, time.monotonic() - started, '')
+
+    path = archive_path(policy, now) if policy.archive else None
+    rows = chunks = 0
+    last_pk = None
+    while True:
+        chunk = expired if last_pk is None else expired.filter(pk__gt=last_pk)
+        pks = list(chunk.values_list('pk', flat=True)[:chunk_size])
+        if not pks:
+            break
+        if path is not None:
+            # gzip допускает дозапись: каждая порция становится отдельным членом архива
+            # Модель может привести строку к виду для архива, например распаковать сжатые поля
+            archive_row = getattr(policy.model, 'archive_row', lambda row: row)
+            with gzip.open(path, 'at', encoding='utf-8') as archive:
+                for row in policy.model.objects.filter(pk__in=pks).values():
+                    row = archive_row(row)
+                    archive.write(json.dumps(row, cls=DjangoJSONEncoder, ensure_ascii=False) + '\n')
+        policy.model.objects.filter(pk__in=pks).delete()
+        rows += len(pks)
+        chunks += 1
+        last_pk = pks[-1]
+        if len(pks) < chunk_size:
+            break
+        if pause:
+            time.sleep(pause)
+    result = PruneResult(policy.name, rows, chunks, time.monotonic() - started, str(path or ''))
+    logger.info('Retention %s: pruned %s rows in %s chunks, %.2fs', result.name, rows, chunks, result.seconds)
+    return result
+
+
+def prune_all(**kwargs):
+    return [prune(policy, **kwargs) for policy in load_policies()]
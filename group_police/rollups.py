@@ -0,0 +1,166 @@
+import json
+import math
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection
+
+from group_police.models import IoTMetricRollup
+
+RESOLUTION_STEPS = {
+    'minute': timedelta(minutes=1),
+    'hour': timedelta(hours=1),
+    'day': timedelta(days=1),
+}
+
+
+def truncate(moment, resolution):
+    """ Начало интервала заданного разрешения, в который попадает момент времени """
+    moment = moment.replace(second=0, microsecond=0)
+    if resolution in ('hour', 'day'):
+        moment = moment.replace(minute=0)
+    if resolution == 'day':
+        moment = moment.replace(hour=0)
+    return moment
+
+
+def parse_payload(payload):
+    """ JSON-сообщение устройства или None, если это не JSON """
+    try:
+        return json.loads(payload)
+    except (TypeError, ValueError):
+        return None
+
+
+def extract_metrics(payload):
+    """
+    Числовые поля верхнего уровня из JSON-сообщения устройства (строка или уже разобранный dict).
+    NaN, бесконечности, числа вне диапазона float и слишком длинные имена пропускаются:
+    такие значения не сохраняются в IoTMetricRollup
+    """
+    data = payload if isinstance(payload, dict) else parse_payload(payload)
+    if not isinstance(data, dict):
+        return {}
+    ignored = settings.ROLLUP_IGNORED_FIELDS
+    max_length = IoTMetricRollup._meta.get_field('metric').max_length
+    metrics = {}
+    for key, value in data.items():
+        if not isinstance(value, (int, float)) or isinstance(value, bool):
+            continue
+        if key in ignored or len(key) > max_length:
+            continue
+        try:
+            value = float(value)
+        except OverflowError:
+            continue
+        if math.isfinite(value):
+            metrics[key] = value
+    return metrics
+
+
+ROLLUP_FIELDS = ['device', 'metric', 'resolution', 'bucket', 'count', 'min', 'max', 'sum', 'last', 'last_time']
+
+
+def merge_sql(rows):
+    """
+    Один INSERT ... ON CONFLICT DO UPDATE для пачки корзин: сохраненный агрегат сливается
+    с новым в самой БД, поэтому параллельные процессы приема не затирают значения друг друга
+    и не ждут общей блокировки
+    """
+    quote = connection.ops.quote_name
+    meta = IoTMetricRollup._meta
+    table = quote(meta.db_table)
+    columns = [quote(meta.get_field(name).column) for name in ROLLUP_FIELDS]
+    count, low, high, total, last, last_time = columns[4:]
+    # SQLite: скалярные MIN/MAX с несколькими аргументами; PostgreSQL: LEAST/GREATEST
+    least, greatest = ('LEAST', 'GREATEST') if connection.vendor == 'postgresql' else ('MIN', 'MAX')
+    placeholders = ', '.join(['(%s)' % ', '.join(['%s'] * len(columns))] * len(rows))
+    sql = (
+        f'INSERT INTO {table} ({", ".join(columns)}) VALUES {placeholders} '
+        f'ON CONFLICT ({", ".join(columns[:4])}) DO UPDATE SET '
+        f'{count} = {table}.{count} + EXCLUDED.{count}, '
+        f'{low} = {least}({table}.{low}, EXCLUDED.{low}), '
+        f'{high} = {greatest}({table}.{high}, EXCLUDED.{high}), '
+        f'{total} = {table}.{total} + EXCLUDED.{total}, '
+        f'{last} = CASE WHEN EXCLUDED.{last_time} >= {table}.{last_time} '
+        f'THEN EXCLUDED.{last} ELSE {table}.{last} END, '
+        f'{last_time} = {greatest}({table}.{last_time}, EXCLUDED.{last_time})'
+    )
+    adapt = connection.ops.adapt_datetimefield_value
+    params = []
+    for (device_id, metric, resolution, bucket), (count, low, high, total, last, last_time) in rows:
+        params += [device_id, metric, resolution, adapt(bucket), count, low, high, total, last, adapt(last_time)]
+    return sql, params
+
+
+class RollupAggregator:
+    """
+    Инкрементальное обновление IoTMetricRollup.
+
+    Сообщения пачки сначала сворачиваются в памяти, затем все затронутые корзины
+    (устройство, показатель, разрешение, интервал) сливаются с сохраненными агрегатами
+    одним upsert на пачку: счетчик и сумма складываются, минимум и максимум выбираются в БД.
+    """
+
+    def __init__(self):
+        self._pending = {}
+
+    def add(self, device_id, received_at, payload):
+        for metric, value in extract_metrics(payload).items():
+            for resolution in RESOLUTION_STEPS:
+                key = (device_id, metric, resolution, truncate(received_at, resolution))
+                current = self._pending.get(key)
+                if current is None:
+                    self._pending[key] = [1, value, value, value, value, received_at]
+                    continue
+                current[0] += 1
+                current[1] = min(current[1], value)
+                current[2] = max(current[2], value)
+                current[3] += value
+                if received_at >= current[5]:
+                    current[4] = value
+                    current[5] = received_at
+
+    def flush(self):
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        rows = list(pending.items())
+        # SQLite ограничивает число параметров запроса
+        batch_size = connection.ops.bulk_batch_size(ROLLUP_FIELDS, rows) or len(rows)
+        batch_size = min(batch_size, 500)
+        with connection.cursor() as cursor:
+            for start in range(0, len(rows), batch_size):
+                cursor.execute(*merge_sql(rows[start:start + batch_size]))
+        return len(pending)
+
+
+def choose_resolution(start, end, max_points):
+    """ Самое детальное разрешение, при котором интервал укладывается в max_points точек """
+    for resolution, step in RESOLUTION_STEPS.items():
+        if (end - start) / step <= max_points:
+            return resolution
+    return 'day'
+
+
+def metric_series(device, metric, start, end, max_points=500):
+    """ Ряд агрегатов показателя устройства за интервал [start, end) """
+    resolution = choose_resolution(start, end, max_points)
+    rows = IoTMetricRollup.objects.filter(
+        device=device,
+        metric=metric,
+        resolution=resolution,
+        bucket__gte=truncate(start, resolution),
+        bucket__lt=end,
+    ).order_by('bucket')
+    return resolution, [
+        {
+            'bucket': row.bucket,
+            'count': row.count,
+            'min': row.min,
+            'max': row.max,
+            'mean': row.mean,
+            'last': row.last,
+        }
+        for row in rows
+    ]
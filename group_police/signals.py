@@ -1,42 +1,214 @@
-from django.db.models.signals import post_save, pre_delete, m2m_changed
-from django.contrib.auth.models import User
+import logging
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from functools import partial
+
+from django.db import transaction
+from django.db.models.signals import post_save, pre_delete, m2m_changed, post_delete
+from django.contrib.auth.models import User, Group
 from django.dispatch import receiver
-from .models import IoTUser, UserLog, IoTDevice, IoTDeviceLog
+from .audit import audit_log
+from . import visibility
+from .decision import decision_point
+from .hosts import host_policies
+from .permissions import permission_cache
+from .models import IoTUser, UserLog, IoTDevice, IoTDeviceLog, AccessPolicy, IoTGroup, RBACPolicy
+
+logger = logging.getLogger(__name__)
+
+
+_state = threading.local()
+
+
+class _PendingRecords:
+    """ Записи журнала текущей транзакции: (модель, pk, действие) -> последняя запись """
+
+    def __init__(self):
+        self.records = {}
+
+    def commit(self, key):
+        # Транзакция зафиксирована: следующие события начнут новый набор
+        if getattr(_state, 'pending', None) is self:
+            _state.pending = None
+        record = self.records.pop(key, None)
+        if record is not None:
+            audit_log.write(record)
+
+
+def _record(instance, action, record):
+    """
+    Запись журнала по сигналу откладывается до фиксации транзакции: повторные события
+    одного объекта с тем же действием схлопываются в одну запись. Callback on_commit
+    регистрируется на каждое событие - Django отбрасывает callback'и откаченной точки
+    сохранения, поэтому записи только откаченных изменений не пишутся. Внутри bulk_import
+    событие только учитывается в сводке.
+    """
+    summary = getattr(_state, 'bulk_summary', None)
+    if summary is not None:
+        summary[(instance._meta.verbose_name_plural, action)] += 1
+        return
+    if not transaction.get_connection().in_atomic_block:
+        _state.pending = None
+        audit_log.write(record)
+        return
+    pending = getattr(_state, 'pending', None)
+    if pending is None:
+        pending = _state.pending = _PendingRecords()
+    key = (instance._meta.label, instance.pk, action)
+    pending.records[key] = record
+    transaction.on_commit(partial(pending.commit, key))
+
+
+@contextmanager
+def bulk_import(user=None, description='Массовый импорт'):
+    """
+    Массовая загрузка устройств или пользователей: вместо записи журнала на каждый объект
+    по выходу пишется одна сводка в лог, а при указании user - и одна запись UserLog.
+    """
+    if getattr(_state, 'bulk_summary', None) is not None:
+        # Вложенный импорт учитывается во внешней сводке
+        yield _state.bulk_summary
+        return
+    summary = _state.bulk_summary = Counter()
+    try:
+        yield summary
+    finally:
+        _state.bulk_summary = None
+    if not summary:
+        return
+    details = ', '.join(f'{name} {action}: {count}' for (name, action), count in sorted(summary.items()))
+    logger.info('%s: %s', description, details)
+    if user is not None:
+        transaction.on_commit(lambda: audit_log.write(UserLog(
+            status='bulk import',
+            user=user,
+            description=f'{description} пользователем [{user.username}]: {details}'
+        )))
 
 
 @receiver(post_save, sender=IoTUser)
 def log_create_user_profile(sender, instance, created, **kwargs):
     if created:
-        UserLog.objects.create(
+        _record(instance, 'created', UserLog(
             status='created',
             user=instance,
             description=f'Пользователь с именем [{instance.username}] был успешно создан'
-        )
+        ))
 
 
 @receiver(post_save, sender=IoTDevice)
 def log_create_device(sender, instance, created, **kwargs):
     if created:
-        IoTDeviceLog.objects.create(
+        _record(instance, 'created', IoTDeviceLog(
             status='created',
             device=instance,
             description=f'Устройство с идентификатором [{instance.device_name}] было добавлено в систему'
-        )
+        ))
 
 
 @receiver(pre_delete, sender=IoTUser)
 def log_user_deletion(sender, instance, **kwargs):
-    UserLog.objects.create(
+    _record(instance, 'deleted', UserLog(
         status='deleted',
         user=instance,
         description=f'Пользователь с именем [{instance.username}] был удален'
-    )
+    ))
 
 
-@receiver(m2m_changed, sender=IoTUser)
-def log_user_group_changed(sender, instance, **kwargs):
-    UserLog.objects.create(
-        status='changed',
-        user=instance,
-        description=f'Пользователь с именем [{instance.username}] был удален'
-    )
+@receiver(m2m_changed, sender=IoTUser.groups.through)
+@receiver(m2m_changed, sender=IoTUser.roles.through)
+def log_user_group_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith('post_'):
+        return
+    if reverse:
+        # Изменен состав группы: запись для каждого затронутого пользователя
+        users = IoTUser.objects.filter(pk__in=pk_set).only('username') if pk_set else ()
+    else:
+        users = (instance,)
+    for user in users:
+        _record(user, 'changed', UserLog(
+            status='changed',
+            user=user,
+            description=f'У пользователя с именем [{user.username}] были изменены группы или роли'
+        ))
+
+
+@receiver(post_save, sender=AccessPolicy)
+@receiver(post_delete, sender=AccessPolicy)
+def invalidate_access_policies(sender, **kwargs):
+    decision_point.invalidate()
+
+
+@receiver(post_save, sender=Group)
+@receiver(post_delete, sender=Group)
+def invalidate_roles(sender, **kwargs):
+    # Имена групп - это и роли в политиках, и источник прав пользователей
+    decision_point.invalidate()
+    permission_cache.clear()
+
+
+@receiver(m2m_changed, sender=AccessPolicy.allowed_roles.through)
+@receiver(m2m_changed, sender=AccessPolicy.allowed_groups.through)
+def invalidate_access_policy_relations(sender, action, **kwargs):
+    if action.startswith('post_'):
+        decision_point.invalidate()
+
+
+@receiver(m2m_changed, sender=IoTUser.roles.through)
+@receiver(m2m_changed, sender=IoTUser.groups.through)
+def invalidate_user_permissions(sender, instance, action, reverse, **kwargs):
+    if not action.startswith('post_'):
+        return
+    if reverse:
+        # Изменился состав группы, затронуты все её пользователи
+        permission_cache.clear()
+    else:
+        permission_cache.invalidate(instance.pk)
+
+
+@receiver(m2m_changed, sender=Group.permissions.through)
+def invalidate_group_permissions(sender, action, **kwargs):
+    if action.startswith('post_'):
+        permission_cache.clear()
+
+
+@receiver(post_delete, sender=IoTUser)
+def forget_user_permissions(sender, instance, **kwargs):
+    permission_cache.invalidate(instance.pk)
+
+
+@receiver(m2m_changed, sender=IoTUser.allowed_iot_groups.through)
+def invalidate_user_visible_devices(sender, instance, action, reverse, **kwargs):
+    if not action.startswith('post_'):
+        return
+    if reverse:
+        visibility.invalidate_all()
+        permission_cache.clear()
+    else:
+        visibility.invalidate_user(instance.pk)
+        permission_cache.invalidate(instance.pk)
+
+
+@receiver(m2m_changed, sender=IoTDevice.groups.through)
+def invalidate_device_groups(sender, action, **kwargs):
+    if action.startswith('post_'):
+        visibility.invalidate_all()
+
+
+@receiver(post_delete, sender=IoTDevice)
+@receiver(post_delete, sender=IoTGroup)
+def invalidate_visible_devices(sender, **kwargs):
+    visibility.invalidate_all()
+
+
+@receiver(post_save, sender=RBACPolicy)
+@receiver(post_delete, sender=RBACPolicy)
+def invalidate_host_policies(sender, **kwargs):
+    host_policies.invalidate()
+
+
+@receiver(m2m_changed, sender=RBACPolicy.iot_groups.through)
+def invalidate_host_policy_groups(sender, action, **kwargs):
+    if action.startswith('post_'):
+        host_policies.invalidate()
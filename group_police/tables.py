@@ -2,6 +2,8 @@ import django_tables2 as tables
 from django.urls import reverse
 from django.utils.html import format_html
 
+from mqtt_broker.last_seen import last_seen_tracker
+
 
 class DeviceTable(tables.Table):
     id = tables.Column(
@@ -15,7 +17,7 @@ class DeviceTable(tables.Table):
         }
     )
     device_name = tables.Column(
-        orderable=False,
+        orderable=True,
         verbose_name='Имя устройства',
         attrs={
             'td': {
@@ -35,7 +37,7 @@ class DeviceTable(tables.Table):
         }
     )
     last_seen = tables.Column(
-        orderable=False,
+        orderable=True,
         verbose_name='Последняя активность',
         attrs={
             'td': {
@@ -45,10 +47,23 @@ class DeviceTable(tables.Table):
         }
     )
 
+    def before_render(self, request):
+        # Более свежее время активности, чем записанное в БД, берем у трекера приема сообщений
+        rows = self.page.object_list if hasattr(self, 'page') else self.rows
+        self.fresh_last_seen = last_seen_tracker.get_many([row.record['id'] for row in rows])
+
+    def render_last_seen(self, value, record):
+        fresh = getattr(self, 'fresh_last_seen', {}).get(record['id'])
+        if fresh is not None and fresh > value:
+            return fresh
+        return value
+
     def render_device_name(self, record):
         link = reverse('device', kwargs={"pk": record['id']})
         record_link = f'<div><a href="{link}">' + record["device_name"] + '</a></div>'
         return format_html(record_link)
 
     class Meta:
-        template_name = "django_tables2/bootstrap5.html"
\ No newline at end of file
+        template_name = "django_tables2/bootstrap5.html"
+        # Сортировка только по проиндексированным полям
+        order_by = ('-last_seen',)
\ No newline at end of file
@@ -1,7 +1,41 @@
 import pytest
 from unittest.mock import Mock, patch, call
+import gzip
 import json
-from iot_device import IoTDevice  # Замените на ваш модуль
+import tempfile
+import time
+from unittest import skipUnless
+from datetime import timedelta
+
+import jwt
+from django.contrib.auth.models import Group, Permission
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection, DatabaseError, transaction
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from group_police.audit import AuditLogWriter, audit_log
+from group_police.checks import check_shared_cache
+from group_police.benchmark import BenchmarkResult, SeedSize, compare, run_benchmarks
+from group_police.compression import storage_fields
+from group_police.decision import decision_point
+from group_police.hosts import host_policies, parse_hosts
+from group_police.index_advisor import HotQuery, advise, analyse_plan
+from group_police.instrumentation import QueryInstrumentationMiddleware, request_metrics, track_queries
+from group_police.jwt_token import TokenVerifier, create_access_token, create_refresh_token, refresh_tokens
+from group_police.models import AccessPolicy, IoTDeviceLog, IoTGroup, IoTMessage, IoTUser, RBACPolicy, UserLog, \
+    UserToDeviceLog
+from group_police.pagination import message_page
+from group_police.permissions import permission_cache
+from group_police.retention import RetentionPolicy, prune
+from group_police.signals import bulk_import
+from group_police.visibility import visible_device_ids
+from group_police.rollups import RollupAggregator, choose_resolution, extract_metrics, metric_series
+from group_police.models import IoTDevice as IoTDeviceModel
+from mqtt_broker.devices import IoTDevice
+from mqtt_broker.live import message_hub
 
 
 class TestIoTDevice:
@@ -122,5 +156,514 @@ class TestIoTDevice:
         assert "Invalid JSON received" in caplog.text
 
 
+@override_settings(AUDIT_LOG_ASYNC=False)
+class PolicyDecisionPointTest(TestCase):
+    def setUp(self):
+        decision_point.invalidate()
+        self.operator = Group.objects.create(name='operator')
+        self.user = IoTUser.objects.create(username='user', attributes={'level': 2})
+        self.user.roles.add(self.operator)
+        self.device = IoTDeviceModel.objects.create(device_name='sensor', uid='sensor-1')
+        self.policy = AccessPolicy.objects.create(name='operators', conditions={'level': 2})
+        self.policy.allowed_roles.add(self.operator)
+
+    def test_allowed_by_role_and_attributes(self):
+        self.assertTrue(decision_point.check_access(self.user, self.device))
+        self.assertEqual(UserToDeviceLog.objects.get().status, 'Разрешено')
+
+    def test_denied_by_context(self):
+        self.assertFalse(decision_point.check_access(self.user, self.device, {'level': 3}))
+        self.assertIn('Несоответствие контекста', UserToDeviceLog.objects.get().description)
+
+    def test_denials_logged_until_first_allowing_policy(self):
+        AccessPolicy.objects.filter(pk=self.policy.pk).update(name='admins')
+        self.policy.allowed_roles.clear()
+        allowing = AccessPolicy.objects.create(name='operators')
+        allowing.allowed_roles.add(self.operator)
+        self.assertTrue(decision_point.check_access(self.user, self.device))
+        self.assertEqual(
+            list(UserToDeviceLog.objects.order_by('pk').values_list('status', flat=True)),
+            ['Отказано', 'Разрешено'],
+        )
+
+    def test_warm_decision_does_not_query_policies(self):
+        decision_point.check_access(self.user, self.device)
+        with self.assertNumQueries(1):  # только запись в журнал
+            decision_point.check_access(self.user, self.device)
+
+    def test_index_invalidated_on_role_change(self):
+        decision_point.check_access(self.user, self.device)
+        self.user.roles.remove(self.operator)
+        self.assertFalse(decision_point.check_access(self.user, self.device))
+
+
+@override_settings(AUDIT_LOG_ASYNC=False)
+class AuditLogWriterTest(TestCase):
+    def setUp(self):
+        self.user = IoTUser.objects.create(username='user')
+        self.device = IoTDeviceModel.objects.create(device_name='sensor', uid='sensor-1')
+        self.writer = AuditLogWriter(background=False)
+
+    def test_records_buffered_until_flush(self):
+        with override_settings(AUDIT_LOG_ASYNC=True):
+            for i in range(10):
+                self.writer.write(UserToDeviceLog(status='Разрешено', user=self.user, device=self.device,
+                                                  description=str(i)))
+            self.writer.write(UserLog(status='changed', user=self.user, description='changed'))
+        self.assertFalse(UserToDeviceLog.objects.exists())
+        with self.assertNumQueries(2):  # по одному bulk_create на модель
+            self.assertEqual(self.writer.flush(), 11)
+        self.assertEqual(UserToDeviceLog.objects.count(), 10)
+
+
+@override_settings(AUDIT_LOG_ASYNC=False)
+class MessagePaginationTest(TestCase):
+    def setUp(self):
+        self.device = IoTDeviceModel.objects.create(device_name='sensor', uid='sensor-1')
+        now = timezone.now()
+        # Часть сообщений с одинаковым временем: порядок внутри них задает id
+        IoTMessage.objects.bulk_create(
+            IoTMessage(device=self.device, topic='devices/sensor-1/data', msg=str(i), receive_time=now.replace(second=i // 3))
+            for i in range(25)
+        )
+
+    def test_pages_cover_history_newest_first(self):
+        seen = []
+        cursor = None
+        while True:
+            page, cursor = message_page(self.device, cursor, limit=10)
+            seen.extend(page)
+            if cursor is None:
+                break
+        self.assertEqual(len(seen), 25)
+        keys = [(msg.receive_time, msg.id) for msg in seen]
+        self.assertEqual(keys, sorted(keys, reverse=True))
+
+    def test_malformed_cursor_rejected(self):
+        for cursor in ('abc', '1_x', f'{10 ** 30}_1', '-1_1', f'1_{2 ** 64}'):
+            with self.assertRaises(ValueError):
+                message_page(self.device, cursor)
+
+    def test_json_endpoint(self):
+        role = Group.objects.create(name='operator')
+        role.permissions.add(Permission.objects.get(name='can view device information'))
+        user = IoTUser.objects.create(username='user')
+        user.roles.add(role)
+        user.groups.add(role)
+        AccessPolicy.objects.create(name='operators').allowed_roles.add(role)
+        self.client.force_login(user)
+        url = reverse('device_messages', kwargs={'pk': self.device.pk})
+        first = self.client.get(url).json()
+        self.assertEqual(len(first['messages']), 25)
+        self.assertIsNone(first['next'])
+        self.assertEqual(self.client.get(url, {'before': 'bad'}).status_code, 400)
+
+
+@override_settings(AUDIT_LOG_ASYNC=False)
+class RollupTest(TestCase):
+    def setUp(self):
+        self.device = IoTDeviceModel.objects.create(device_name='sensor', uid='sensor-1')
+        self.start = timezone.now().replace(hour=10, minute=0, second=0, microsecond=0)
+
+    def test_incremental_aggregates(self):
+        aggregator = RollupAggregator()
+        for i, temperature in enumerate([20, 22, 24]):
+            aggregator.add(self.device.id, self.start + timedelta(seconds=i),
+                           json.dumps({'temperature': temperature, 'device_id': 'sensor-1', 'sent_at': 1.0}))
+        aggregator.flush()
+        aggregator.add(self.device.id, self.start + timedelta(seconds=30), json.dumps({'temperature': 18}))
+        aggregator.flush()
+        resolution, series = metric_series(self.device, 'temperature', self.start, self.start + timedelta(hours=1))
+        self.assertEqual(resolution, 'minute')
+        self.assertEqual(series[0]['count'], 4)
+        self.assertEqual((series[0]['min'], series[0]['max'], series[0]['last']), (18, 24, 18))
+        self.assertEqual(series[0]['mean'], 21)
+        self.assertEqual(metric_series(self.device, 'sent_at', self.start, self.start + timedelta(hours=1))[1], [])
+
+    def test_merged_in_single_upsert(self):
+        aggregator = RollupAggregator()
+        aggregator.add(self.device.id, self.start + timedelta(seconds=20), {'temperature': 30})
+        aggregator.flush()
+        # Более раннее сообщение, записанное позже, не меняет последнее значение
+        aggregator.add(self.device.id, self.start + timedelta(seconds=10), {'temperature': 10})
+        with CaptureQueriesContext(connection) as queries:
+            aggregator.flush()
+        self.assertEqual(len(queries), 1)
+        series = metric_series(self.device, 'temperature', self.start, self.start + timedelta(hours=1))[1]
+        self.assertEqual((series[0]['count'], series[0]['min'], series[0]['max'], series[0]['last']), (2, 10, 30, 30))
+
+    def test_invalid_values_are_skipped(self):
+        payload = '{"temperature": NaN, "humidity": Infinity, "counter": %s, "%s": 1, "pressure": 1000}' % (
+            '9' * 400, 'x' * 65)
+        self.assertEqual(extract_metrics(payload), {'pressure': 1000.0})
+        aggregator = RollupAggregator()
+        aggregator.add(self.device.id, self.start, payload)
+        self.assertEqual(aggregator.flush(), 3)
+
+    def test_resolution_fits_point_budget(self):
+        self.assertEqual(choose_resolution(self.start, self.start + timedelta(hours=6), 500), 'minute')
+        self.assertEqual(choose_resolution(self.start, self.start + timedelta(days=7), 500), 'hour')
+        self.assertEqual(choose_resolution(self.start, self.start + timedelta(days=365), 500), 'day')
+
+
+@override_settings(AUDIT_LOG_ASYNC=False)
+class RetentionTest(TestCase):
+    def test_prune_in_chunks_with_archive(self):
+        device = IoTDeviceModel.objects.create(device_name='sensor', uid='sensor-1', device_type='temperature_sensor')
+        now = timezone.now()
+        IoTMessage.objects.bulk_create(
+            IoTMessage(device=device, topic='devices/sensor-1/data', msg=str(i), receive_time=now - timedelta(days=i))
+            for i in range(9)
+        )
+        # Сжатое сообщение попадает в архив распакованным
+        msg, body = storage_fields('9' * 100)
+        IoTMessage.objects.create(device=device, topic='devices/sensor-1/data', msg=msg, body=body,
+                                  receive_time=now - timedelta(days=9))
+        policy = RetentionPolicy('group_police.IoTMessage', 'receive_time', days=3, archive=True,
+                                 filter={'device__device_type': 'temperature_sensor'})
+        with tempfile.TemporaryDirectory() as directory, override_settings(RETENTION_ARCHIVE_DIR=directory):
+            result = prune(policy, chunk_size=3, pause=0, now=now)
+            with gzip.open(result.archive, 'rt') as archive:
+                archived = [json.loads(line)['msg'] for line in archive]
+        self.assertEqual((result.rows, result.chunks), (6, 2))
+        self.assertEqual(sorted(archived), [str(i) for i in range(4, 9)] + ['9' * 100])
+        self.assertEqual(IoTMessage.objects.count(), 4)
+
+
+@override_settings(AUDIT_LOG_ASYNC=False, DEVICE_LIST_PAGE_SIZE=2)
+class DeviceListTest(TestCase):
+    def setUp(self):
+        self.groups = [IoTGroup.objects.create(name=f'group-{i}', description='') for i in range(3)]
+        self.devices = [IoTDeviceModel.objects.create(device_name=f'sensor-{i}', uid=f'sensor-{i}') for i in range(3)]
+        for device in self.devices:
+            device.groups.set(self.groups)
+        self.user = IoTUser.objects.create(username='user')
+        self.user.allowed_iot_groups.set(self.groups[:2])
+        role = Group.objects.create(name='operator')
+        self.user.roles.add(role)
+        self.policy = AccessPolicy.objects.create(name='operators')
+        self.policy.allowed_roles.add(role)
+        self.client.force_login(self.user)
+
+    def test_devices_listed_once_and_paginated(self):
+        response = self.client.get(reverse('device_list'))
+        table = response.context['table']
+        self.assertEqual(table.paginator.count, 3)
+        self.assertEqual(len(table.page.object_list), 2)
+        page_two = self.client.get(reverse('device_list'), {'page': 2}).context['table']
+        ids = [row.record['id'] for row in table.page.object_list] + \
+              [row.record['id'] for row in page_two.page.object_list]
+        self.assertEqual(sorted(ids), [device.id for device in self.devices])
+
+    def test_devices_hidden_when_policy_denies(self):
+        self.policy.allowed_roles.clear()
+        UserLog.objects.all().delete()
+        response = self.client.get(reverse('device_list'))
+        self.assertEqual(response.context['table'].paginator.count, 0)
+        self.assertEqual(UserLog.objects.get().status, 'Отказано')
+
+    def test_batch_evaluation_writes_one_record(self):
+        UserLog.objects.all().delete()
+        ids = {device.id for device in self.devices}
+        self.assertEqual(decision_point.allowed_devices(self.user, IoTDeviceModel.objects.all()), ids)
+        self.assertEqual(decision_point.allowed_devices(self.user, list(ids)[:2]), set(list(ids)[:2]))
+        self.assertEqual(UserLog.objects.count(), 2)
+        self.assertFalse(UserToDeviceLog.objects.exists())
+
+    def test_allowed_list_logged_once_per_session(self):
+        UserLog.objects.all().delete()
+        self.client.get(reverse('device_list'))
+        self.client.get(reverse('device_list'), {'page': 2})
+        self.assertEqual(UserLog.objects.get().status, 'Разрешено')
+        self.assertFalse(UserToDeviceLog.objects.exists())
+
+    def test_process_local_cache_rejected_for_deploy(self):
+        self.assertEqual([error.id for error in check_shared_cache(None)], ['group_police.E001'])
+        shared = {'default': {'BACKEND': 'django.core.cache.backends.db.DatabaseCache', 'LOCATION': 'cache'}}
+        with self.settings(CACHES=shared):
+            self.assertEqual(check_shared_cache(None), [])
+
+    def test_visible_ids_invalidated_on_membership_change(self):
+        self.assertEqual(len(visible_device_ids(self.user)), 3)
+        self.devices[0].groups.clear()
+        self.assertEqual(len(visible_device_ids(self.user)), 2)
+        self.user.allowed_iot_groups.clear()
+        self.assertEqual(visible_device_ids(self.user), frozenset())
+
+
+@override_settings(AUDIT_LOG_ASYNC=False, LIVE_STREAM_HEARTBEAT=0.1, LIVE_STREAM_MAX_AGE=0.5)
+class DeviceStreamTest(TestCase):
+    def setUp(self):
+        self.device = IoTDeviceModel.objects.create(device_name='sensor', uid='sensor-1')
+        self.user = IoTUser.objects.create(username='user')
+        role = Group.objects.create(name='operator')
+        role.permissions.add(Permission.objects.get(name='can view device information'))
+        self.user.roles.add(role)
+        self.user.groups.add(role)
+        AccessPolicy.objects.create(name='operators').allowed_roles.add(role)
+        self.async_client.force_login(self.user)
+
+    async def test_new_messages_pushed_to_stream(self):
+        with patch.object(message_hub, 'start'):
+            response = await self.async_client.get(reverse('device_stream', kwargs={'pk': self.device.pk}))
+            self.assertEqual(response['Content-Type'], 'text/event-stream')
+            stream = aiter(response.streaming_content)
+            self.assertTrue((await anext(stream)).startswith(b'retry:'))
+            self.assertEqual(message_hub.subscriber_count('sensor-1'), 1)
+            message_hub.publish('sensor-1', {'topic': 'devices/sensor-1/data', 'msg': '{"t": 1}',
+                                             'receive_time': timezone.now()})
+            event = (await anext(stream)).decode()
+            self.assertTrue(event.startswith('event: message'))
+            self.assertEqual(json.loads(event.split('data: ', 1)[1])['msg'], '{"t": 1}')
+            rest = [chunk async for chunk in stream]
+        self.assertIn(b': keepalive\n\n', rest)
+        self.assertEqual(message_hub.subscriber_count(), 0)
+
+    async def test_anonymous_denied(self):
+        self.async_client.cookies.clear()
+        response = await self.async_client.get(reverse('device_stream', kwargs={'pk': self.device.pk}))
+        self.assertEqual(response.status_code, 403)
+
+    def test_send_to_device_is_queued(self):
+        self.client.force_login(self.user)
+        data = {'device': 'sensor-1', 'device_message': 'reboot'}
+        self.assertEqual(self.client.post(reverse('send_to_device'), data).status_code, 403)
+        Group.objects.get(name='operator').permissions.add(Permission.objects.get(name='can send device information'))
+        with patch('group_police.views.command_dispatcher') as dispatcher:
+            response = self.client.post(reverse('send_to_device'), data, HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, 202)
+        dispatcher.send.assert_called_once_with(self.user, self.device, 'reboot')
+        response = self.client.post(reverse('send_to_device'), {'device': 'missing', 'device_message': 'reboot'})
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(AUDIT_LOG_ASYNC=False)
+class PermissionCacheTest(TestCase):
+    def setUp(self):
+        permission_cache.clear()
+        self.role = Group.objects.create(name='operator')
+        self.user = IoTUser.objects.create(username='user')
+        self.user.groups.add(self.role)
+        self.user.roles.add(self.role)
+
+    def test_loaded_once_and_invalidated_by_signals(self):
+        self.assertEqual(permission_cache.get(self.user).roles, {'operator'})
+        with self.assertNumQueries(0):
+            self.assertNotIn('can view device information', permission_cache.get(self.user))
+        self.role.permissions.add(Permission.objects.get(name='can view device information'))
+        self.assertIn('can view device information', permission_cache.get(self.user))
+
+    def test_request_attribute(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('device_list'))
+        self.assertEqual(response.wsgi_request.effective_permissions.roles, {'operator'})
+
+
+class HostPolicyTest(TestCase):
+    def setUp(self):
+        host_policies.invalidate()
+        self.group = IoTGroup.objects.create(name='sensors', description='')
+        self.other = IoTGroup.objects.create(name='cameras', description='')
+        allow = RBACPolicy.objects.create(name='lan', description='', action='A', hosts='10.0.0.0/8, 2001:db8::/32',
+                                          redirect_hosts='')
+        drop = RBACPolicy.objects.create(name='guest', description='', action='D', hosts='10.1.0.0/16\n10.2.3.4',
+                                         redirect_hosts='')
+        for policy in (allow, drop):
+            policy.iot_groups.add(self.group)
+
+    def test_parse_skips_invalid_tokens(self):
+        self.assertEqual([str(n) for n in parse_hosts('10.0.0.1; bad, 192.168.0.0/24')],
+                         ['10.0.0.1/32', '192.168.0.0/24'])
+
+    def test_longest_prefix_wins(self):
+        self.assertEqual(host_policies.match('10.9.9.9', [self.group.id]).action, 'A')
+        self.assertEqual(host_policies.match('10.1.2.3', [self.group.id]).action, 'D')
+        self.assertEqual(host_policies.match('10.2.3.4', [self.group.id]).policy_name, 'guest')
+        self.assertEqual(host_policies.match('2001:db8::1', [self.group.id]).action, 'A')
+        self.assertIsNone(host_policies.match('192.168.1.1', [self.group.id]))
+        self.assertIsNone(host_policies.match('10.1.2.3', [self.other.id]))
+
+    def test_rebuilt_on_policy_change(self):
+        host_policies.match('10.9.9.9', [self.group.id])
+        RBACPolicy.objects.get(name='lan').iot_groups.clear()
+        self.assertIsNone(host_policies.match('10.9.9.9', [self.group.id]))
+
+    def test_hosts_parsed_once_per_policy(self):
+        RBACPolicy.objects.get(name='lan').iot_groups.add(self.other)
+        with patch('group_police.hosts.parse_hosts', wraps=parse_hosts) as parse:
+            self.assertEqual(host_policies.match('10.9.9.9', [self.other.id]).action, 'A')
+        # hosts и redirect_hosts двух политик, независимо от числа их групп
+        self.assertEqual(parse.call_count, 4)
+
+
+@override_settings(JWT_SIGNING_KEYS={'k1': 'old-secret'}, JWT_ACTIVE_KEY_ID='k1')
+class TokenVerifierTest(TestCase):
+    def setUp(self):
+        self.verifier = TokenVerifier()
+
+    def test_cached_until_revoked(self):
+        token = create_access_token(7)
+        claims = self.verifier.verify(token)
+        self.assertEqual(claims['user_id'], 7)
+        with patch('jwt.decode') as decode:
+            self.assertEqual(self.verifier.verify(token), claims)
+        decode.assert_not_called()
+        self.verifier.revoke(claims['jti'])
+        with self.assertRaises(jwt.InvalidTokenError):
+            self.verifier.verify(token)
+
+    def test_revoked_ids_pruned_after_expiry(self):
+        self.verifier.revoke('expired', exp=time.time() - 1)
+        self.verifier.revoke('active', exp=time.time() + 60)
+        self.verifier.revoke('default')
+        self.assertEqual(set(self.verifier._revoked), {'active', 'default'})
+
+    def test_key_rotation_keeps_issued_tokens(self):
+        old_token = create_access_token(1)
+        with self.settings(JWT_SIGNING_KEYS={'k1': 'old-secret', 'k2': 'new-secret'}, JWT_ACTIVE_KEY_ID='k2'):
+            new_token = create_access_token(2)
+            self.assertEqual(jwt.get_unverified_header(new_token)['kid'], 'k2')
+            self.assertEqual(self.verifier.verify(old_token)['user_id'], 1)
+            self.assertEqual(self.verifier.verify(new_token)['user_id'], 2)
+        with self.settings(JWT_SIGNING_KEYS={'k2': 'new-secret'}, JWT_ACTIVE_KEY_ID='k2'):
+            with self.assertRaises(jwt.InvalidTokenError):
+                self.verifier.verify(old_token)
+
+    def test_expired_and_forged_rejected(self):
+        expired = jwt.encode({'user_id': 1, 'exp': timezone.now() - timedelta(seconds=1)}, 'old-secret',
+                             headers={'kid': 'k1'})
+        forged = jwt.encode({'user_id': 1}, 'other-secret', headers={'kid': 'k1'})
+        with self.assertRaises(jwt.ExpiredSignatureError):
+            self.verifier.verify(expired)
+        with self.assertRaises(jwt.InvalidSignatureError):
+            self.verifier.verify(forged)
+
+    def test_refresh_tokens(self):
+        access = refresh_tokens(create_refresh_token(5))
+        self.assertEqual(self.verifier.verify(access)['user_id'], 5)
+
+
+@override_settings(AUDIT_LOG_ASYNC=False)
+class SignalLogTest(TestCase):
+    def test_transaction_events_coalesced(self):
+        role = Group.objects.create(name='operator')
+        # Записи транзакции уходят в очередь журнала подряд и сохраняются одной пачкой
+        with self.settings(AUDIT_LOG_ASYNC=True), patch.object(audit_log, 'background', False):
+            with self.captureOnCommitCallbacks(execute=True):
+                user = IoTUser.objects.create(username='user')
+                user.roles.add(role)
+                user.roles.remove(role)
+                user.groups.add(role)
+            with CaptureQueriesContext(connection) as queries:
+                audit_log.flush()
+        self.assertEqual(sorted(UserLog.objects.values_list('status', flat=True)), ['changed', 'created'])
+        inserts = [query for query in queries if query['sql'].startswith('INSERT INTO "group_police_userlog"')]
+        self.assertEqual(len(inserts), 1)
+
+    def test_reverse_group_change_logged_per_user(self):
+        role = Group.objects.create(name='operator')
+        users = [IoTUser.objects.create(username=f'user-{i}') for i in range(3)]
+        with self.captureOnCommitCallbacks(execute=True):
+            role.iot_users.add(*users)
+        self.assertEqual(UserLog.objects.filter(status='changed').count(), 3)
+
+    def test_rolled_back_savepoint_not_logged(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                IoTUser.objects.create(username='kept')
+                try:
+                    with transaction.atomic():
+                        IoTUser.objects.create(username='discarded')
+                        raise DatabaseError('rollback')
+                except DatabaseError:
+                    pass
+        self.assertEqual(list(UserLog.objects.values_list('description', flat=True)),
+                         ['Пользователь с именем [kept] был успешно создан'])
+
+    def test_bulk_import_writes_summary(self):
+        admin = IoTUser.objects.create(username='admin')
+        with self.captureOnCommitCallbacks(execute=True):
+            with bulk_import(user=admin) as summary:
+                for i in range(50):
+                    IoTDeviceModel.objects.create(device_name=f'sensor-{i}', uid=f'sensor-{i}')
+        self.assertEqual(sum(summary.values()), 50)
+        self.assertFalse(IoTDeviceLog.objects.exists())
+        self.assertIn('50', UserLog.objects.get(status='bulk import').description)
+
+
+@override_settings(AUDIT_LOG_ASYNC=False)
+class BenchmarkTest(TestCase):
+    def test_harness_reports_latency_and_queries(self):
+        size = SeedSize(users=2, groups=2, policies=3, devices=5, messages=20)
+        with patch('paho.mqtt.client.Client'):
+            results = run_benchmarks(size, iterations=2)
+        self.assertEqual([result.name for result in results],
+                         ['device_list_view', 'device_view', 'check_access', 'ingestion_batch'])
+        for result in results:
+            self.assertGreater(result.queries, 0)
+            self.assertLessEqual(result.p50_ms, result.p99_ms)
+
+    def test_compare_flags_regressions(self):
+        baseline = {'results': [{'name': 'device_view', 'p99_ms': 10.0, 'queries': 5.0}]}
+        fast = BenchmarkResult('device_view', 10, 5.0, 11.0, 6.0, 5.0, 100.0)
+        slow = BenchmarkResult('device_view', 10, 5.0, 20.0, 6.0, 7.0, 100.0)
+        self.assertEqual(compare([fast], baseline, 0.2), [])
+        self.assertEqual(len(compare([slow], baseline, 0.2)), 2)
+
+
+@override_settings(AUDIT_LOG_ASYNC=False, REQUEST_METRICS_ENABLED=True)
+class InstrumentationTest(TestCase):
+    def setUp(self):
+        request_metrics.reset()
+        self.user = IoTUser.objects.create(username='user')
+        self.client.force_login(self.user)
+
+    def test_server_timing_and_histograms(self):
+        response = self.client.get(reverse('device_list'))
+        self.assertRegex(response['Server-Timing'], r'^db;dur=[\d.]+;desc="\d+ queries", ')
+        metrics = self.client.get(reverse('request_metrics')).json()['routes']['device_list']
+        self.assertEqual(metrics['view_ms']['count'], 1)
+        self.assertGreater(metrics['queries']['mean'], 0)
+        self.assertIsNotNone(metrics['slowest_sql'])
+
+    def test_metrics_endpoint_local_only(self):
+        response = self.client.get(reverse('request_metrics'), REMOTE_ADDR='10.0.0.5')
+        self.assertEqual(response.status_code, 403)
+
+    def test_track_queries_and_disabled_middleware(self):
+        with track_queries() as stats:
+            list(IoTUser.objects.all())
+        self.assertEqual(stats.count, 1)
+        with self.settings(REQUEST_METRICS_ENABLED=False):
+            with self.assertRaises(MiddlewareNotUsed):
+                QueryInstrumentationMiddleware(lambda request: None)
+
+
+class DatabaseSetupTest(TestCase):
+    @skipUnless(connection.vendor == 'sqlite', 'SQLite pragmas')
+    def test_sqlite_synchronous_normal(self):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA synchronous')
+            self.assertEqual(cursor.fetchone()[0], 1)
+
+
+class IndexAdvisorTest(TestCase):
+    def test_hot_queries_use_indexes(self):
+        bad = [result.query.name for result in advise() if not result.ok]
+        self.assertEqual(bad, [])
+
+    def test_reports_full_scan_and_sort(self):
+        query = HotQuery('unindexed', 'test', lambda: UserLog.objects.filter(description='x').order_by('at_time'))
+        result, = advise([query])
+        self.assertFalse(result.ok)
+        self.assertEqual(result.full_scans, ['group_police_userlog'])
+
+    def test_analyse_postgresql_plan(self):
+        plan = ('Limit  (cost=0.00..1.00 rows=1 width=8)\n'
+                '  ->  Sort  (cost=0.00..1.00 rows=1 width=8)\n'
+                '        ->  Seq Scan on group_police_userlog  (cost=0.00..1.00 rows=1 width=8)')
+        self.assertEqual(analyse_plan(plan, 'postgresql'), (['group_police_userlog'], 1))
+
+
 if __name__ == "__main__":
     pytest.main(["-v"])
\ No newline at end of file
@@ -1,11 +1,23 @@
+import asyncio
+import json
+import time
 from base64 import b64encode
+from datetime import timedelta
 from io import BytesIO
 from typing import Any
 
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.contrib.auth import user_logged_in, authenticate, login, logout
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.models import User
+from django.core.paginator import Paginator
 from django.db import IntegrityError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import JsonResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.functional import cached_property
+from django.utils.dateparse import parse_datetime
 from django.shortcuts import render, redirect
 from django.urls import reverse
 from django.views import View
@@ -14,9 +26,14 @@ import qrcode
 import qrcode.image.svg
 from django_tables2 import SingleTableView
 
+from group_police.decision import decision_point
 from group_police.models import IoTDevice, IoTUser, IoTMessage, AccessPolicy, UserToDeviceLog
+from group_police.pagination import message_page
+from group_police.rollups import metric_series
+from group_police.visibility import visible_device_ids, visible_devices
 from group_police.tables import DeviceTable
-# from mqtt_broker.devices import MQTT_LISTENER
+from mqtt_broker.dispatch import command_dispatcher
+from mqtt_broker.live import message_hub
 
 
 def create_user(request, **kwargs):
@@ -54,6 +71,20 @@ class RegisterView(View):
         return render(request, 'register.html', context=context)
 
 
+class KnownCountPaginator(Paginator):
+    """ Paginator, которому общее число строк известно заранее и не требует COUNT(*) """
+
+    def __init__(self, object_list, per_page, count=None, **kwargs):
+        super().__init__(object_list, per_page, **kwargs)
+        self.known_count = count
+
+    @cached_property
+    def count(self):
+        if self.known_count is None:
+            return super().count
+        return self.known_count
+
+
 class IoTDeviceListView(LoginRequiredMixin, SingleTableView):
     table_class = DeviceTable
     template_name = 'main_page.html'
@@ -62,10 +93,33 @@ class IoTDeviceListView(LoginRequiredMixin, SingleTableView):
     def dispatch(self, request, *args, **kwargs):
         return super().dispatch(request, *args, **kwargs)
 
+    def get_allowed_device_ids(self):
+        # Видимые по группам устройства, которые пользователь действительно может открыть
+        if not hasattr(self, 'allowed_device_ids'):
+            self.allowed_device_ids = decision_point.allowed_devices(
+                self.request.user,
+                visible_device_ids(self.request.user),
+                session=self.request.session,
+            )
+        return self.allowed_device_ids
+
+    def get_table_pagination(self, table):
+        return {
+            'per_page': settings.DEVICE_LIST_PAGE_SIZE,
+            'paginator_class': KnownCountPaginator,
+            'count': len(self.get_allowed_device_ids()),
+        }
+
     def get_queryset(self):
-        devices_qs = IoTDevice.objects.filter(
-            groups__in=self.request.user.allowed_iot_groups.all(),
-        ).values(
+        user = self.request.user
+        allowed_ids = self.get_allowed_device_ids()
+        if not allowed_ids:
+            devices_qs = IoTDevice.objects.none()
+        elif len(allowed_ids) == len(visible_device_ids(user)):
+            devices_qs = visible_devices(user)
+        else:
+            devices_qs = visible_devices(user).filter(id__in=allowed_ids)
+        devices_qs = devices_qs.values(
             'id',
             'device_name',
             'device_type',
@@ -83,41 +137,132 @@ class IoTDeviceView(LoginRequiredMixin, View):
     def get(self, request, *args, **kwargs):
         device = IoTDevice.objects.get(**kwargs)
         user = request.user
-        if any(policy.check_access(user, device) for policy in AccessPolicy.objects.all()):
-            permissions = user.groups.values_list('permissions__name', flat=True)
+        if decision_point.check_access(user, device):
+            permissions = request.effective_permissions.names
             context = {
                 'permissions': permissions,
                 'device': device,
-                'device_msg': IoTMessage.objects.filter(
-                    device=device,
-                ).order_by(
-                    'receive_time',
-                )
             }
+            if 'can view device information' in permissions:
+                try:
+                    context['device_msg'], context['next_cursor'] = message_page(device, request.GET.get('before'))
+                except ValueError:
+                    context['device_msg'], context['next_cursor'] = message_page(device)
             return render(request, 'device.html', context)
         else:
             context = {'error': True}
             return render(request, 'device.html', context)
 
 
-# class IoTDevicesAPIView(LoginRequiredMixin, View):
-#     def post(self, request, *args, **kwargs):
-#         msg = request.POST.get('device_message')
-#         device = IoTDevice.objects.get(uid=request.POST.get('device'))
-#         topic = f'/devices/{device.device_name}/data'
-#         try:
-#             MQTT_LISTENER.send_message(topic, msg)
-#             UserToDeviceLog.objects.create(
-#                 user=request.user,
-#                 device=device,
-#                 status='Успешная отправка',
-#                 description=f'successful send. msg: [{msg}] from user: [{request.user}] to device: [{device.device_name}]'
-#             )
-#         except Exception as e:
-#             UserToDeviceLog.objects.create(
-#                 user=request.user,
-#                 device=device,
-#                 status='Неудачная отправка',
-#                 description=f'unsuccessful send. msg: [{msg}] from user: [{request.user}] to device: [{device.device_name}]\n reason: [{e}]'
-#             )
-#         return redirect(reverse("device", kwargs={'pk': device.id}))
+class IoTDeviceMessagesView(LoginRequiredMixin, View):
+    """ История сообщений устройства в JSON для подгрузки при прокрутке """
+
+    def get(self, request, *args, **kwargs):
+        device = IoTDevice.objects.get(**kwargs)
+        user = request.user
+        if not decision_point.check_access(user, device):
+            return JsonResponse({'error': 'Отказано в доступе'}, status=403)
+        if 'can view device information' not in request.effective_permissions:
+            return JsonResponse({'error': 'Отказано в доступе'}, status=403)
+        try:
+            messages, next_cursor = message_page(device, request.GET.get('before'))
+        except ValueError:
+            return JsonResponse({'error': 'Некорректный курсор'}, status=400)
+        return JsonResponse({
+            'messages': [
+                {
+                    'id': msg.id,
+                    'topic': msg.topic,
+                    'msg': msg.text,
+                    'receive_time': msg.receive_time.isoformat(),
+                    'text': str(msg),
+                }
+                for msg in messages
+            ],
+            'next': next_cursor,
+        })
+
+
+class IoTDeviceMetricView(LoginRequiredMixin, View):
+    """ Агрегаты показателя устройства для графиков: ?start=&end=&points= """
+
+    def get(self, request, *args, **kwargs):
+        device = IoTDevice.objects.get(pk=kwargs['pk'])
+        user = request.user
+        if not decision_point.check_access(user, device):
+            return JsonResponse({'error': 'Отказано в доступе'}, status=403)
+        if 'can view device information' not in request.effective_permissions:
+            return JsonResponse({'error': 'Отказано в доступе'}, status=403)
+        try:
+            end = parse_datetime(request.GET['end']) if 'end' in request.GET else timezone.now()
+            start = parse_datetime(request.GET['start']) if 'start' in request.GET else end - timedelta(days=1)
+            points = int(request.GET.get('points', 500))
+        except ValueError:
+            return JsonResponse({'error': 'Некорректные параметры'}, status=400)
+        if start is None or end is None or points <= 0:
+            return JsonResponse({'error': 'Некорректные параметры'}, status=400)
+        resolution, series = metric_series(device, kwargs['metric'], start, end, points)
+        return JsonResponse({'resolution': resolution, 'series': series})
+
+
+def _stream_device(request, pk):
+    # Синхронная часть проверки доступа для асинхронного представления
+    if not request.user.is_authenticated:
+        return None
+    device = IoTDevice.objects.get(pk=pk)
+    if not decision_point.check_access(request.user, device):
+        return None
+    if 'can view device information' not in request.effective_permissions:
+        return None
+    return device
+
+
+def _sse(event, event_type='message'):
+    data = json.dumps(event, cls=DjangoJSONEncoder, ensure_ascii=False)
+    return f'event: {event_type}\ndata: {data}\n\n'
+
+
+async def _device_events(uid):
+    heartbeat = settings.LIVE_STREAM_HEARTBEAT
+    deadline = time.monotonic() + settings.LIVE_STREAM_MAX_AGE
+    with message_hub.subscribe(uid) as events:
+        yield f'retry: {settings.LIVE_STREAM_RETRY}\n\n'
+        # Поток ограничен по времени: браузер переподключится сам, а отключившиеся клиенты не копятся
+        while time.monotonic() < deadline:
+            try:
+                event = await asyncio.wait_for(events.get(), heartbeat)
+            except asyncio.TimeoutError:
+                yield ': keepalive\n\n'
+                continue
+            event['text'] = str(IoTMessage(msg=event['msg'], topic=event['topic'],
+                                           receive_time=event['receive_time']))
+            yield _sse(event)
+
+
+async def device_stream(request, pk):
+    """ Новые сообщения устройства в реальном времени (Server-Sent Events, требуется ASGI) """
+    device = await sync_to_async(_stream_device)(request, pk)
+    if device is None:
+        return JsonResponse({'error': 'Отказано в доступе'}, status=403)
+    response = StreamingHttpResponse(_device_events(device.uid), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+class IoTDevicesAPIView(LoginRequiredMixin, View):
+    """ Отправка команды устройству: команда ставится в очередь, статус доставки пишется в журнал """
+
+    def post(self, request, *args, **kwargs):
+        msg = request.POST.get('device_message')
+        device = IoTDevice.objects.filter(uid=request.POST.get('device')).first()
+        if device is None:
+            return JsonResponse({'error': 'Устройство не найдено'}, status=404)
+        if not decision_point.check_access(request.user, device) or \
+                'can send device information' not in request.effective_permissions:
+            return JsonResponse({'error': 'Отказано в доступе'}, status=403)
+        if not command_dispatcher.send(request.user, device, msg):
+            return JsonResponse({'error': 'Очередь отправки переполнена'}, status=503)
+        if request.headers.get('Accept', '').startswith('application/json'):
+            return JsonResponse({'status': 'queued'}, status=202)
+        return redirect(reverse("device", kwargs={'pk': device.id}))
@@ -0,0 +1,41 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Exists, OuterRef
+
+from group_police.models import IoTDevice, IoTUser
+
+VERSION_KEY = 'visible_devices:version'
+
+
+def _user_key(user_id):
+    return f'visible_devices:{cache.get_or_set(VERSION_KEY, 1, None)}:{user_id}'
+
+
+def visible_devices(user):
+    """ Устройства, входящие хотя бы в одну из разрешенных пользователю групп, без дублей """
+    allowed_groups = IoTUser.allowed_iot_groups.through.objects.filter(iotuser_id=user.pk).values('iotgroup_id')
+    return IoTDevice.objects.filter(Exists(
+        IoTDevice.groups.through.objects.filter(iotdevice_id=OuterRef('pk'), iotgroup_id__in=allowed_groups)
+    ))
+
+
+def visible_device_ids(user):
+    """ Множество id видимых пользователю устройств, кэшируется до изменения групп """
+    key = _user_key(user.pk)
+    ids = cache.get(key)
+    if ids is None:
+        ids = frozenset(visible_devices(user).values_list('id', flat=True))
+        cache.set(key, ids, settings.VISIBLE_DEVICES_CACHE_TTL)
+    return ids
+
+
+def invalidate_user(user_id):
+    cache.delete(_user_key(user_id))
+
+
+def invalidate_all():
+    # Смена версии делает недействительными кэши всех пользователей сразу
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.set(VERSION_KEY, 2, None)
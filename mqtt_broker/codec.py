@@ -0,0 +1,101 @@
+import json
+
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+
+try:
+    import msgpack
+except ImportError:  # необязательная зависимость
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:  # необязательная зависимость
+    cbor2 = None
+
+# Значения свойства Content Type сообщений MQTT v5
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+CBOR = 'application/cbor'
+
+# Длиннее не бывает ни один из типов, которые понимает сервер (RFC 6838 ограничивает тип и подтип 127 символами)
+MAX_CONTENT_TYPE_LENGTH = 255
+
+
+def _json_encode(data):
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+CODECS = {JSON: (_json_encode, json.loads)}
+if msgpack is not None:
+    CODECS[MSGPACK] = (msgpack.packb, msgpack.unpackb)
+if cbor2 is not None:
+    CODECS[CBOR] = (cbor2.dumps, cbor2.loads)
+
+
+def supported():
+    """ Доступные кодировки: JSON всегда, MessagePack и CBOR - если установлены msgpack и cbor2 """
+    return list(CODECS)
+
+
+def encode(data, content_type=JSON):
+    return CODECS[content_type][0](data)
+
+
+def decode(payload, content_type=None):
+    """ Содержимое сообщения; без Content Type считается JSON. ValueError для неизвестной кодировки и битых данных """
+    codec = CODECS.get(content_type or JSON)
+    if codec is None:
+        raise ValueError(f'Unsupported content type: {content_type}')
+    try:
+        return codec[1](payload)
+    except ValueError:
+        raise
+    except Exception as error:
+        # msgpack и cbor2 сообщают об ошибках разбора собственными исключениями
+        raise ValueError(str(error)) from error
+
+
+def payload_content(payload, content_type=None):
+    """
+    Текст сообщения для хранения и показа и его разобранное содержимое. JSON хранится как есть
+    (содержимое None, если это не JSON), двоичные кодировки переводятся в JSON; для них
+    нераспознаваемые данные дают ValueError.
+    """
+    if content_type in (None, JSON):
+        text = payload.decode('utf-8', errors='replace')
+        try:
+            return text, json.loads(text)
+        except ValueError:
+            return text, None
+    data = decode(payload, content_type)
+    return json.dumps(data, ensure_ascii=False, default=str), data
+
+
+def negotiate(accepted):
+    """ Первая из предложенных устройством кодировок, которую поддерживает сервер, иначе JSON """
+    for content_type in accepted or ():
+        if content_type in CODECS:
+            return content_type
+    return JSON
+
+
+def content_type_of(properties):
+    """
+    Content Type сообщения MQTT v5 или None (MQTT 3.1.1 и сообщения без свойства).
+    Значение задает устройство, поэтому не-ASCII и слишком длинные значения тоже дают None
+    """
+    content_type = getattr(properties, 'ContentType', None)
+    if not isinstance(content_type, str) or not content_type or len(content_type) > MAX_CONTENT_TYPE_LENGTH:
+        return None
+    return content_type if content_type.isascii() else None
+
+
+def publish_properties(content_type=None, token=None):
+    """ Свойства PUBLISH MQTT v5: Content Type и JWT в пользовательском свойстве Authorization """
+    properties = Properties(PacketTypes.PUBLISH)
+    if content_type:
+        properties.ContentType = content_type
+    if token:
+        properties.UserProperty = ('Authorization', f'Bearer {token}')
+    return properties
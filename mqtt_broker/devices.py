@@ -1,22 +1,44 @@
 import json
+import time
 import uuid
 import paho.mqtt.client as mqtt
 import random
 import logging
 
+from mqtt_broker import codec
+from mqtt_broker.routing import TopicRouter
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("IoTDevice")
 
+# Доля срока JWT, после которой устройство регистрируется повторно за новым токеном
+TOKEN_REFRESH_FRACTION = 0.8
+
 
 class IoTDevice:
     def __init__(self, broker_address):
-        self.client = mqtt.Client(client_id=f"device_{uuid.uuid4().hex[:6]}")
+        # MQTT v5 нужен для свойств Content Type и Authorization
+        self.client = mqtt.Client(
+            mqtt.CallbackAPIVersion.VERSION2,
+            client_id=f"device_{uuid.uuid4().hex[:6]}",
+            protocol=mqtt.MQTTv5,
+        )
         self.client.on_connect = self.on_connect
         self.client.on_message = self.on_message
 
         self.broker = broker_address
         self.jwt_token = None
+        self.token_refresh_at = None  # time.monotonic(), после которого токен обновляется повторной регистрацией
+        self.device_type = None
         self.subscribed_topics = set()
+        # Кодировка сообщений устройства; сервер выбирает ее в ответе на регистрацию
+        self.content_type = codec.JSON
+
+        # Регистрация обрабатывается отдельно, остальные топики - общим обработчиком
+        self.router = TopicRouter()
+        self.router.add("devices/register", lambda topic, payload: self.handle_registration(payload))
+        self.router.add("devices/+/register", lambda topic, payload: self.handle_registration(payload))
+        self.router.add("#", self.handle_custom_topic)
 
         # Генерация данных устройства
         self.device_data = {
@@ -25,21 +47,24 @@ class IoTDevice:
             "serial": uuid.uuid4().hex
         }
 
-    def on_connect(self, client, userdata, flags, rc):
+    def on_connect(self, client, userdata, flags, rc, properties=None):
         logger.info(f"Connected to broker {self.broker}")
         # Подписка на топик регистрации при подключении
         self.subscribe("devices/register")
 
     def on_message(self, client, userdata, msg):
         topic = msg.topic
-        payload = msg.payload.decode()
+        try:
+            payload, _ = codec.payload_content(msg.payload, codec.content_type_of(msg.properties))
+        except ValueError:
+            logger.error(f"Undecodable message on {topic}")
+            return
 
         logger.info(f"Received message on {topic}: {payload}")
 
-        if topic == "devices/register":
-            self.handle_registration(payload)
-        else:
-            self.handle_custom_topic(topic, payload)
+        match = self.router.resolve(topic)
+        if match is not None:
+            match.handler(topic, payload)
 
     def handle_registration(self, payload):
         try:
@@ -52,8 +77,16 @@ class IoTDevice:
             # Сохранение JWT токена
             if "jwt" in data:
                 self.jwt_token = data["jwt"]
+                expires_in = data.get("expires_in")
+                self.token_refresh_at = (
+                    time.monotonic() + expires_in * TOKEN_REFRESH_FRACTION
+                    if isinstance(expires_in, (int, float)) else None
+                )
                 logger.info("JWT token updated")
 
+            if data.get("content_type") in codec.CODECS:
+                self.content_type = data["content_type"]
+
         except json.JSONDecodeError:
             logger.error("Invalid JSON received")
 
@@ -74,7 +107,7 @@ class IoTDevice:
                 "message": "No auth token available"
             }
 
-        self.publish(f"{topic}/response", json.dumps(response))
+        self.publish(f"{topic}/response", response)
 
     def subscribe(self, topic):
         if topic not in self.subscribed_topics:
@@ -82,14 +115,36 @@ class IoTDevice:
             self.subscribed_topics.add(topic)
             logger.info(f"Subscribed to {topic}")
 
-    def publish(self, topic, message):
-        # Добавляем JWT в заголовки если есть
-        headers = {}
-        if self.jwt_token:
-            headers["Authorization"] = f"Bearer {self.jwt_token}"
+    def register(self, device_type):
+        self.device_type = device_type
+        # Устройство предлагает поддерживаемые кодировки, сервер отвечает выбранной в devices/<id>/register
+        self.subscribe(f"devices/{self.device_data['serial']}/register")
+        self.publish("devices/register", {
+            "device_id": self.device_data["serial"],
+            "device_type": device_type,
+            "accept": codec.supported(),
+        })
+
+    def refresh_token(self):
+        # Повторная регистрация до истечения JWT: иначе прием с MQTT_INGEST_REQUIRE_JWT отбросит данные
+        if self.token_refresh_at is None or time.monotonic() < self.token_refresh_at:
+            return
+        self.token_refresh_at = None
+        self.register(self.device_type)
 
-        self.client.publish(topic, payload=message, properties=headers)
-        logger.info(f"Published to {topic}: {message}")
+    def publish(self, topic, message):
+        if topic != "devices/register":
+            self.refresh_token()
+        # Словари кодируются выбранной кодировкой, строки и байты отправляются как есть
+        content_type = None
+        if not isinstance(message, (str, bytes)):
+            content_type = self.content_type if topic != "devices/register" else codec.JSON
+            message = codec.encode(message, content_type)
+
+        # JWT и Content Type передаются свойствами MQTT v5
+        properties = codec.publish_properties(content_type, self.jwt_token)
+        self.client.publish(topic, payload=message, properties=properties)
+        logger.info(f"Published to {topic}: {len(message)} bytes")
 
     def start(self):
         self.client.connect(self.broker)
@@ -108,7 +163,7 @@ if __name__ == "__main__":
     try:
         while True:
             # Имитация периодической отправки данных
-            device.publish("devices/status", json.dumps(device.device_data))
+            device.publish("devices/status", device.device_data)
             time.sleep(30)
 
     except KeyboardInterrupt:
@@ -0,0 +1,213 @@
+import atexit
+import itertools
+import logging
+import queue
+import threading
+import time
+import uuid
+from typing import NamedTuple
+
+import paho.mqtt.client as mqtt
+from django.conf import settings
+
+from group_police.audit import audit_log
+from group_police.models import UserToDeviceLog
+
+logger = logging.getLogger(__name__)
+
+COMMAND_TOPIC = 'devices/{uid}/command'
+
+STATUS_QUEUED = 'В очереди'
+STATUS_DELIVERED = 'Доставлено'
+STATUS_FAILED = 'Не доставлено'
+STATUS_UNCONFIRMED = 'Не подтверждено'
+
+# PUBACK, пришедший раньше записи mid в _pending, забирается сразу после client.publish; более старые -
+# подтверждения уже истекших команд, и после переполнения mid они подтвердили бы чужую команду
+EARLY_ACK_TTL = 5
+# Сколько секунд после MQTT_DISPATCH_ACK_TIMEOUT ждать запоздавший PUBACK: paho досылает команду и дальше
+LATE_ACK_TTL = 600
+
+
+class DeviceCommand(NamedTuple):
+    user_id: int
+    device_id: int
+    device_name: str
+    uid: str
+    message: str
+
+
+def command_topic(uid):
+    return COMMAND_TOPIC.format(uid=uid)
+
+
+class CommandDispatcher:
+    """
+    Отправка команд устройствам через пул долгоживущих соединений MQTT.
+
+    send() только ставит команду в очередь, поэтому время ответа веб-запроса не зависит
+    от брокера. Фоновый поток публикует команды с QoS 1 по соединениям пула по кругу;
+    paho сам переподключается и досылает неподтвержденные сообщения, а окно
+    неподтвержденных публикаций на соединение ограничено MQTT_DISPATCH_MAX_INFLIGHT.
+    Итог доставки пишется в UserToDeviceLog через фоновый журнал. Без PUBACK за
+    MQTT_DISPATCH_ACK_TIMEOUT команда получает статус «Не подтверждено», а не «Не доставлено»:
+    paho продолжает ее досылать, и запоздавший PUBACK еще запишет доставку.
+
+    Пул и очередь свои у каждого процесса, использующего диспетчер (воркера веб-сервера),
+    а не общие на все процессы.
+    """
+
+    def __init__(self, host=None, port=None, pool_size=None):
+        self.host = host or settings.MQTT_BROKER_HOST
+        self.port = port or settings.MQTT_BROKER_PORT
+        self.pool_size = pool_size or settings.MQTT_DISPATCH_POOL_SIZE
+        self.stats = {'queued': 0, 'rejected': 0, 'delivered': 0, 'failed': 0, 'unconfirmed': 0}
+        self._queue = queue.Queue(maxsize=settings.MQTT_DISPATCH_QUEUE_SIZE)
+        self._lock = threading.Lock()
+        self._pending = {}  # (номер соединения, mid) -> (команда, время публикации), ожидающие PUBACK
+        self._early_acks = {}  # PUBACK, пришедшие раньше, чем mid был записан в _pending: key -> (код, время)
+        self._unconfirmed = {}  # команды без PUBACK за MQTT_DISPATCH_ACK_TIMEOUT: key -> (команда, время истечения)
+        self._clients = []
+        self._thread = None
+        self._stopping = threading.Event()
+
+    def _create_client(self, index):
+        client = mqtt.Client(
+            mqtt.CallbackAPIVersion.VERSION2,
+            client_id=f'pdp-dispatch-{uuid.uuid4().hex[:8]}-{index}',
+            protocol=mqtt.MQTTv5,
+            userdata=index,
+        )
+        client.max_inflight_messages_set(settings.MQTT_DISPATCH_MAX_INFLIGHT)
+        client.reconnect_delay_set(min_delay=1, max_delay=30)
+        client.on_publish = self.on_publish
+        return client
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stopping.clear()
+            self._clients = [self._create_client(index) for index in range(self.pool_size)]
+            for client in self._clients:
+                client.connect_async(self.host, self.port)
+                client.loop_start()
+            self._thread = threading.Thread(target=self._run, name='mqtt-dispatch', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=5):
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        self._stopping.set()
+        thread.join(timeout)
+        for client in self._clients:
+            client.loop_stop()
+            client.disconnect()
+
+    def send(self, user, device, message):
+        """ Ставит команду в очередь; False, если очередь переполнена """
+        self.start()
+        command = DeviceCommand(user.pk, device.pk, device.device_name, device.uid, message)
+        try:
+            self._queue.put_nowait(command)
+        except queue.Full:
+            self.stats['rejected'] += 1
+            self._log(command, STATUS_FAILED, 'очередь отправки переполнена')
+            return False
+        self.stats['queued'] += 1
+        self._log(command, STATUS_QUEUED, 'поставлено в очередь')
+        return True
+
+    def _run(self):
+        clients = itertools.cycle(range(self.pool_size))
+        while not self._stopping.is_set():
+            try:
+                command = self._queue.get(timeout=1)
+            except queue.Empty:
+                command = None
+            if command is not None:
+                try:
+                    self.publish(next(clients), command)
+                except Exception as error:
+                    # Ошибка одной команды не должна останавливать поток: остальные ждут в очереди
+                    logger.exception('Failed to publish command to %s', command.uid)
+                    self._complete(command, False, error)
+            try:
+                self.expire()
+            except Exception:
+                logger.exception('Failed to expire pending commands')
+
+    def publish(self, index, command):
+        info = self._clients[index].publish(command_topic(command.uid), command.message, qos=1)
+        if info.rc not in (mqtt.MQTT_ERR_SUCCESS, mqtt.MQTT_ERR_NO_CONN):
+            # NO_CONN не ошибка: сообщение с QoS 1 остается в очереди клиента до переподключения
+            self._complete(command, False, mqtt.error_string(info.rc))
+            return
+        key = (index, info.mid)
+        with self._lock:
+            # mid переиспользован: PUBACK с ним относится уже к новой команде
+            self._unconfirmed.pop(key, None)
+            early_ack = self._early_acks.pop(key, None)
+            if early_ack is None:
+                self._pending[key] = (command, time.monotonic())
+        if early_ack is not None:
+            self._complete_with_reason(command, early_ack[0])
+
+    def on_publish(self, client, userdata, mid, reason_code, properties):
+        # Вызывается в сетевом потоке paho под его внутренней блокировкой: client.publish здесь не вызывать
+        key = (userdata, mid)
+        with self._lock:
+            pending = self._pending.pop(key, None) or self._unconfirmed.pop(key, None)
+            if pending is None:
+                self._early_acks[key] = (reason_code, time.monotonic())
+                return
+        self._complete_with_reason(pending[0], reason_code)
+
+    def expire(self):
+        now = time.monotonic()
+        deadline = now - settings.MQTT_DISPATCH_ACK_TIMEOUT
+        with self._lock:
+            expired = [key for key, (_, published_at) in self._pending.items() if published_at < deadline]
+            commands = []
+            for key in expired:
+                command = self._pending.pop(key)[0]
+                self._unconfirmed[key] = (command, now)
+                commands.append(command)
+            for key in [key for key, (_, expired_at) in self._unconfirmed.items() if expired_at < now - LATE_ACK_TTL]:
+                del self._unconfirmed[key]
+            for key in [key for key, (_, acked_at) in self._early_acks.items() if acked_at < now - EARLY_ACK_TTL]:
+                del self._early_acks[key]
+        for command in commands:
+            self.stats['unconfirmed'] += 1
+            logger.warning('Command to %s not acknowledged in %ss', command.uid, settings.MQTT_DISPATCH_ACK_TIMEOUT)
+            self._log(command, STATUS_UNCONFIRMED, 'нет подтверждения от брокера, доставка еще возможна')
+
+    def _complete_with_reason(self, command, reason_code):
+        if getattr(reason_code, 'is_failure', False):
+            self._complete(command, False, str(reason_code))
+        else:
+            self._complete(command, True)
+
+    def _complete(self, command, delivered, reason=None):
+        if delivered:
+            self.stats['delivered'] += 1
+            self._log(command, STATUS_DELIVERED, 'доставлено брокеру')
+        else:
+            self.stats['failed'] += 1
+            logger.warning('Command to %s failed: %s', command.uid, reason)
+            self._log(command, STATUS_FAILED, f'не доставлено, причина: [{reason}]')
+
+    def _log(self, command, status, result):
+        audit_log.write(UserToDeviceLog(
+            status=status,
+            device_id=command.device_id,
+            user_id=command.user_id,
+            description=f'msg: [{command.message}] to device: [{command.device_name}] '
+                        f'topic: [{command_topic(command.uid)}]: {result}',
+        ))
+
+
+command_dispatcher = CommandDispatcher()
+atexit.register(command_dispatcher.stop)
@@ -0,0 +1,539 @@
+import asyncio
+import itertools
+import json
+import multiprocessing
+import random
+import struct
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple
+
+from mqtt_broker import codec
+
+# Типы пакетов MQTT
+CONNECT, CONNACK, PUBLISH, PUBACK, SUBSCRIBE, SUBACK, PINGREQ, PINGRESP, DISCONNECT = 1, 2, 3, 4, 8, 9, 12, 13, 14
+
+# Свойства MQTT v5 по способу кодирования; нужны, чтобы пропускать неизвестные свойства входящих пакетов
+PROPERTY_CONTENT_TYPE = 0x03
+PROPERTY_USER = 0x26
+_BYTE_PROPERTIES = {0x01, 0x17, 0x19, 0x24, 0x25, 0x28, 0x29, 0x2A}
+_SHORT_PROPERTIES = {0x13, 0x21, 0x22, 0x23}
+_INT_PROPERTIES = {0x02, 0x11, 0x18, 0x27}
+_STRING_PROPERTIES = {0x03, 0x08, 0x12, 0x15, 0x1A, 0x1C, 0x1F}
+_BINARY_PROPERTIES = {0x09, 0x16}
+
+REGISTER_TOPIC = 'devices/register'
+
+
+def encode_varint(value):
+    encoded = bytearray()
+    while True:
+        value, byte = divmod(value, 128)
+        encoded.append(byte | 0x80 if value else byte)
+        if not value:
+            return bytes(encoded)
+
+
+def decode_varint(data, position):
+    value, multiplier = 0, 1
+    while True:
+        byte = data[position]
+        position += 1
+        value += (byte & 0x7F) * multiplier
+        if not byte & 0x80:
+            return value, position
+        multiplier *= 128
+
+
+def encode_string(text):
+    data = text.encode('utf-8')
+    return struct.pack('!H', len(data)) + data
+
+
+def decode_string(data, position):
+    length, = struct.unpack_from('!H', data, position)
+    start = position + 2
+    return bytes(data[start:start + length]).decode('utf-8'), start + length
+
+
+def encode_properties(content_type=None, user_properties=()):
+    body = bytearray()
+    if content_type:
+        body += bytes([PROPERTY_CONTENT_TYPE]) + encode_string(content_type)
+    for name, value in user_properties:
+        body += bytes([PROPERTY_USER]) + encode_string(name) + encode_string(value)
+    return encode_varint(len(body)) + bytes(body)
+
+
+def decode_properties(data):
+    """ Content Type и пользовательские свойства; остальные свойства пропускаются """
+    properties = {'content_type': None, 'user': []}
+    position = 0
+    while position < len(data):
+        identifier, position = decode_varint(data, position)
+        if identifier == PROPERTY_CONTENT_TYPE:
+            properties['content_type'], position = decode_string(data, position)
+        elif identifier == PROPERTY_USER:
+            name, position = decode_string(data, position)
+            value, position = decode_string(data, position)
+            properties['user'].append((name, value))
+        elif identifier in _BYTE_PROPERTIES:
+            position += 1
+        elif identifier in _SHORT_PROPERTIES:
+            position += 2
+        elif identifier in _INT_PROPERTIES:
+            position += 4
+        elif identifier == 0x0B:
+            _, position = decode_varint(data, position)
+        elif identifier in _STRING_PROPERTIES or identifier in _BINARY_PROPERTIES:
+            length, = struct.unpack_from('!H', data, position)
+            position += 2 + length
+        else:
+            raise ValueError(f'Unknown MQTT property 0x{identifier:02x}')
+    return properties
+
+
+def packet(kind, flags, body):
+    return bytes([kind << 4 | flags]) + encode_varint(len(body)) + body
+
+
+def connect_packet(client_id, keepalive=60, clean_start=True):
+    body = encode_string('MQTT') + bytes([5, 0x02 if clean_start else 0]) + struct.pack('!H', keepalive)
+    return packet(CONNECT, 0, body + encode_properties() + encode_string(client_id))
+
+
+def publish_packet(topic, payload, qos=0, packet_id=None, content_type=None, user_properties=()):
+    body = encode_string(topic)
+    if qos:
+        body += struct.pack('!H', packet_id)
+    return packet(PUBLISH, qos << 1, body + encode_properties(content_type, user_properties) + payload)
+
+
+def subscribe_packet(packet_id, topic, qos=1):
+    body = struct.pack('!H', packet_id) + encode_properties() + encode_string(topic) + bytes([qos])
+    return packet(SUBSCRIBE, 0x02, body)
+
+
+def puback_packet(packet_id):
+    return packet(PUBACK, 0, struct.pack('!H', packet_id))
+
+
+def parse_publish(flags, body):
+    """ Топик, packet id, QoS, свойства и содержимое входящего PUBLISH """
+    qos = (flags >> 1) & 0x03
+    topic, position = decode_string(body, 0)
+    packet_id = None
+    if qos:
+        packet_id, = struct.unpack_from('!H', body, position)
+        position += 2
+    length, position = decode_varint(body, position)
+    properties = decode_properties(body[position:position + length])
+    return topic, packet_id, qos, properties, bytes(body[position + length:])
+
+
+async def read_packet(reader):
+    """ (тип, флаги, тело) следующего пакета из потока """
+    header = (await reader.readexactly(1))[0]
+    length, multiplier = 0, 1
+    while True:
+        byte = (await reader.readexactly(1))[0]
+        length += (byte & 0x7F) * multiplier
+        if not byte & 0x80:
+            break
+        multiplier *= 128
+    body = await reader.readexactly(length) if length else b''
+    return header >> 4, header & 0x0F, body
+
+
+class MQTTConnection:
+    """
+    Минимальный клиент MQTT v5 поверх asyncio streams: CONNECT, PUBLISH с QoS 0/1,
+    SUBSCRIBE, keepalive. Без собственного потока на соединение, поэтому один цикл
+    событий держит десятки тысяч соединений.
+    """
+
+    def __init__(self, client_id, host, port, keepalive=60, on_message=None):
+        self.client_id = client_id
+        self.host = host
+        self.port = port
+        self.keepalive = keepalive
+        self.on_message = on_message
+        self.connected = False
+        self.protocol_errors = 0
+        self._pending = {}  # packet id -> future подтверждения
+        self._ids = itertools.cycle(range(1, 65536))
+        self._reader = self._writer = None
+        self._tasks = []
+
+    async def connect(self, timeout=10.0):
+        self._reader, self._writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), timeout)
+        self._writer.write(connect_packet(self.client_id, self.keepalive))
+        kind, flags, body = await asyncio.wait_for(read_packet(self._reader), timeout)
+        if kind != CONNACK or len(body) < 2 or body[1] >= 0x80:
+            self._writer.close()
+            raise ConnectionError(f'Connection refused: {body[1:2].hex()}')
+        self.connected = True
+        self._tasks = [asyncio.create_task(self._read_loop()), asyncio.create_task(self._ping_loop())]
+
+    async def _read_loop(self):
+        try:
+            while True:
+                kind, flags, body = await read_packet(self._reader)
+                if kind in (PUBACK, SUBACK):
+                    packet_id, = struct.unpack_from('!H', body)
+                    future = self._pending.pop(packet_id, None)
+                    if future is not None and not future.done():
+                        future.set_result(body)
+                elif kind == PUBLISH:
+                    topic, packet_id, qos, properties, payload = parse_publish(flags, body)
+                    if qos == 1:
+                        self._writer.write(puback_packet(packet_id))
+                    if self.on_message is not None:
+                        self.on_message(topic, payload, properties)
+        except (asyncio.IncompleteReadError, ConnectionError, OSError):
+            pass
+        except (ValueError, struct.error):
+            # Неразборчивый пакет (UnicodeDecodeError - тоже ValueError): соединение дальше не читается
+            self.protocol_errors += 1
+            self._writer.close()
+        finally:
+            self.connected = False
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError('Connection lost'))
+            self._pending.clear()
+
+    async def _ping_loop(self):
+        while self.connected:
+            await asyncio.sleep(self.keepalive * 0.75)
+            self._writer.write(bytes([PINGREQ << 4, 0]))
+
+    def _register(self):
+        packet_id = next(self._ids)
+        while packet_id in self._pending:
+            packet_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[packet_id] = future
+        return packet_id, future
+
+    async def _wait(self, packet_id, future, timeout):
+        try:
+            await asyncio.wait_for(future, timeout)
+        finally:
+            # Без подтверждения id так и остался бы занят, а _pending рос бы на каждом таймауте
+            if self._pending.get(packet_id) is future:
+                del self._pending[packet_id]
+
+    async def publish(self, topic, payload, qos=0, content_type=None, token=None, timeout=30.0):
+        """ Публикует сообщение; для QoS 1 ждет PUBACK """
+        if not self.connected:
+            raise ConnectionError('Not connected')
+        user_properties = [('Authorization', f'Bearer {token}')] if token else ()
+        if not qos:
+            self._writer.write(publish_packet(topic, payload, 0, None, content_type, user_properties))
+            await self._writer.drain()
+            return
+        packet_id, future = self._register()
+        self._writer.write(publish_packet(topic, payload, qos, packet_id, content_type, user_properties))
+        await self._writer.drain()
+        await self._wait(packet_id, future, timeout)
+
+    async def subscribe(self, topic, qos=1, timeout=30.0):
+        packet_id, future = self._register()
+        self._writer.write(subscribe_packet(packet_id, topic, qos))
+        await self._writer.drain()
+        await self._wait(packet_id, future, timeout)
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        if self._writer is not None:
+            try:
+                if self.connected:
+                    self._writer.write(bytes([DISCONNECT << 4, 0]))
+                self._writer.close()
+                await self._writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+        self.connected = False
+
+
+class Samples:
+    """ Равномерная выборка не более limit значений (reservoir sampling) для перцентилей """
+
+    def __init__(self, limit=100000, values=None, seen=0):
+        self.limit = limit
+        self.values = list(values or [])
+        self.seen = seen or len(self.values)
+
+    def add(self, value):
+        self.seen += 1
+        if len(self.values) < self.limit:
+            self.values.append(value)
+        else:
+            index = random.randrange(self.seen)
+            if index < self.limit:
+                self.values[index] = value
+
+    def merge(self, other):
+        for value in other.values:
+            self.add(value)
+        self.seen += other.seen - len(other.values)
+
+    def percentile(self, fraction):
+        if not self.values:
+            return None
+        ordered = sorted(self.values)
+        return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+class FleetConfig(NamedTuple):
+    host: str = '127.0.0.1'
+    port: int = 1883
+    devices: int = 1000
+    rate: float = 1000.0  # сообщений в секунду на весь парк
+    duration: float = 30.0
+    shape: str = 'sensor'
+    qos: int = 1
+    content_type: str = codec.JSON
+    register: bool = True
+    storm: bool = False  # все устройства подключаются и регистрируются одновременно
+    ramp: float = 5.0  # без storm подключения равномерно растягиваются на ramp секунд
+    churn: float = 0.0  # доля устройств, переподключающихся за минуту
+    prefix: str = 'fleet'
+    first: int = 0  # номер первого устройства; процессы симулятора получают разные диапазоны
+    timeout: float = 10.0
+
+
+class FleetStats:
+    COUNTERS = ('connections', 'connect_errors', 'registered', 'registration_timeouts', 'registration_errors',
+                'published', 'failed', 'reconnects', 'protocol_errors')
+
+    def __init__(self):
+        for name in self.COUNTERS:
+            setattr(self, name, 0)
+        self.ack_latency = Samples()
+        self.registration_latency = Samples()
+        self.seconds = 0.0
+
+    def merge(self, other):
+        for name in self.COUNTERS:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        self.ack_latency.merge(other.ack_latency)
+        self.registration_latency.merge(other.registration_latency)
+        self.seconds = max(self.seconds, other.seconds)
+
+    @property
+    def rate(self):
+        return self.published / self.seconds if self.seconds else 0.0
+
+
+def device_uid(config, number):
+    return f'{config.prefix}-{number}'
+
+
+def make_payload(shape, uid, number, sent_at):
+    """ Сообщение устройства заданного вида; sent_at нужен для измерения задержки до IoTMessage """
+    if shape == 'minimal':
+        return {'temperature': round(20 + number % 100 / 10, 1), 'sent_at': sent_at}
+    if shape == 'response':
+        return {
+            'device_data': {'mac': f'02:00:00:{number >> 16 & 255:02x}:{number >> 8 & 255:02x}:{number & 255:02x}',
+                            'ip': f'10.{number >> 16 & 255}.{number >> 8 & 255}.{number & 255}', 'serial': uid},
+            'message': 'Processing your request',
+            'sent_at': sent_at,
+        }
+    return {
+        'device_id': uid,
+        'temperature': round(random.uniform(15, 30), 2),
+        'humidity': round(random.uniform(20, 80), 1),
+        'pressure': round(random.uniform(980, 1040), 2),
+        'battery': round(random.uniform(3.3, 4.2), 2),
+        'sent_at': sent_at,
+    }
+
+
+async def register(connection, uid, config, stats):
+    """
+    Регистрация устройства; возвращает (JWT, кодировка) из ответа сервера или (None, JSON)
+    по таймауту или при некорректном ответе
+    """
+    reply = asyncio.get_running_loop().create_future()
+    reply_topic = f'devices/{uid}/register'
+
+    def on_message(topic, payload, properties):
+        if topic == reply_topic and not reply.done():
+            reply.set_result(payload)
+
+    connection.on_message = on_message
+    started = time.perf_counter()
+    await connection.subscribe(reply_topic, timeout=config.timeout)
+    request = {'device_id': uid, 'device_type': f'{config.prefix}_{config.shape}',
+               'accept': [config.content_type, codec.JSON]}
+    await connection.publish(REGISTER_TOPIC, codec.encode(request), qos=1, content_type=codec.JSON,
+                             timeout=config.timeout)
+    try:
+        data = json.loads(await asyncio.wait_for(reply, config.timeout))
+    except asyncio.TimeoutError:
+        stats.registration_timeouts += 1
+        return None, codec.JSON
+    except ValueError:
+        data = None
+    if not isinstance(data, dict):
+        stats.registration_errors += 1
+        return None, codec.JSON
+    stats.registered += 1
+    stats.registration_latency.add(time.perf_counter() - started)
+    content_type = data.get('content_type')
+    return data.get('jwt'), content_type if content_type in codec.CODECS else codec.JSON
+
+
+async def run_device(number, config, stats, deadline):
+    loop = asyncio.get_running_loop()
+    uid = device_uid(config, number)
+    interval = config.devices / config.rate if config.rate else config.duration
+    offset = number - config.first
+    if not config.storm:
+        await asyncio.sleep(config.ramp * offset / config.devices)
+    token, content_type = None, codec.JSON
+    registered = not config.register
+    next_at = loop.time() + random.uniform(0, interval)
+    while loop.time() < deadline:
+        connection = MQTTConnection(f'{uid}-{uuid.uuid4().hex[:6]}', config.host, config.port)
+        try:
+            await connection.connect(config.timeout)
+        except (OSError, ConnectionError, asyncio.TimeoutError):
+            stats.connect_errors += 1
+            await asyncio.sleep(min(1.0, max(deadline - loop.time(), 0)))
+            continue
+        stats.connections += 1
+        try:
+            if not registered:
+                token, content_type = await register(connection, uid, config, stats)
+                registered = True
+            while loop.time() < deadline:
+                delay = next_at - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                next_at += interval
+                if loop.time() >= deadline:
+                    break
+                payload = codec.encode(make_payload(config.shape, uid, number, time.time()), content_type)
+                started = time.perf_counter()
+                await connection.publish(f'devices/{uid}/data', payload, config.qos, content_type, token,
+                                         timeout=config.timeout)
+                if config.qos:
+                    stats.ack_latency.add(time.perf_counter() - started)
+                stats.published += 1
+                if config.churn and random.random() < config.churn * interval / 60:
+                    stats.reconnects += 1
+                    break
+        except (OSError, ConnectionError, asyncio.TimeoutError):
+            stats.failed += 1
+        finally:
+            stats.protocol_errors += connection.protocol_errors
+            await connection.close()
+
+
+async def _simulate(config):
+    try:
+        import resource
+        # Каждое устройство - отдельное TCP-соединение
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+    stats = FleetStats()
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    deadline = started + config.ramp * (not config.storm) + config.duration
+    await asyncio.gather(*(
+        run_device(number, config, stats, deadline) for number in range(config.first, config.first + config.devices)
+    ))
+    stats.seconds = loop.time() - started
+    return stats
+
+
+def simulate(config):
+    """ Парк устройств в одном цикле событий текущего процесса """
+    return asyncio.run(_simulate(config))
+
+
+def run_fleet(config, processes=1):
+    """ Делит парк и частоту между процессами, каждый со своим циклом событий; статистика суммируется """
+    if processes <= 1:
+        return simulate(config)
+    share, extra = divmod(config.devices, processes)
+    slices = []
+    first = config.first
+    for index in range(processes):
+        devices = share + (index < extra)
+        if devices:
+            slices.append(config._replace(first=first, devices=devices, rate=config.rate * devices / config.devices))
+        first += devices
+    total = FleetStats()
+    with ProcessPoolExecutor(len(slices), mp_context=multiprocessing.get_context('spawn')) as executor:
+        for stats in executor.map(simulate, slices):
+            total.merge(stats)
+    return total
+
+
+class IngestionProbe:
+    """
+    Задержка от отправки сообщения устройством до его появления в IoTMessage: фоновый поток
+    опрашивает новые строки устройств парка и сравнивает время с sent_at из сообщения.
+    Погрешность - не больше интервала опроса.
+    """
+
+    def __init__(self, prefix, interval=0.2):
+        self.prefix = prefix
+        self.interval = interval
+        self.stored = 0
+        self.ingest_latency = Samples()  # до приема процессом приема (IoTMessage.receive_time)
+        self.stored_latency = Samples()  # до фиксации строки в БД
+        self._last_id = None
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        from group_police.models import IoTMessage
+
+        self._last_id = IoTMessage.objects.order_by('-id').values_list('id', flat=True).first() or 0
+        self._thread = threading.Thread(target=self._run, name='ingestion-probe', daemon=True)
+        self._thread.start()
+
+    def poll(self):
+        from group_police.models import IoTMessage
+
+        rows = list(IoTMessage.objects.filter(
+            id__gt=self._last_id, device__uid__startswith=f'{self.prefix}-',
+        ).order_by('id')[:10000])
+        seen_at = time.time()
+        for row in rows:
+            try:
+                sent_at = float(json.loads(row.text)['sent_at'])
+            except (ValueError, KeyError, TypeError):
+                continue
+            self.stored += 1
+            self.ingest_latency.add(row.receive_time.timestamp() - sent_at)
+            self.stored_latency.add(seen_at - sent_at)
+        if rows:
+            self._last_id = rows[-1].id
+        return len(rows)
+
+    def _run(self):
+        from django.db import connection
+
+        try:
+            while not self._stopping.is_set():
+                if not self.poll():
+                    self._stopping.wait(self.interval)
+        finally:
+            connection.close()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
@@ -0,0 +1,534 @@
+import ipaddress
+import logging
+import queue
+import re
+import threading
+import time
+from pathlib import Path
+from typing import NamedTuple
+
+import jwt
+import paho.mqtt.client as mqtt
+from django.conf import settings
+from django.db import (
+    close_old_connections, connection, DatabaseError, DataError, IntegrityError, InterfaceError, OperationalError,
+    transaction,
+)
+from django.utils import timezone
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+
+from group_police.db import copy_insert, supports_copy
+from group_police.models import IoTDevice, IoTMessage
+from group_police.checks import shared_cache
+from group_police.hosts import DROP, REDIRECT, host_policies
+from group_police.jwt_token import token_verifier
+from group_police.compression import storage_fields
+from group_police.rollups import RollupAggregator
+from mqtt_broker.codec import content_type_of, payload_content
+from mqtt_broker.last_seen import last_seen_tracker
+from mqtt_broker.live import live_event, live_topic
+from mqtt_broker.models import SpoolOffset
+from mqtt_broker.registration import parse_registrations, registration_reply, reply_topic, upsert_devices
+from mqtt_broker.routing import TopicRouter, shared_subscription
+from mqtt_broker.spool import Spool
+
+logger = logging.getLogger(__name__)
+
+# Виды сообщений, принимаемых в БД
+DATA = 'data'
+REGISTER = 'register'
+
+topics = TopicRouter()
+DATA_TOPIC = topics.add('devices/{uid}/data', DATA).subscription
+REGISTER_TOPIC = topics.add('devices/register', REGISTER).subscription
+
+# Сбои соединения с БД: пачка повторяется целиком с растущей задержкой
+TRANSIENT_ERRORS = (OperationalError, InterfaceError)
+# БД отвергла сами данные: пачка сохраняется по одному сообщению, отвергнутые пропускаются
+RECORD_ERRORS = (IntegrityError, DataError)
+
+# Компактная сериализация JWT: три части base64url через точку
+JWT_FORMAT = re.compile(r'[A-Za-z0-9_-]+\.[A-Za-z0-9_-]+\.[A-Za-z0-9_-]*')
+MAX_TOKEN_LENGTH = 4096
+
+
+class IncomingMessage(NamedTuple):
+    mid: int
+    qos: int
+    topic: str
+    payload: bytes
+    received_at: object
+    token: str = None
+    content_type: str = None  # свойство Content Type MQTT v5, без него - JSON
+    source: str = None  # адрес клиента, переданный брокером (MQTT_INGEST_SOURCE_PROPERTY)
+
+
+class DeviceCache:
+    """ Соответствие uid устройства -> IoTDevice.id и группы устройств в памяти процесса """
+
+    def __init__(self):
+        self._ids = {}
+        self._groups = {}
+        self._loaded_at = None
+
+    def load(self):
+        self._ids = dict(IoTDevice.objects.values_list('uid', 'id'))
+        groups = {}
+        for device_id, group_id in IoTDevice.groups.through.objects.values_list('iotdevice_id', 'iotgroup_id'):
+            groups.setdefault(device_id, set()).add(group_id)
+        self._groups = {device_id: frozenset(group_ids) for device_id, group_ids in groups.items()}
+        self._loaded_at = time.monotonic()
+
+    def refresh(self):
+        # Группы меняются в веб-процессе, поэтому кэш периодически перечитывается целиком
+        if self._loaded_at is None or time.monotonic() - self._loaded_at > settings.MQTT_INGEST_DEVICE_CACHE_TTL:
+            self.load()
+
+    def groups_of(self, device_id):
+        return self._groups.get(device_id, frozenset())
+
+    def get_many(self, uids):
+        missing = [uid for uid in uids if uid not in self._ids]
+        if missing:
+            self._ids.update(IoTDevice.objects.filter(uid__in=missing).values_list('uid', 'id'))
+        return {uid: self._ids[uid] for uid in uids if uid in self._ids}
+
+    def add(self, uid, device_id):
+        self._ids[uid] = device_id
+
+    def __len__(self):
+        return len(self._ids)
+
+
+def bearer_token(properties):
+    """
+    JWT из пользовательского свойства Authorization: Bearer сообщения MQTT v5. Значение, которое
+    не может быть JWT, отбрасывается сразу: такое сообщение считается неподписанным
+    """
+    for name, value in getattr(properties, 'UserProperty', None) or ():
+        if name == 'Authorization' and value.startswith('Bearer '):
+            token = value[7:]
+            if len(token) <= MAX_TOKEN_LENGTH and JWT_FORMAT.fullmatch(token):
+                return token
+            return None
+    return None
+
+
+def source_address(properties):
+    """
+    Адрес клиента из пользовательского свойства MQTT_INGEST_SOURCE_PROPERTY. Свойство добавляет брокер,
+    заменяя одноименное свойство клиента; данным из самого сообщения устройство может подставить любой адрес
+    """
+    name = settings.MQTT_INGEST_SOURCE_PROPERTY
+    if not name:
+        return None
+    address = None
+    for key, value in getattr(properties, 'UserProperty', None) or ():
+        if key == name:
+            address = value
+    if address is None:
+        return None
+    try:
+        return str(ipaddress.ip_address(address))
+    except ValueError:
+        return None
+
+
+def device_uid_from_topic(topic):
+    match = topics.resolve(topic)
+    if match is not None and match.handler == DATA:
+        return match.params['uid']
+    return None
+
+
+class MessageIngestor:
+    """
+    Прием сообщений устройств из MQTT в IoTMessage.
+
+    Сетевой поток paho только кладет сообщения в ограниченную очередь, а поток записи
+    сохраняет их пачками через bulk_create и после фиксации подтверждает QoS 1 брокеру.
+    Когда БД не успевает, очередь заполняется, сетевой поток блокируется и брокер
+    придерживает сообщения у себя, ничего не теряя. С share_group подписка общая
+    ($share/<группа>/...), и брокер делит поток между несколькими процессами приема.
+
+    При MQTT_INGEST_SPOOL_ENABLED пачка сначала пишется в спул на диске и подтверждается
+    сразу после msync, а в БД переносится из спула (drain), как только БД доступна.
+    """
+
+    def __init__(self, host=None, port=None, client_id=None, batch_size=None, flush_interval=None,
+                 max_pending=None, share_group=None):
+        self.host = host or settings.MQTT_BROKER_HOST
+        self.port = port or settings.MQTT_BROKER_PORT
+        self.client_id = client_id or settings.MQTT_INGEST_CLIENT_ID
+        self.batch_size = batch_size or settings.MQTT_INGEST_BATCH_SIZE
+        self.flush_interval = flush_interval or settings.MQTT_INGEST_FLUSH_INTERVAL
+        self.max_pending = max_pending or settings.MQTT_INGEST_MAX_PENDING
+        self.share_group = share_group
+        self.devices = DeviceCache()
+        self.last_seen = last_seen_tracker
+        self.rollups = RollupAggregator()
+        self.stats = {
+            'received': 0, 'stored': 0, 'unknown': 0, 'dropped': 0, 'redirected': 0, 'registered': 0, 'batches': 0,
+            'unauthorized': 0, 'spooled': 0, 'undecodable': 0, 'rejected': 0, 'unchecked': 0,
+        }
+        self.spool = None
+        self.spool_offset = None  # до какого смещения спул перенесен в БД; None - еще не прочитано из БД
+        self._drain_after = 0.0
+        self._drain_delay = 0.5
+        self._queue = queue.Queue(maxsize=self.max_pending)
+        self._stopping = threading.Event()
+        self.client = self._create_client()
+
+    def _create_client(self):
+        client = mqtt.Client(
+            mqtt.CallbackAPIVersion.VERSION2,
+            client_id=self.client_id,
+            protocol=mqtt.MQTTv5,
+            manual_ack=True,
+        )
+        client.on_connect = self.on_connect
+        client.on_message = self.on_message
+        return client
+
+    def connect(self):
+        properties = Properties(PacketTypes.CONNECT)
+        # Сессия переживает переподключение, брокер хранит неподтвержденные QoS 1 сообщения
+        properties.SessionExpiryInterval = 3600
+        properties.ReceiveMaximum = min(self.max_pending, 65535)
+        self.client.connect(self.host, self.port, clean_start=False, properties=properties)
+
+    def on_connect(self, client, userdata, flags, reason_code, properties):
+        logger.info('Ingestor connected to %s:%s (%s)', self.host, self.port, reason_code)
+        subscriptions = topics.subscriptions
+        if self.share_group:
+            subscriptions = [shared_subscription(subscription, self.share_group) for subscription in subscriptions]
+        client.subscribe([(subscription, 1) for subscription in subscriptions])
+
+    def on_message(self, client, userdata, msg):
+        # Вызывается в сетевом потоке paho: только постановка в очередь
+        self._queue.put(IncomingMessage(
+            msg.mid, msg.qos, msg.topic, msg.payload, timezone.now(), bearer_token(msg.properties),
+            content_type_of(msg.properties), source_address(msg.properties),
+        ))
+
+    def authorized(self, message):
+        """ С MQTT_INGEST_REQUIRE_JWT сообщение подписано токеном именно того устройства, чей это топик """
+        if not settings.MQTT_INGEST_REQUIRE_JWT:
+            return True
+        if message.token is None:
+            return False
+        try:
+            claims = token_verifier.verify(message.token)
+        except jwt.InvalidTokenError:
+            return False
+        return claims.get('device') == device_uid_from_topic(message.topic)
+
+    def _collect(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def handle_registrations(self, messages):
+        """ Upsert устройств пачки регистраций; возвращает uid -> (id, кодировка) для ответов устройствам """
+        registrations = parse_registrations(messages)
+        device_ids, created = upsert_devices(registrations)
+        for uid, device_id in device_ids.items():
+            self.devices.add(uid, device_id)
+            self.last_seen.touch(device_id, registrations[uid].received_at)
+        self.stats['registered'] += len(created)
+        return {uid: (device_id, registrations[uid].content_type) for uid, device_id in device_ids.items()}
+
+    def reply_registrations(self, registered):
+        # Ответ публикуется после фиксации транзакции, чтобы устройство не получило id несохраненной записи
+        for uid, (_, content_type) in registered.items():
+            self.client.publish(reply_topic(uid), registration_reply(uid, content_type), qos=1)
+
+    def build_messages(self, messages):
+        """ Сообщения для записи и их разобранное содержимое; отброшенные политиками RBAC пропускаются """
+        uids = {device_uid_from_topic(message.topic) for message in messages}
+        device_ids = self.devices.get_many(uids - {None})
+        host_index = host_policies.get_index()
+        rows = []
+        payloads = []
+        for message in messages:
+            device_id = device_ids.get(device_uid_from_topic(message.topic))
+            if device_id is None:
+                self.stats['unknown'] += 1
+                continue
+            if not self.authorized(message):
+                self.stats['unauthorized'] += 1
+                continue
+            try:
+                text, data = payload_content(message.payload, message.content_type)
+            except ValueError:
+                self.stats['undecodable'] += 1
+                continue
+            if host_index and message.source is None:
+                # Брокер не передал адрес клиента: политики RBACPolicy к сообщению не применить
+                self.stats['unchecked'] += 1
+            elif host_index:
+                match = host_index.match(message.source, self.devices.groups_of(device_id))
+                if match is not None and match.action == DROP:
+                    self.stats['dropped'] += 1
+                    continue
+                if match is not None and match.action == REDIRECT:
+                    # Перенаправление - дело сетевого уровня, прием его не выполняет: сообщение сохраняется
+                    self.stats['redirected'] += 1
+            msg, body = storage_fields(text)
+            rows.append(IoTMessage(
+                device_id=device_id,
+                topic=message.topic,
+                msg=msg,
+                body=body,
+                receive_time=message.received_at,
+            ))
+            payloads.append(data)
+        return rows, payloads
+
+    def write(self, batch):
+        """ Записывает пачку в текущей транзакции; возвращает строки IoTMessage и ответы на регистрации """
+        registrations, data = [], []
+        for message in batch:
+            match = topics.resolve(message.topic)
+            (registrations if match is not None and match.handler == REGISTER else data).append(message)
+        registered = {}
+        if registrations:
+            registered = self.handle_registrations(registrations)
+        rows, payloads = self.build_messages(data)
+        if rows:
+            if supports_copy():
+                copy_insert(IoTMessage, rows, ['device', 'topic', 'msg', 'body', 'receive_time'])
+            else:
+                IoTMessage.objects.bulk_create(rows, batch_size=self.batch_size)
+            for row, payload in zip(rows, payloads):
+                self.rollups.add(row.device_id, row.receive_time, payload)
+            self.rollups.flush()
+        return rows, registered
+
+    def save_spool_offset(self, offset):
+        # Смещение фиксируется вместе с сообщениями: после сбоя ни одна запись спула не повторится
+        SpoolOffset.objects.bulk_create(
+            [SpoolOffset(name=self.client_id, offset=offset)],
+            update_conflicts=True,
+            unique_fields=['name'],
+            update_fields=['offset', 'updated_at'],
+        )
+
+    def publish_live(self, rows):
+        # Страницы устройств (MessageHub) получают только сохраненные сообщения; без подписчиков брокер их не рассылает
+        if not settings.LIVE_STREAM_PUBLISH:
+            return
+        for row in rows:
+            self.client.publish(live_topic(device_uid_from_topic(row.topic)), live_event(row, row.text), qos=0)
+
+    def committed(self, rows, registered):
+        self.reply_registrations(registered)
+        self.publish_live(rows)
+        self.last_seen.touch_many((row.device_id, row.receive_time) for row in rows)
+        self.stats['stored'] += len(rows)
+        self.stats['batches'] += 1
+
+    def store(self, batch, spool_offset=None):
+        with transaction.atomic():
+            rows, registered = self.write(batch)
+            if spool_offset is not None:
+                self.save_spool_offset(spool_offset)
+        self.committed(rows, registered)
+        return rows
+
+    def store_each(self, batch, spool_offset=None):
+        """
+        Сохраняет пачку по одному сообщению, каждое в своей точке сохранения общей транзакции.
+        Сообщения, которые отвергла БД, пропускаются с записью в журнал, а смещение спула
+        фиксируется вместе с остальными: одна битая запись не останавливает прием.
+        """
+        rows, registered = [], {}
+        with transaction.atomic():
+            if connection.vendor == 'postgresql':
+                # Внешние ключи Django отложены до фиксации; здесь нарушение должно откатить только свою точку
+                with connection.cursor() as cursor:
+                    cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+            for message in batch:
+                try:
+                    with transaction.atomic():
+                        message_rows, message_registered = self.write([message])
+                except RECORD_ERRORS:
+                    logger.exception('Rejected message on %s: %r', message.topic, message.payload[:200])
+                    self.stats['rejected'] += 1
+                    continue
+                rows.extend(message_rows)
+                registered.update(message_registered)
+            if spool_offset is not None:
+                self.save_spool_offset(spool_offset)
+        self.committed(rows, registered)
+        return rows
+
+    def save(self, batch, spool_offset=None):
+        """ store(); если БД отвергла данные пачки, сообщения сохраняются по одному """
+        try:
+            return self.store(batch, spool_offset)
+        except RECORD_ERRORS:
+            logger.warning('Database rejected a batch of %s messages, storing them one by one', len(batch))
+            return self.store_each(batch, spool_offset)
+
+    def acknowledge(self, batch):
+        for message in batch:
+            if message.qos > 0:
+                self.client.ack(message.mid, message.qos)
+
+    def stored_spool_offset(self):
+        return SpoolOffset.objects.filter(name=self.client_id).values_list('offset', flat=True).first() or 0
+
+    def open_spool(self, directory=None):
+        offset = None
+        try:
+            close_old_connections()
+            offset = self.stored_spool_offset()
+        except TRANSIENT_ERRORS:
+            logger.exception('Failed to read spool offset')
+        # Спул продолжает смещения из БД, даже если его каталог потерян
+        self.spool = Spool(Path(directory or settings.MQTT_INGEST_SPOOL_DIR) / self.client_id, start=offset or 0)
+        if offset is None and self.spool.created:
+            # Смещение неизвестно, а каталог пуст: все записи нового спула переносятся с его начала
+            self.spool_offset = self.spool.tail
+        else:
+            self.spool_offset = offset
+        logger.info('Spool %s: %s bytes on disk', self.spool.directory, self.spool.pending_bytes(0))
+
+    def drain(self, force=False):
+        """ Переносит спул в БД пачками; пока БД недоступна, попытки повторяются с растущей задержкой """
+        if self.spool is None or (not force and time.monotonic() < self._drain_after):
+            return 0
+        moved = 0
+        try:
+            close_old_connections()
+            if self.spool_offset is None:
+                self.spool_offset = self.stored_spool_offset()
+            if self.spool_offset > self.spool.head:
+                # Смещение из БД впереди спула - его каталог подменен: переносится все, что в нем есть
+                logger.warning('Spool %s is behind stored offset %s, draining from %s',
+                               self.spool.directory, self.spool_offset, self.spool.tail)
+                self.spool_offset = self.spool.tail
+            self.devices.refresh()
+            while True:
+                messages, offset = self.spool.read(self.spool_offset, self.batch_size)
+                if not messages:
+                    break
+                self.save(messages, spool_offset=offset)
+                self.spool_offset = offset
+                self.spool.release(offset)
+                moved += len(messages)
+        except TRANSIENT_ERRORS:
+            logger.exception('Failed to drain spool, retrying in %.1fs', self._drain_delay)
+            self._drain_after = time.monotonic() + self._drain_delay
+            self._drain_delay = min(self._drain_delay * 2, 30)
+            return moved
+        self._drain_delay = 0.5
+        return moved
+
+    def spool_batch(self, batch):
+        """ Пишет пачку в спул и подтверждает ее брокеру после msync """
+        # Спул переполнен: пачка не подтверждается, пока БД не разберет его, и брокер придерживает сообщения
+        while self.spool.pending_bytes(self.spool_offset or 0) > settings.MQTT_INGEST_SPOOL_MAX_BYTES:
+            if self._stopping.is_set():
+                return False
+            if not self.drain(force=True):
+                time.sleep(self._drain_delay)
+        self.spool.append(batch)
+        self.spool.sync()
+        self.stats['spooled'] += len(batch)
+        self.stats['received'] += len(batch)
+        self.acknowledge(batch)
+        self.drain()
+        self.update_last_seen()
+        return True
+
+    def flush(self, batch):
+        """ Сохраняет пачку, повторяя попытку, пока БД недоступна, и только потом подтверждает ее """
+        if self.spool is not None:
+            return self.spool_batch(batch)
+        delay = 0.5
+        while True:
+            try:
+                close_old_connections()
+                self.devices.refresh()
+                self.save(batch)
+                break
+            except TRANSIENT_ERRORS:
+                logger.exception('Failed to store %s messages, retrying in %.1fs', len(batch), delay)
+                if self._stopping.is_set():
+                    return False
+                time.sleep(delay)
+                delay = min(delay * 2, 30)
+        self.stats['received'] += len(batch)
+        self.acknowledge(batch)
+        self.update_last_seen()
+        return True
+
+    def update_last_seen(self, force=False):
+        self.last_seen.publish(force)
+        try:
+            self.last_seen.flush(force)
+        except DatabaseError:
+            logger.exception('Failed to update last_seen, will retry')
+
+    def run(self):
+        if not shared_cache():
+            logger.warning('Cache is local to this process: web processes will see last_seen only from the database')
+        if settings.MQTT_INGEST_SPOOL_ENABLED:
+            self.open_spool()
+            # Со спулом прием работает и без БД: устройства загрузятся при первом переносе
+            self.drain(force=True)
+        else:
+            self.devices.load()
+        logger.info('Loaded %s devices', len(self.devices))
+        self.connect()
+        self.client.loop_start()
+        last_report = time.monotonic()
+        try:
+            while not self._stopping.is_set():
+                batch = self._collect()
+                if batch:
+                    self.flush(batch)
+                else:
+                    self.drain()
+                    self.update_last_seen()
+                if time.monotonic() - last_report >= 10:
+                    logger.info('Ingestion stats: %s, pending %s', self.stats, self._queue.qsize())
+                    last_report = time.monotonic()
+        finally:
+            remaining = []
+            while True:
+                try:
+                    remaining.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if remaining and self.spool is not None:
+                self.spool.append(remaining)
+                self.spool.sync()
+                self.acknowledge(remaining)
+            elif remaining:
+                try:
+                    self.save(remaining)
+                    self.acknowledge(remaining)
+                except DatabaseError:
+                    # Неподтвержденные сообщения брокер доставит повторно при следующем подключении
+                    logger.exception('Failed to store %s messages on shutdown', len(remaining))
+            if self.spool is not None:
+                self.drain(force=True)
+                self.spool.close()
+            self.update_last_seen(force=True)
+            self.client.disconnect()
+            self.client.loop_stop()
+
+    def stop(self):
+        self._stopping.set()
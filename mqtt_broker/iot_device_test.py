@@ -1,3 +1,4 @@
+import argparse
 import paho.mqtt.client as mqtt
 import json
 import time
@@ -9,8 +10,6 @@ DEVICE_ID_2 = "wet-sensor-2"
 DEVICE_ID_3 = "pressure-sensor-3"
 REGISTER_TOPIC = "devices/register"
 
-mqttc = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
-mqttc.connect(BROKER, PORT, 60)
 devices = [
     {
         "device_id": DEVICE_ID_1,
@@ -25,9 +24,75 @@ devices = [
         "device_type": "pressure_sensor"
     },
 ]
-for device in devices:
-    mqttc.publish(REGISTER_TOPIC, json.dumps(device))
-    print(f"Device {device['device_id']} registered!")
+
+
+def register_devices(mqttc, devices):
+    info = None
+    for device in devices:
+        info = mqttc.publish(REGISTER_TOPIC, json.dumps(device), qos=1)
+        print(f"Device {device['device_id']} registered!")
+    return info
+
+
+def generate_load(mqttc, device_ids, rate, duration, qos=1):
+    """Публикует данные датчиков с заданной суммарной частотой (сообщений в секунду)"""
+    total = int(rate * duration)
+    info = None
+    started = time.perf_counter()
+    for i in range(total):
+        device_id = device_ids[i % len(device_ids)]
+        temp_data = {
+            "device_id": device_id,
+            "temperature": 20 + (i % 50) / 10,
+            "sent_at": time.time(),
+        }
+        info = mqttc.publish(f"devices/{device_id}/data", json.dumps(temp_data), qos=qos)
+        # Выравниваем темп публикации по целевой частоте
+        ahead = (i + 1) / rate - (time.perf_counter() - started)
+        if ahead > 0:
+            time.sleep(ahead)
+    elapsed = time.perf_counter() - started
+    print(f"Published {total} messages in {elapsed:.2f}s ({total / elapsed:.0f} msg/s)")
+    return info
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Регистрация тестовых устройств и синтетическая нагрузка")
+    parser.add_argument("--broker", default=BROKER)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--load", action="store_true", help="После регистрации публиковать данные датчиков")
+    parser.add_argument("--devices", type=int, default=len(devices), help="Количество устройств для нагрузки")
+    parser.add_argument("--rate", type=float, default=10000, help="Сообщений в секунду")
+    parser.add_argument("--duration", type=float, default=10, help="Длительность нагрузки, секунд")
+    parser.add_argument("--qos", type=int, default=1, choices=(0, 1))
+    args = parser.parse_args()
+
+    mqttc = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+    # Без ограничения окна QoS 1 публикация упирается в подтверждения брокера
+    mqttc.max_inflight_messages_set(0)
+    mqttc.max_queued_messages_set(0)
+    mqttc.connect(args.broker, args.port, 60)
+    mqttc.loop_start()
+
+    fleet = list(devices)
+    for i in range(len(fleet), args.devices):
+        fleet.append({"device_id": f"load-sensor-{i}", "device_type": "temperature_sensor"})
+    info = register_devices(mqttc, fleet)
+
+    if args.load:
+        # Даем серверу время обработать регистрацию
+        time.sleep(1)
+        info = generate_load(mqttc, [device["device_id"] for device in fleet], args.rate, args.duration, args.qos)
+
+    # Дожидаемся отправки всей очереди публикаций
+    if info is not None:
+        info.wait_for_publish(timeout=60)
+    mqttc.loop_stop()
+    mqttc.disconnect()
+
+
+if __name__ == "__main__":
+    main()
 
 
 # while True:
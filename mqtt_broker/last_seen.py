@@ -0,0 +1,94 @@
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from group_police.models import IoTDevice
+
+logger = logging.getLogger(__name__)
+
+CACHE_KEY = 'last_seen:{}'
+
+
+class LastSeenTracker:
+    """
+    Время последней активности устройств, накапливаемое в памяти.
+
+    Прием сообщений отмечает устройства через touch(), в IoTDevice.last_seen изменения
+    попадают одним bulk_update раз в LAST_SEEN_FLUSH_INTERVAL секунд, а свежие значения
+    раз в LAST_SEEN_PUBLISH_INTERVAL секунд публикуются в кэш для веб-процессов.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latest = {}
+        self._unflushed = set()
+        self._unpublished = set()
+        self._flushed_at = time.monotonic()
+        self._published_at = 0.0
+
+    def touch(self, device_id, seen_at):
+        with self._lock:
+            current = self._latest.get(device_id)
+            if current is None or seen_at > current:
+                self._latest[device_id] = seen_at
+                self._unflushed.add(device_id)
+                self._unpublished.add(device_id)
+
+    def touch_many(self, pairs):
+        for device_id, seen_at in pairs:
+            self.touch(device_id, seen_at)
+
+    def get(self, device_id):
+        return self.get_many([device_id]).get(device_id)
+
+    def get_many(self, device_ids):
+        """ Самые свежие известные значения: из памяти процесса, иначе из кэша """
+        found = {}
+        missing = []
+        for device_id in device_ids:
+            seen_at = self._latest.get(device_id)
+            if seen_at is None:
+                missing.append(device_id)
+            else:
+                found[device_id] = seen_at
+        if missing:
+            cached = cache.get_many([CACHE_KEY.format(device_id) for device_id in missing])
+            for device_id in missing:
+                seen_at = cached.get(CACHE_KEY.format(device_id))
+                if seen_at is not None:
+                    found[device_id] = seen_at
+        return found
+
+    def publish(self, force=False):
+        if not force and time.monotonic() - self._published_at < settings.LAST_SEEN_PUBLISH_INTERVAL:
+            return 0
+        with self._lock:
+            values = {CACHE_KEY.format(device_id): self._latest[device_id] for device_id in self._unpublished}
+            self._unpublished = set()
+            self._published_at = time.monotonic()
+        if values:
+            cache.set_many(values, timeout=settings.LAST_SEEN_FLUSH_INTERVAL * 4)
+        return len(values)
+
+    def flush(self, force=False):
+        """ Записывает накопленные значения в IoTDevice.last_seen одним UPDATE на пачку """
+        if not force and time.monotonic() - self._flushed_at < settings.LAST_SEEN_FLUSH_INTERVAL:
+            return 0
+        with self._lock:
+            devices = [IoTDevice(id=device_id, last_seen=self._latest[device_id]) for device_id in self._unflushed]
+            self._unflushed = set()
+            self._flushed_at = time.monotonic()
+        if devices:
+            try:
+                IoTDevice.objects.bulk_update(devices, ['last_seen'], batch_size=1000)
+            except Exception:
+                with self._lock:
+                    self._unflushed.update(device.id for device in devices)
+                raise
+        return len(devices)
+
+
+last_seen_tracker = LastSeenTracker()
@@ -0,0 +1,124 @@
+import asyncio
+import json
+import logging
+import threading
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+
+import paho.mqtt.client as mqtt
+from django.conf import settings
+from django.utils.dateparse import parse_datetime
+
+from mqtt_broker.routing import TopicRouter
+
+logger = logging.getLogger(__name__)
+
+# Прием публикует сюда сообщения, уже сохраненные в IoTMessage (прошедшие проверку JWT и политик RBAC)
+LIVE = 'live'
+topics = TopicRouter()
+LIVE_TOPIC = topics.add('pdp/live/{uid}', LIVE).subscription
+
+
+def live_topic(uid):
+    return f'pdp/live/{uid}'
+
+
+def live_event(row, text):
+    """ Событие для страниц устройства о сохраненном сообщении """
+    return json.dumps({'topic': row.topic, 'msg': text, 'receive_time': row.receive_time.isoformat()})
+
+
+def _offer(queue, event):
+    # Медленный клиент теряет самые старые события, а не тормозит остальных
+    if queue.full():
+        queue.get_nowait()
+    queue.put_nowait(event)
+
+
+class MessageHub:
+    """
+    Раздача сообщений устройств открытым потокам SSE внутри процесса.
+
+    Процесс держит одну подписку MQTT на LIVE_TOPIC, созданную при первом подписчике,
+    и раскладывает события по asyncio-очередям подписчиков нужного устройства. События
+    публикует прием после фиксации пачки, поэтому на странице только сохраненные сообщения.
+    Сколько бы страниц устройств ни было открыто, нагрузка на брокер и БД не растет.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = defaultdict(set)  # uid устройства -> {(event loop, очередь)}
+        self._client = None
+
+    def start(self):
+        with self._lock:
+            if self._client is not None:
+                return
+            self._client = mqtt.Client(
+                mqtt.CallbackAPIVersion.VERSION2,
+                client_id=f'pdp-live-{uuid.uuid4().hex[:8]}',
+                protocol=mqtt.MQTTv5,
+            )
+        self._client.on_connect = self.on_connect
+        self._client.on_message = self.on_message
+        self._client.connect_async(settings.MQTT_BROKER_HOST, settings.MQTT_BROKER_PORT)
+        self._client.loop_start()
+
+    def stop(self):
+        with self._lock:
+            client, self._client = self._client, None
+        if client is not None:
+            client.loop_stop()
+            client.disconnect()
+
+    def on_connect(self, client, userdata, flags, reason_code, properties):
+        logger.info('Live message hub connected (%s)', reason_code)
+        client.subscribe(LIVE_TOPIC, qos=0)
+
+    def on_message(self, client, userdata, msg):
+        match = topics.resolve(msg.topic)
+        if match is None or not self.subscriber_count(match.params['uid']):
+            return
+        try:
+            event = json.loads(msg.payload)
+            event['receive_time'] = parse_datetime(event['receive_time'])
+        except (ValueError, KeyError, TypeError):
+            logger.warning('Invalid live event on %s', msg.topic)
+            return
+        self.publish(match.params['uid'], event)
+
+    def publish(self, uid, event):
+        """ Передает событие всем подписчикам устройства; можно вызывать из любого потока """
+        with self._lock:
+            subscribers = tuple(self._subscribers.get(uid, ()))
+        for loop, queue in subscribers:
+            try:
+                loop.call_soon_threadsafe(_offer, queue, event)
+            except RuntimeError:
+                # Цикл событий уже закрыт, подписчик удалится сам
+                pass
+
+    def subscriber_count(self, uid=None):
+        with self._lock:
+            if uid is not None:
+                return len(self._subscribers.get(uid, ()))
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+    @contextmanager
+    def subscribe(self, uid):
+        """ Очередь событий устройства для текущего event loop """
+        self.start()
+        entry = (asyncio.get_running_loop(), asyncio.Queue(maxsize=settings.LIVE_STREAM_QUEUE_SIZE))
+        with self._lock:
+            self._subscribers[uid].add(entry)
+        try:
+            yield entry[1]
+        finally:
+            with self._lock:
+                self._subscribers[uid].discard(entry)
+                if not self._subscribers[uid]:
+                    del self._subscribers[uid]
+
+
+message_hub = MessageHub()
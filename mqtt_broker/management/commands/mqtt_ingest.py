@@ -0,0 +1,32 @@
+import signal
+
+from django.core.management.base import BaseCommand
+
+from mqtt_broker.ingest import MessageIngestor
+
+
+class Command(BaseCommand):
+    help = 'Принимает сообщения устройств из MQTT и сохраняет их в IoTMessage'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', help='Адрес MQTT-брокера')
+        parser.add_argument('--port', type=int, help='Порт MQTT-брокера')
+        parser.add_argument('--client-id', help='Идентификатор клиента (постоянная сессия брокера)')
+        parser.add_argument('--batch-size', type=int, help='Максимальный размер пачки для bulk_create')
+        parser.add_argument('--flush-interval', type=float, help='Максимальное ожидание пачки, секунд')
+        parser.add_argument('--max-pending', type=int, help='Размер очереди до включения обратного давления')
+
+    def handle(self, *args, **options):
+        ingestor = MessageIngestor(
+            host=options['host'],
+            port=options['port'],
+            client_id=options['client_id'],
+            batch_size=options['batch_size'],
+            flush_interval=options['flush_interval'],
+            max_pending=options['max_pending'],
+        )
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *args: ingestor.stop())
+        self.stdout.write(f'Ingesting from {ingestor.host}:{ingestor.port}')
+        ingestor.run()
+        self.stdout.write(f'Stopped: {ingestor.stats}')
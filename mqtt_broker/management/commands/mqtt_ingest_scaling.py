@@ -0,0 +1,66 @@
+import os
+import tempfile
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from group_police.models import IoTDevice
+from mqtt_broker.supervisor import SCALING_UID, measure_throughput
+
+
+class Command(BaseCommand):
+    help = ('Измеряет пропускную способность приема сообщений через MQTT-брокер при разном числе процессов '
+            '(общая подписка). Данные пишутся в отдельную тестовую БД')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8], help='Числа процессов')
+        parser.add_argument('--messages', type=int, default=50000, help='Сообщений на замер')
+        parser.add_argument('--devices', type=int, default=1000, help='Устройств, от имени которых публикуются сообщения')
+        parser.add_argument('--host', help='Адрес MQTT-брокера')
+        parser.add_argument('--port', type=int, help='Порт MQTT-брокера')
+        parser.add_argument('--batch-size', type=int, help='Максимальный размер пачки для bulk_create')
+        parser.add_argument('--warmup', type=float, default=5.0, help='Ожидание подписки процессов, секунд')
+        parser.add_argument('--timeout', type=float, default=120.0, help='Максимальная длительность замера, секунд')
+
+    def handle(self, *args, **options):
+        # Тестовая БД SQLite и спулы процессов приема - во временном каталоге, удаляемом после замеров
+        directory = tempfile.TemporaryDirectory(prefix='pdp-scaling-')
+        setup_test_environment()
+        try:
+            if connection.vendor == 'sqlite':
+                # Процессы приема подключаются к тестовой БД сами, поэтому она должна быть файлом, а не :memory:
+                connection.settings_dict['TEST']['NAME'] = os.path.join(directory.name, 'scaling.sqlite3')
+            old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+            try:
+                results = self.measure(options, directory.name)
+            finally:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+        finally:
+            teardown_test_environment()
+            directory.cleanup()
+
+        base = results[0].throughput if results and results[0].throughput else None
+        self.stdout.write(f'{"workers":>8} {"msg/s":>10} {"speedup":>8}')
+        for result in results:
+            speedup = result.throughput / base if base else 0.0
+            self.stdout.write(f'{result.workers:>8} {result.throughput:>10.0f} {speedup:>8.2f}')
+
+    def measure(self, options, directory):
+        IoTDevice.objects.bulk_create(
+            IoTDevice(device_name=SCALING_UID.format(number), uid=SCALING_UID.format(number))
+            for number in range(options['devices'])
+        )
+        results = []
+        for workers in options['workers']:
+            result = measure_throughput(
+                workers, options['messages'], options['devices'],
+                host=options['host'], port=options['port'], batch_size=options['batch_size'],
+                warmup=options['warmup'], timeout=options['timeout'],
+                database_name=connection.settings_dict['NAME'],
+                spool_dir=os.path.join(directory, f'spool-{workers}'),
+            )
+            results.append(result)
+            self.stdout.write(f'{workers} workers: {result.stored}/{result.messages} messages '
+                              f'in {result.seconds:.2f}s, {result.throughput:.0f} msg/s')
+        return results
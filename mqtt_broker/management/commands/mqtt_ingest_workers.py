@@ -0,0 +1,38 @@
+import signal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from mqtt_broker.supervisor import IngestSupervisor
+
+
+class Command(BaseCommand):
+    help = ('Запускает несколько процессов приема сообщений устройств с общей подпиской MQTT '
+            '($share/<группа>/devices/+/data) и перезапускает упавшие')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=settings.MQTT_INGEST_WORKERS, help='Число процессов')
+        parser.add_argument('--group', default=settings.MQTT_INGEST_SHARE_GROUP, help='Группа общей подписки')
+        parser.add_argument('--host', help='Адрес MQTT-брокера')
+        parser.add_argument('--port', type=int, help='Порт MQTT-брокера')
+        parser.add_argument('--client-id', help='Префикс идентификаторов клиентов, к нему добавляется номер процесса')
+        parser.add_argument('--batch-size', type=int, help='Максимальный размер пачки для bulk_create')
+        parser.add_argument('--flush-interval', type=float, help='Максимальное ожидание пачки, секунд')
+        parser.add_argument('--max-pending', type=int, help='Размер очереди процесса до включения обратного давления')
+
+    def handle(self, *args, **options):
+        supervisor = IngestSupervisor(
+            workers=options['workers'],
+            share_group=options['group'],
+            host=options['host'],
+            port=options['port'],
+            client_id=options['client_id'],
+            batch_size=options['batch_size'],
+            flush_interval=options['flush_interval'],
+            max_pending=options['max_pending'],
+        )
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *args: supervisor.request_stop())
+        self.stdout.write(f'Starting {len(supervisor.workers)} ingest workers, group {supervisor.share_group}')
+        supervisor.run()
+        self.stdout.write(f'Stopped, {supervisor.restarts} restarts')
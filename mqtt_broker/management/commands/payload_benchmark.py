@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+
+from group_police.jwt_token import create_access_token
+from mqtt_broker import codec
+from mqtt_broker.payload_benchmark import bench_codecs, bench_storage, device_responses, sensor_readings
+
+
+class Command(BaseCommand):
+    help = ('Сравнивает JSON, MessagePack и CBOR на типичных сообщениях устройств: байты на проводе, '
+            'время кодирования и разбора, а также размер хранения текста сообщений со сжатием и без')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=10000, help='Сообщений каждого вида')
+
+    def handle(self, *args, **options):
+        count = options['messages']
+        samples = {
+            'sensor reading': sensor_readings(count),
+            'device response': device_responses(count, create_access_token(1)),
+        }
+        missing = {codec.MSGPACK: 'msgpack', codec.CBOR: 'cbor2'}
+        for content_type, package in missing.items():
+            if content_type not in codec.supported():
+                self.stdout.write(self.style.WARNING(f'{content_type} skipped: {package} is not installed'))
+
+        self.stdout.write(f'{"content type":<22} {"message":<16} {"bytes":>8} {"encode us":>10} {"decode us":>10}')
+        for result in bench_codecs(samples):
+            self.stdout.write(f'{result.content_type:<22} {result.kind:<16} {result.bytes:>8.1f} '
+                              f'{result.encode_us:>10.2f} {result.decode_us:>10.2f}')
+
+        self.stdout.write('')
+        self.stdout.write(f'{"stored message":<16} {"text bytes":>10} {"stored bytes":>12} {"ratio":>6} {"compress us":>12}')
+        for result in bench_storage(samples):
+            self.stdout.write(f'{result.kind:<16} {result.text_bytes:>10.1f} {result.stored_bytes:>12.1f} '
+                              f'{result.stored_bytes / result.text_bytes:>6.2f} {result.compress_us:>12.2f}')
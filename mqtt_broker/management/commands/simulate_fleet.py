@@ -0,0 +1,100 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from group_police.models import IoTDevice
+from mqtt_broker import codec
+from mqtt_broker.fleet import FleetConfig, IngestionProbe, device_uid, run_fleet
+
+
+def _ms(value):
+    return f'{value * 1000:.1f}' if value is not None else '-'
+
+
+class Command(BaseCommand):
+    help = ('Симулятор парка виртуальных устройств: десятки тысяч соединений MQTT из одного цикла событий '
+            '(или нескольких процессов) с заданной частотой публикации, видом сообщений, волной регистраций '
+            'и переподключениями. Показывает достигнутую частоту и задержку до записи в IoTMessage')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--devices', type=int, default=1000, help='Число виртуальных устройств')
+        parser.add_argument('--rate', type=float, default=1000.0, help='Сообщений в секунду на весь парк')
+        parser.add_argument('--duration', type=float, default=30.0, help='Длительность публикации, секунд')
+        parser.add_argument('--shape', choices=['minimal', 'sensor', 'response'], default='sensor',
+                            help='Вид сообщений')
+        parser.add_argument('--qos', type=int, choices=[0, 1], default=1)
+        parser.add_argument('--content-type', default=codec.JSON, choices=codec.supported(),
+                            help='Кодировка, предлагаемая устройствами при регистрации')
+        parser.add_argument('--no-register', action='store_true',
+                            help='Не регистрировать устройства через MQTT: они создаются в БД заранее')
+        parser.add_argument('--storm', action='store_true',
+                            help='Все устройства подключаются и регистрируются одновременно')
+        parser.add_argument('--ramp', type=float, default=5.0, help='Время подключения парка без --storm, секунд')
+        parser.add_argument('--churn', type=float, default=0.0,
+                            help='Доля устройств, отключающихся и переподключающихся за минуту')
+        parser.add_argument('--processes', type=int, default=1, help='Процессов симулятора')
+        parser.add_argument('--prefix', default='fleet', help='Префикс uid виртуальных устройств')
+        parser.add_argument('--host', help='Адрес MQTT-брокера')
+        parser.add_argument('--port', type=int, help='Порт MQTT-брокера')
+        parser.add_argument('--drain', type=float, default=10.0,
+                            help='Ожидание записи оставшихся сообщений после публикации, секунд')
+
+    def handle(self, *args, **options):
+        if options['devices'] < 1 or options['rate'] <= 0:
+            raise CommandError('--devices and --rate must be positive')
+        config = FleetConfig(
+            host=options['host'] or settings.MQTT_BROKER_HOST,
+            port=options['port'] or settings.MQTT_BROKER_PORT,
+            devices=options['devices'],
+            rate=options['rate'],
+            duration=options['duration'],
+            shape=options['shape'],
+            qos=options['qos'],
+            content_type=options['content_type'],
+            register=not options['no_register'],
+            storm=options['storm'],
+            ramp=options['ramp'],
+            churn=options['churn'],
+            prefix=options['prefix'],
+        )
+        if not config.register:
+            IoTDevice.objects.bulk_create(
+                [
+                    IoTDevice(device_name=device_uid(config, number), uid=device_uid(config, number),
+                              device_type=f'{config.prefix}_{config.shape}')
+                    for number in range(config.devices)
+                ],
+                batch_size=1000,
+                ignore_conflicts=True,
+            )
+
+        probe = IngestionProbe(config.prefix)
+        probe.start()
+        try:
+            stats = run_fleet(config, options['processes'])
+            deadline = time.monotonic() + options['drain']
+            while probe.stored < stats.published and time.monotonic() < deadline:
+                time.sleep(0.2)
+        finally:
+            probe.stop()
+
+        self.stdout.write(f'devices: {config.devices}, connections: {stats.connections}, '
+                          f'connect errors: {stats.connect_errors}, reconnects: {stats.reconnects}, '
+                          f'failed: {stats.failed}, protocol errors: {stats.protocol_errors}')
+        if config.register:
+            self.stdout.write(f'registered: {stats.registered}, timeouts: {stats.registration_timeouts}, '
+                              f'bad replies: {stats.registration_errors}, '
+                              f'latency p50 {_ms(stats.registration_latency.percentile(0.5))} ms, '
+                              f'p99 {_ms(stats.registration_latency.percentile(0.99))} ms')
+        self.stdout.write(f'published: {stats.published} in {stats.seconds:.1f}s, '
+                          f'{stats.rate:.0f} msg/s (target {config.rate:.0f})')
+        if config.qos:
+            self.stdout.write(f'PUBACK latency p50 {_ms(stats.ack_latency.percentile(0.5))} ms, '
+                              f'p99 {_ms(stats.ack_latency.percentile(0.99))} ms')
+        self.stdout.write(f'stored: {probe.stored}/{stats.published}')
+        self.stdout.write(f'{"latency, ms":<20} {"p50":>8} {"p95":>8} {"p99":>8} {"max":>8}')
+        for name, samples in (('to ingestor', probe.ingest_latency), ('to IoTMessage', probe.stored_latency)):
+            self.stdout.write(f'{name:<20} ' + ' '.join(
+                f'{_ms(samples.percentile(fraction)):>8}' for fraction in (0.5, 0.95, 0.99, 1.0)
+            ))
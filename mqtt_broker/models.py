@@ -1,3 +1,15 @@
 from django.db import models
 
-# Create your models here.
+
+class SpoolOffset(models.Model):
+    """ Смещение в спуле процесса приема, до которого сообщения уже записаны в IoTMessage """
+    name = models.CharField(max_length=100, primary_key=True)
+    offset = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = 'Смещение спула приема'
+        verbose_name_plural = 'Смещения спула приема'
+
+    def __str__(self):
+        return f'{self.name}: {self.offset}'
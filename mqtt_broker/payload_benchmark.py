@@ -0,0 +1,90 @@
+import random
+import time
+import uuid
+from typing import NamedTuple
+
+from group_police.compression import storage_fields
+from mqtt_broker import codec
+
+
+class PayloadResult(NamedTuple):
+    content_type: str
+    kind: str
+    bytes: float  # средний размер сообщения на проводе
+    encode_us: float
+    decode_us: float  # разбор на сервере вместе с переводом в текст для хранения
+
+
+class StorageResult(NamedTuple):
+    kind: str
+    text_bytes: float  # средний размер текста в msg без сжатия
+    stored_bytes: float  # средний размер msg или body после storage_fields
+    compress_us: float
+
+
+def sensor_readings(count, seed=0):
+    """ Показания датчиков, похожие на реальные: идентификатор, несколько чисел с плавающей точкой, время """
+    rnd = random.Random(seed)
+    started = time.time()
+    return [
+        {
+            'device_id': f'temperature-sensor-{rnd.randrange(1000)}',
+            'temperature': round(rnd.uniform(15, 30), 2),
+            'humidity': round(rnd.uniform(20, 80), 1),
+            'pressure': round(rnd.uniform(980, 1040), 2),
+            'battery': round(rnd.uniform(3.3, 4.2), 2),
+            'rssi': rnd.randrange(-90, -40),
+            'sent_at': started + number * 0.5,
+        }
+        for number in range(count)
+    ]
+
+
+def device_responses(count, token, seed=0):
+    """ Ответы устройства на команды: данные устройства и JWT в каждом сообщении """
+    rnd = random.Random(seed)
+    return [
+        {
+            'device_data': {
+                'mac': ':'.join(f'{rnd.randint(0, 255):02x}' for _ in range(6)),
+                'ip': '.'.join(str(rnd.randint(0, 255)) for _ in range(4)),
+                'serial': uuid.UUID(int=rnd.getrandbits(128)).hex,
+            },
+            'jwt': token,
+            'message': 'Processing your request',
+        }
+        for _ in range(count)
+    ]
+
+
+def _timed(function, items):
+    started = time.perf_counter()
+    results = [function(item) for item in items]
+    return results, (time.perf_counter() - started) / len(items) * 1e6
+
+
+def bench_codecs(samples):
+    """ Размер и стоимость кодирования и разбора для каждой доступной кодировки; samples: вид -> сообщения """
+    results = []
+    for content_type in codec.supported():
+        for kind, messages in samples.items():
+            payloads, encode_us = _timed(lambda data: codec.encode(data, content_type), messages)
+            _, decode_us = _timed(lambda payload: codec.payload_content(payload, content_type), payloads)
+            size = sum(len(payload) for payload in payloads) / len(payloads)
+            results.append(PayloadResult(content_type, kind, size, encode_us, decode_us))
+    return results
+
+
+def bench_storage(samples):
+    """ Размер текста сообщения в IoTMessage без сжатия и со сжатием (zlib с предустановленным словарем) """
+    results = []
+    for kind, messages in samples.items():
+        texts = [codec.payload_content(codec.encode(data))[0] for data in messages]
+        stored, compress_us = _timed(storage_fields, texts)
+        results.append(StorageResult(
+            kind,
+            sum(len(text.encode('utf-8')) for text in texts) / len(texts),
+            sum(len(body) if body is not None else len(msg.encode('utf-8')) for msg, body in stored) / len(texts),
+            compress_us,
+        ))
+    return results
@@ -0,0 +1,102 @@
+import json
+import logging
+from typing import NamedTuple
+
+from django.conf import settings
+
+from group_police.audit import audit_log
+from group_police.jwt_token import create_device_token
+from group_police.models import IoTDevice, IoTDeviceLog
+from mqtt_broker.codec import JSON, decode, negotiate
+from mqtt_broker.dispatch import command_topic
+
+logger = logging.getLogger(__name__)
+
+REPLY_TOPIC = 'devices/{uid}/register'
+
+
+class Registration(NamedTuple):
+    uid: str
+    device_type: str
+    received_at: object
+    content_type: str = JSON  # кодировка сообщений, выбранная из предложенных устройством в accept
+
+
+def valid_uid(uid):
+    """ uid должен быть непустой строкой, допустимой как уровень топика MQTT, и помещаться в IoTDevice.uid """
+    return (
+        isinstance(uid, str)
+        and 0 < len(uid) <= IoTDevice._meta.get_field('uid').max_length
+        and not any(char in uid for char in '/+#\0')
+    )
+
+
+def reply_topic(uid):
+    return REPLY_TOPIC.format(uid=uid)
+
+
+def parse_registrations(messages):
+    """ Регистрации из пачки сообщений devices/register; повторы одного устройства схлопываются """
+    registrations = {}
+    for message in messages:
+        try:
+            data = decode(message.payload, message.content_type)
+            uid = data['device_id']
+            if not valid_uid(uid):
+                raise ValueError(f'Invalid device id: {uid!r}')
+            registrations[uid] = Registration(
+                uid, data.get('device_type'), message.received_at, negotiate(data.get('accept')),
+            )
+        except (ValueError, KeyError, TypeError):
+            logger.warning('Invalid registration message: %r', message.payload[:200])
+    return registrations
+
+
+def upsert_devices(registrations, batch_size=500):
+    """
+    Создает или обновляет IoTDevice для пачки регистраций одним upsert по uid.
+
+    Возвращает uid -> id и множество uid новых устройств. bulk_create не вызывает post_save,
+    поэтому записи журнала о новых устройствах пишутся здесь же одной пачкой.
+    """
+    if not registrations:
+        return {}, set()
+    existing = set(IoTDevice.objects.filter(uid__in=registrations).values_list('uid', flat=True))
+    IoTDevice.objects.bulk_create(
+        [
+            IoTDevice(
+                uid=registration.uid,
+                device_name=registration.uid,
+                device_type=registration.device_type,
+                last_seen=registration.received_at,
+            )
+            for registration in registrations.values()
+        ],
+        batch_size=batch_size,
+        update_conflicts=True,
+        unique_fields=['uid'],
+        update_fields=['device_type', 'last_seen'],
+    )
+    device_ids = dict(IoTDevice.objects.filter(uid__in=registrations).values_list('uid', 'id'))
+    created = set(registrations) - existing
+    for uid in created:
+        audit_log.write(IoTDeviceLog(
+            status='created',
+            device_id=device_ids[uid],
+            description=f'Устройство с идентификатором [{uid}] было добавлено в систему'
+        ))
+    return device_ids, created
+
+
+def registration_reply(uid, content_type=JSON):
+    """
+    Ответ устройству (всегда JSON): топик команд, JWT для подписи его сообщений, срок JWT в секундах
+    и кодировка сообщений. До истечения срока устройство регистрируется повторно и получает новый JWT
+    """
+    return json.dumps({
+        'device_id': uid,
+        'subscribe_topic': command_topic(uid),
+        'jwt': create_device_token(uid),
+        'expires_in': settings.DEVICE_TOKEN_LIFETIME,
+        'content_type': content_type,
+    })
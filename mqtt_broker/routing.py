@@ -0,0 +1,148 @@
+from typing import Any, NamedTuple
+
+# Вес уровня шаблона: точное совпадение, один уровень (+ или {имя}), все оставшиеся уровни (#).
+# Шаблон без # завершается END, поэтому a/b точнее, чем a/b/#
+LITERAL, SINGLE, MULTI = 2, 1, 0
+END = 1
+
+
+def shared_subscription(topic_filter, group):
+    """ Общая подписка MQTT v5: брокер раздает сообщения фильтра между клиентами группы по одному """
+    return f'$share/{group}/{topic_filter}'
+
+
+class Route(NamedTuple):
+    pattern: str
+    handler: Any
+    params: tuple  # (номер уровня, имя параметра) для {имя}
+    specificity: tuple  # веса уровней, чем больше, тем точнее шаблон
+    order: int  # порядок добавления
+
+    @property
+    def subscription(self):
+        """ Фильтр подписки MQTT: {имя} заменяется на + """
+        return '/'.join('+' if level.startswith('{') else level for level in self.pattern.split('/'))
+
+
+class RouteMatch(NamedTuple):
+    route: Route
+    params: dict
+
+    @property
+    def handler(self):
+        return self.route.handler
+
+
+class _Node:
+    __slots__ = ('children', 'single', 'routes', 'multi_routes')
+
+    def __init__(self):
+        self.children = {}
+        self.single = None
+        self.routes = []  # шаблоны, заканчивающиеся на этом уровне
+        self.multi_routes = []  # шаблоны с # на следующем уровне
+
+
+def parse_pattern(pattern):
+    """ Уровни шаблона и имена параметров; ValueError для некорректного фильтра MQTT """
+    levels = pattern.split('/')
+    params = []
+    specificity = []
+    for index, level in enumerate(levels):
+        if level == '#':
+            if index != len(levels) - 1:
+                raise ValueError(f'"#" must be the last level: {pattern}')
+            specificity.append(MULTI)
+        elif level == '+' or (level.startswith('{') and level.endswith('}')):
+            if level != '+':
+                params.append((index, level[1:-1]))
+            specificity.append(SINGLE)
+        elif '+' in level or '#' in level or '{' in level:
+            raise ValueError(f'Wildcard must occupy a whole level: {pattern}')
+        else:
+            specificity.append(LITERAL)
+    if levels[-1] != '#':
+        specificity.append(END)
+    return levels, tuple(params), tuple(specificity)
+
+
+class TopicRouter:
+    """
+    Маршрутизация сообщений MQTT по шаблонам подписок.
+
+    Шаблоны (+, # и именованные уровни {uid}) компилируются в дерево по уровням топика,
+    поэтому поиск обработчиков стоит порядка глубины топика, а не числа шаблонов.
+    Как и в MQTT, топики на $ не совпадают с шаблонами, начинающимися с + или #.
+    """
+
+    def __init__(self):
+        self._root = _Node()
+        self._routes = []
+
+    def add(self, pattern, handler):
+        levels, params, specificity = parse_pattern(pattern)
+        route = Route(pattern, handler, params, specificity, len(self._routes))
+        node = self._root
+        for level in levels:
+            if level == '#':
+                node.multi_routes.append(route)
+                break
+            if level == '+' or level.startswith('{'):
+                if node.single is None:
+                    node.single = _Node()
+                node = node.single
+            else:
+                node = node.children.setdefault(level, _Node())
+        else:
+            node.routes.append(route)
+        self._routes.append(route)
+        return route
+
+    def route(self, pattern):
+        """ Декоратор: router.route('devices/{uid}/data') над обработчиком """
+        def decorator(handler):
+            self.add(pattern, handler)
+            return handler
+        return decorator
+
+    @property
+    def subscriptions(self):
+        return [route.subscription for route in self._routes]
+
+    def match(self, topic):
+        """ Все подходящие шаблоны в порядке добавления с параметрами из топика """
+        levels = topic.split('/')
+        found = []
+        stack = [(self._root, 0)]
+        while stack:
+            node, depth = stack.pop()
+            # Шаблон a/# совпадает и с самим a
+            if node.multi_routes and not (depth == 0 and topic.startswith('$')):
+                found.extend(node.multi_routes)
+            if depth == len(levels):
+                found.extend(node.routes)
+                continue
+            child = node.children.get(levels[depth])
+            if child is not None:
+                stack.append((child, depth + 1))
+            if node.single is not None and not (depth == 0 and topic.startswith('$')):
+                stack.append((node.single, depth + 1))
+        found.sort(key=lambda route: route.order)
+        return [RouteMatch(route, {name: levels[index] for index, name in route.params}) for route in found]
+
+    def resolve(self, topic):
+        """ Самый точный подходящий шаблон (при равенстве - добавленный раньше) или None """
+        matches = self.match(topic)
+        if not matches:
+            return None
+        return max(matches, key=lambda match: match.route.specificity)
+
+    def dispatch(self, topic, *args, **kwargs):
+        """ Вызывает все подходящие обработчики: handler(*args, **kwargs, **параметры); возвращает число вызовов """
+        matches = self.match(topic)
+        for match in matches:
+            match.handler(*args, **kwargs, **match.params)
+        return len(matches)
+
+    def __len__(self):
+        return len(self._routes)
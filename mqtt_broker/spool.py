@@ -0,0 +1,216 @@
+import logging
+import mmap
+import os
+import struct
+import zlib
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Запись: длина тела и его crc32, затем время приема, длины топика, токена, Content Type и сообщения и сами данные
+# (строки в UTF-8; строка MQTT не длиннее 65535 байт, поэтому 16-битных длин достаточно).
+# Остаток тела после сообщения - адрес клиента (в записях прежнего формата его нет).
+# Сегмент заранее заполнен нулями, поэтому нулевая длина означает конец записанных данных
+RECORD_HEADER = struct.Struct('<II')
+BODY_HEADER = struct.Struct('<dHHHI')
+SEGMENT_SUFFIX = '.seg'
+
+
+def encode_message(message):
+    topic = message.topic.encode('utf-8')
+    token = (message.token or '').encode('utf-8')
+    content_type = (message.content_type or '').encode('utf-8')
+    body = BODY_HEADER.pack(
+        message.received_at.timestamp(), len(topic), len(token), len(content_type), len(message.payload),
+    )
+    body += topic + token + content_type + message.payload + (message.source or '').encode('ascii')
+    return RECORD_HEADER.pack(len(body), zlib.crc32(body)) + body
+
+
+def decode_message(body):
+    from mqtt_broker.ingest import IncomingMessage
+
+    received_at, topic_length, token_length, content_type_length, payload_length = BODY_HEADER.unpack_from(body)
+    start = BODY_HEADER.size
+    topic = body[start:start + topic_length].decode('utf-8')
+    start += topic_length
+    token = body[start:start + token_length].decode('utf-8') or None
+    start += token_length
+    content_type = body[start:start + content_type_length].decode('utf-8') or None
+    start += content_type_length
+    payload = bytes(body[start:start + payload_length])
+    source = body[start + payload_length:].decode('ascii') or None
+    # Сообщение уже подтверждено брокеру при записи в спул, поэтому mid и qos не нужны
+    return IncomingMessage(
+        0, 0, topic, payload, datetime.fromtimestamp(received_at, dt_timezone.utc), token, content_type, source,
+    )
+
+
+class Segment:
+    """ Файл фиксированного размера, отображенный в память; имя - смещение его начала в спуле """
+
+    def __init__(self, path, base, capacity=None):
+        self.path = path
+        self.base = base
+        exists = os.path.exists(path)
+        self._file = open(path, 'r+b' if exists else 'w+b')
+        if not exists:
+            self._file.truncate(capacity)
+        self.capacity = os.fstat(self._file.fileno()).st_size
+        self._map = mmap.mmap(self._file.fileno(), self.capacity)
+        self.position = 0
+
+    @property
+    def end(self):
+        return self.base + self.capacity
+
+    def read(self, position):
+        """ (тело записи, позиция следующей) или None в конце данных и на оборванной записи """
+        if position + RECORD_HEADER.size > self.capacity:
+            return None
+        length, checksum = RECORD_HEADER.unpack_from(self._map, position)
+        start = position + RECORD_HEADER.size
+        if length == 0 or start + length > self.capacity:
+            return None
+        body = self._map[start:start + length]
+        if zlib.crc32(body) != checksum:
+            return None
+        return body, start + length
+
+    def recover(self):
+        """ Находит конец записанных данных; хвост оборванной при сбое записи затирается нулями """
+        position = 0
+        while True:
+            record = self.read(position)
+            if record is None:
+                break
+            position = record[1]
+        self.position = position
+        header = self._map[position:position + RECORD_HEADER.size]
+        if header.strip(b'\0'):
+            logger.warning('Truncating torn record in %s at %s', self.path, position)
+            self._map[position:] = bytes(self.capacity - position)
+        return position
+
+    def append(self, record):
+        if self.position + len(record) > self.capacity:
+            return False
+        self._map[self.position:self.position + len(record)] = record
+        self.position += len(record)
+        return True
+
+    def sync(self):
+        self._map.flush()
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+class Spool:
+    """
+    Упреждающий журнал приема сообщений: сегменты, отображенные в память, только дописываются.
+
+    Прием пишет пачку в спул, одним msync делает ее надежной и только после этого
+    подтверждает QoS 1 брокеру. Из спула сообщения переносятся в IoTMessage пачками, когда
+    БД доступна; смещение прочитанного сохраняется в той же транзакции, что и сами сообщения
+    (SpoolOffset), поэтому после сбоя каждая запись переносится ровно один раз.
+    Сегменты, целиком перенесенные в БД, удаляются. Пустой спул начинается со смещения start -
+    сохраненного в БД, чтобы после потери каталога смещения новых записей не оказались позади него.
+    """
+
+    def __init__(self, directory, segment_size=None, start=0):
+        self.directory = str(directory)
+        self.segment_size = segment_size or settings.MQTT_INGEST_SPOOL_SEGMENT_SIZE
+        self.start = start
+        os.makedirs(self.directory, exist_ok=True)
+        self._segments = []
+        for name in sorted(os.listdir(self.directory)):
+            if name.endswith(SEGMENT_SUFFIX):
+                base = int(name[:-len(SEGMENT_SUFFIX)])
+                self._segments.append(Segment(os.path.join(self.directory, name), base))
+        for segment in self._segments[:-1]:
+            segment.position = segment.capacity
+        if self._segments:
+            self._segments[-1].recover()
+        self.created = not self._segments  # каталог был пуст: спул начат заново
+        self._dirty = False
+
+    @property
+    def head(self):
+        """ Смещение, с которого будет записана следующая запись """
+        if not self._segments:
+            return self.start
+        last = self._segments[-1]
+        return last.base + last.position
+
+    @property
+    def tail(self):
+        """ Смещение начала самого старого сегмента на диске """
+        return self._segments[0].base if self._segments else self.start
+
+    def _new_segment(self, min_capacity):
+        base = self._segments[-1].end if self._segments else self.start
+        path = os.path.join(self.directory, f'{base:020d}{SEGMENT_SUFFIX}')
+        segment = Segment(path, base, max(self.segment_size, min_capacity + RECORD_HEADER.size))
+        # Новый файл должен пережить сбой вместе с записями в нем
+        directory = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        self._segments.append(segment)
+        return segment
+
+    def append(self, messages):
+        """ Дописывает сообщения; надежными они становятся после sync() """
+        for message in messages:
+            record = encode_message(message)
+            if not self._segments or not self._segments[-1].append(record):
+                if self._segments:
+                    self._segments[-1].sync()
+                self._new_segment(len(record)).append(record)
+            self._dirty = True
+
+    def sync(self):
+        if self._dirty:
+            self._segments[-1].sync()
+            self._dirty = False
+
+    def read(self, offset, limit):
+        """ До limit сообщений начиная со смещения offset и смещение после последнего из них """
+        messages = []
+        offset = max(offset, self.tail)
+        for segment in self._segments:
+            if segment.end <= offset:
+                continue
+            position = max(offset - segment.base, 0)
+            while len(messages) < limit:
+                record = segment.read(position) if position < segment.position else None
+                if record is None:
+                    break
+                body, position = record
+                messages.append(decode_message(body))
+            if len(messages) >= limit or segment is self._segments[-1]:
+                return messages, segment.base + position
+            # Сегмент дочитан до конца данных, дальше - следующий
+            offset = segment.end
+        return messages, offset
+
+    def release(self, offset):
+        """ Удаляет сегменты, целиком перенесенные в БД; последний сегмент остается для записи """
+        while len(self._segments) > 1 and self._segments[0].end <= offset:
+            segment = self._segments.pop(0)
+            segment.close()
+            os.remove(segment.path)
+
+    def pending_bytes(self, offset):
+        return self.head - max(offset, self.tail)
+
+    def close(self):
+        self.sync()
+        for segment in self._segments:
+            segment.close()
+        self._segments = []
@@ -0,0 +1,200 @@
+import json
+import logging
+import multiprocessing
+import signal
+import time
+import uuid
+from typing import NamedTuple
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+SCALING_UID = 'scaling-{}'
+
+# Процесс, проработавший дольше, считается стабильным: задержка перезапуска сбрасывается
+STABLE_UPTIME = 60
+
+
+def run_worker(index, options, database_name=None, spool_dir=None):
+    """ Точка входа процесса приема: собственное соединение MQTT и БД, остановка по SIGTERM """
+    import django
+    django.setup()
+    if database_name:
+        settings.DATABASES['default']['NAME'] = database_name
+    if spool_dir:
+        settings.MQTT_INGEST_SPOOL_DIR = spool_dir
+    from mqtt_broker.ingest import MessageIngestor
+
+    options = dict(options)
+    options['client_id'] = f'{options.get("client_id") or settings.MQTT_INGEST_CLIENT_ID}-{index}'
+    ingestor = MessageIngestor(**options)
+    # Ctrl+C получает вся группа процессов; останавливает процессы приема супервизор
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda *args: ingestor.stop())
+    ingestor.run()
+    logger.info('Worker %s stopped: %s', index, ingestor.stats)
+
+
+class Worker:
+    def __init__(self, index):
+        self.index = index
+        self.process = None
+        self.started_at = 0.0
+        self.restarts = 0
+        self.delay = settings.MQTT_INGEST_RESTART_DELAY
+        self.restart_at = None
+
+
+class IngestSupervisor:
+    """
+    N процессов приема сообщений с общей подпиской MQTT v5: брокер раздает сообщения
+    между ними, и каждый пишет свои пачки в IoTMessage независимо от GIL остальных.
+
+    Упавший процесс перезапускается; при повторных падениях задержка перед
+    перезапуском удваивается до MQTT_INGEST_RESTART_MAX_DELAY.
+    """
+
+    def __init__(self, workers=None, share_group=None, database_name=None, spool_dir=None, **options):
+        self.share_group = share_group or settings.MQTT_INGEST_SHARE_GROUP
+        self.options = dict(options, share_group=self.share_group)
+        self.database_name = database_name
+        self.spool_dir = spool_dir
+        self.workers = [Worker(index) for index in range(workers or settings.MQTT_INGEST_WORKERS)]
+        # spawn: дочерний процесс не наследует соединения с БД и потоки родителя
+        self._context = multiprocessing.get_context('spawn')
+        self._stopping = False
+
+    def _spawn(self, worker):
+        worker.process = self._context.Process(
+            target=run_worker,
+            args=(worker.index, self.options, self.database_name, self.spool_dir),
+            name=f'mqtt-ingest-{worker.index}',
+            daemon=False,
+        )
+        worker.process.start()
+        worker.started_at = time.monotonic()
+        worker.restart_at = None
+        logger.info('Started ingest worker %s (pid %s)', worker.index, worker.process.pid)
+
+    def start(self):
+        connections.close_all()
+        for worker in self.workers:
+            self._spawn(worker)
+
+    def poll(self):
+        """ Перезапускает завершившиеся процессы; возвращает число живых """
+        now = time.monotonic()
+        for worker in self.workers:
+            process = worker.process
+            if process is not None and process.is_alive():
+                continue
+            if worker.restart_at is None:
+                if now - worker.started_at >= STABLE_UPTIME:
+                    worker.delay = settings.MQTT_INGEST_RESTART_DELAY
+                logger.warning('Ingest worker %s exited with code %s, restarting in %ss',
+                               worker.index, process.exitcode if process else None, worker.delay)
+                worker.restart_at = now + worker.delay
+                worker.delay = min(worker.delay * 2, settings.MQTT_INGEST_RESTART_MAX_DELAY)
+            elif now >= worker.restart_at and not self._stopping:
+                worker.restarts += 1
+                self._spawn(worker)
+        return sum(1 for worker in self.workers if worker.process is not None and worker.process.is_alive())
+
+    def stop(self, timeout=30):
+        """ SIGTERM всем процессам: они дописывают очередь и подтверждают сообщения; зависшие убиваются """
+        self._stopping = True
+        processes = [worker.process for worker in self.workers if worker.process is not None]
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + timeout
+        for process in processes:
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                logger.error('Ingest worker %s did not stop, killing', process.name)
+                process.kill()
+                process.join()
+
+    def run(self, interval=1.0):
+        self.start()
+        try:
+            while not self._stopping:
+                self.poll()
+                time.sleep(interval)
+        finally:
+            self.stop()
+
+    def request_stop(self):
+        self._stopping = True
+
+    @property
+    def restarts(self):
+        return sum(worker.restarts for worker in self.workers)
+
+
+class ScalingResult(NamedTuple):
+    workers: int
+    messages: int
+    stored: int
+    seconds: float
+
+    @property
+    def throughput(self):
+        return self.stored / self.seconds if self.seconds else 0.0
+
+
+def publish_messages(count, devices, host, port, qos=1):
+    """ Публикует count сообщений устройств scaling-<n> по кругу и ждет подтверждения всех """
+    import paho.mqtt.client as mqtt
+
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, protocol=mqtt.MQTTv5)
+    client.max_inflight_messages_set(1000)
+    client.max_queued_messages_set(0)
+    client.connect(host, port)
+    client.loop_start()
+    try:
+        infos = []
+        for number in range(count):
+            payload = json.dumps({'temperature': 20 + number % 10, 'sent_at': time.time()})
+            infos.append(client.publish(f'devices/{SCALING_UID.format(number % devices)}/data', payload, qos=qos))
+        for info in infos:
+            info.wait_for_publish()
+    finally:
+        client.disconnect()
+        client.loop_stop()
+
+
+def measure_throughput(workers, messages, devices, host=None, port=None, warmup=5.0, timeout=120.0,
+                       database_name=None, spool_dir=None, **options):
+    """
+    Пропускная способность приема при заданном числе процессов: время от начала публикации
+    до записи последнего сообщения в IoTMessage. Устройства scaling-<n> должны существовать.
+    """
+    from group_police.models import IoTMessage
+
+    host = host or settings.MQTT_BROKER_HOST
+    port = port or settings.MQTT_BROKER_PORT
+    IoTMessage.objects.filter(device__uid__startswith=SCALING_UID.format('')).delete()
+    # Новые группа и клиенты на каждый замер: постоянные сессии прошлых замеров не забирают сообщения
+    run_id = uuid.uuid4().hex[:8]
+    supervisor = IngestSupervisor(
+        workers=workers, share_group=f'pdp-scaling-{run_id}', database_name=database_name, spool_dir=spool_dir,
+        host=host, port=port, client_id=f'pdp-scaling-{run_id}', **options,
+    )
+    supervisor.start()
+    try:
+        # Сообщения, опубликованные до подписки процессов, брокер никому не доставит
+        time.sleep(warmup)
+        started = time.monotonic()
+        publish_messages(messages, devices, host, port)
+        stored = 0
+        while time.monotonic() - started < timeout:
+            stored = IoTMessage.objects.filter(device__uid__startswith=SCALING_UID.format('')).count()
+            if stored >= messages:
+                break
+            time.sleep(0.1)
+        return ScalingResult(workers, messages, stored, time.monotonic() - started)
+    finally:
+        supervisor.stop()
@@ -1,3 +1,626 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import time
+from datetime import timedelta
+from unittest.mock import Mock, patch
 
-# Create your tests here.
+from django.db import connection, IntegrityError, OperationalError
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.reasoncodes import ReasonCode
+from django.conf import settings
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from group_police.db import supports_copy
+from group_police.hosts import host_policies
+from group_police.jwt_token import create_access_token, create_device_token, token_verifier
+from group_police.models import IoTDevice, IoTDeviceLog, IoTGroup, IoTMessage, IoTUser, RBACPolicy, UserToDeviceLog
+from mqtt_broker import codec, devices, fleet
+from mqtt_broker.dispatch import (
+    EARLY_ACK_TTL, STATUS_DELIVERED, STATUS_FAILED, STATUS_QUEUED, STATUS_UNCONFIRMED, CommandDispatcher,
+)
+from mqtt_broker.ingest import IncomingMessage, MessageIngestor, source_address
+from mqtt_broker.last_seen import LastSeenTracker
+from mqtt_broker.live import MessageHub
+from mqtt_broker.models import SpoolOffset
+from mqtt_broker.routing import TopicRouter
+from mqtt_broker.spool import Spool
+from mqtt_broker.supervisor import IngestSupervisor
+
+
+def incoming(mid, topic, payload, qos=1, token=None, content_type=None, source=None):
+    encoded = json.dumps(payload).encode() if content_type is None else codec.encode(payload, content_type)
+    return IncomingMessage(mid, qos, topic, encoded, timezone.now(), token, content_type, source)
+
+
+@override_settings(AUDIT_LOG_ASYNC=False)
+class MessageIngestorTest(TestCase):
+    def setUp(self):
+        with patch('paho.mqtt.client.Client'):
+            self.ingestor = MessageIngestor()
+        self.device = IoTDevice.objects.create(device_name='sensor', uid='sensor-1')
+        self.ingestor.devices.load()
+
+    def test_batch_stored_with_single_insert(self):
+        batch = [incoming(i, 'devices/sensor-1/data', {'temperature': i}) for i in range(50)]
+        with CaptureQueriesContext(connection) as queries:
+            self.ingestor.store(batch)
+        inserts = [query for query in queries if query['sql'].startswith('INSERT INTO "group_police_iotmessage"')]
+        # На PostgreSQL с psycopg 3 пачка пишется через COPY, а не INSERT
+        self.assertEqual(len(inserts), 0 if supports_copy() else 1)
+        self.assertEqual(IoTMessage.objects.filter(device=self.device).count(), 50)
+
+    def test_registration_resolves_following_messages(self):
+        batch = [
+            incoming(1, 'devices/register', {'device_id': 'sensor-2', 'device_type': 'temperature_sensor'}),
+            incoming(2, 'devices/sensor-2/data', {'temperature': 22.5}),
+            incoming(3, 'devices/unknown/data', {'temperature': 0}),
+        ]
+        self.ingestor.flush(batch)
+        self.assertEqual(IoTMessage.objects.get().device.uid, 'sensor-2')
+        self.assertEqual(self.ingestor.stats['unknown'], 1)
+        self.assertEqual(self.ingestor.client.ack.call_count, 3)
+
+    def test_registration_storm_upserted_in_batch(self):
+        IoTDeviceLog.objects.all().delete()
+        batch = [incoming(i, 'devices/register', {'device_id': f'sensor-{i}', 'device_type': 'thermometer'})
+                 for i in range(1, 201)]
+        batch.append(incoming(201, 'devices/register', {'device_id': 'sensor-2', 'device_type': 'hygrometer'}))
+        with CaptureQueriesContext(connection) as queries:
+            self.ingestor.store(batch)
+        device_inserts = [query for query in queries if query['sql'].startswith('INSERT INTO "group_police_iotdevice"')]
+        # SQLite ограничивает число параметров запроса, поэтому upsert делится на несколько INSERT
+        self.assertLessEqual(len(device_inserts), 2)
+        self.assertEqual(IoTDevice.objects.count(), 200)
+        self.assertEqual(IoTDevice.objects.get(uid='sensor-1').device_type, 'thermometer')
+        self.assertEqual(IoTDevice.objects.get(uid='sensor-2').device_type, 'hygrometer')
+        self.assertEqual(IoTDeviceLog.objects.filter(status='created').count(), 199)
+        self.assertEqual(self.ingestor.stats['registered'], 199)
+
+        self.assertEqual(self.ingestor.client.publish.call_count, 200)
+        replies = dict(call.args for call in self.ingestor.client.publish.call_args_list)
+        reply = json.loads(replies['devices/sensor-2/register'])
+        self.assertEqual(reply['subscribe_topic'], 'devices/sensor-2/command')
+        claims = token_verifier.verify(reply['jwt'])
+        self.assertEqual(claims['device'], 'sensor-2')
+        self.assertEqual(reply['expires_in'], settings.DEVICE_TOKEN_LIFETIME)
+        self.assertAlmostEqual(claims['exp'] - time.time(), settings.DEVICE_TOKEN_LIFETIME, delta=60)
+
+    def test_device_reregisters_before_token_expiry(self):
+        with patch('paho.mqtt.client.Client'):
+            device = devices.IoTDevice('localhost')
+        device.register('thermometer')
+        device.handle_registration(json.dumps({'jwt': 'token', 'expires_in': 100}))
+        device.client.publish.reset_mock()
+        device.publish('devices/sensor-1/data', {'temperature': 1})
+        self.assertEqual([call.args[0] for call in device.client.publish.call_args_list], ['devices/sensor-1/data'])
+        device.client.publish.reset_mock()
+        with patch('mqtt_broker.devices.time.monotonic', return_value=time.monotonic() + 81):
+            device.publish('devices/sensor-1/data', {'temperature': 2})
+        self.assertEqual([call.args[0] for call in device.client.publish.call_args_list],
+                         ['devices/register', 'devices/sensor-1/data'])
+
+    def test_invalid_device_ids_rejected(self):
+        batch = [incoming(i, 'devices/register', {'device_id': uid, 'device_type': 'thermometer'})
+                 for i, uid in enumerate(['evil/+', 'all#', '', 'nul\0', 'x' * 101, 42, 'sensor-9'], start=1)]
+        self.ingestor.store(batch)
+        self.assertEqual(list(IoTDevice.objects.exclude(pk=self.device.pk).values_list('uid', flat=True)),
+                         ['sensor-9'])
+        self.ingestor.client.publish.assert_called_once()
+
+    def test_poison_record_does_not_block_flush(self):
+        add = self.ingestor.rollups.add
+
+        def add_or_fail(device_id, received_at, payload):
+            if payload.get('temperature') == 1:
+                raise IntegrityError('NOT NULL constraint failed')
+            add(device_id, received_at, payload)
+
+        batch = [incoming(i, 'devices/sensor-1/data', {'temperature': i}) for i in range(3)]
+        with patch.object(self.ingestor.rollups, 'add', side_effect=add_or_fail):
+            self.assertTrue(self.ingestor.flush(batch))
+        self.assertEqual(IoTMessage.objects.count(), 2)
+        self.assertEqual(self.ingestor.stats['rejected'], 1)
+        self.assertEqual(self.ingestor.client.ack.call_count, 3)
+
+    def test_dropped_by_rbac_policy(self):
+        group = IoTGroup.objects.create(name='sensors', description='')
+        self.device.groups.add(group)
+        policy = RBACPolicy.objects.create(name='guest', description='', action='D', hosts='10.1.0.0/16',
+                                           redirect_hosts='')
+        policy.iot_groups.add(group)
+        host_policies.invalidate()
+        self.ingestor.devices.load()
+        self.ingestor.store([
+            # Адрес из данных устройства не учитывается, только переданный брокером
+            incoming(1, 'devices/sensor-1/data', {'ip': '10.2.2.3', 'temperature': 1}, source='10.1.2.3'),
+            incoming(2, 'devices/sensor-1/data', {'ip': '10.2.2.3', 'temperature': 2}, source='10.2.2.3'),
+            incoming(3, 'devices/sensor-1/data', {'ip': '10.1.2.3', 'temperature': 3}),
+        ])
+        self.assertEqual(IoTMessage.objects.count(), 2)
+        self.assertEqual(self.ingestor.stats['dropped'], 1)
+        self.assertEqual(self.ingestor.stats['unchecked'], 1)
+        # На страницу устройства попадает только сохраненное сообщение
+        live = [call.args for call in self.ingestor.client.publish.call_args_list]
+        self.assertEqual([topic for topic, payload in live], ['pdp/live/sensor-1'] * 2)
+        self.assertEqual(json.loads(json.loads(live[0][1])['msg'])['temperature'], 2)
+
+    def test_source_address_taken_from_broker_property(self):
+        properties = Mock(UserProperty=[('source-ip', '1.2.3.4'), ('source-ip', '10.0.0.1')])
+        self.assertEqual(source_address(properties), '10.0.0.1')
+        self.assertIsNone(source_address(Mock(UserProperty=[('source-ip', 'bad')])))
+        with self.settings(MQTT_INGEST_SOURCE_PROPERTY=None):
+            self.assertIsNone(source_address(properties))
+
+    def test_live_hub_skips_devices_without_subscribers(self):
+        hub = MessageHub()
+        self.ingestor.store([incoming(1, 'devices/sensor-1/data', {'temperature': 1})])
+        topic, payload = self.ingestor.client.publish.call_args.args
+        with patch.object(hub, 'publish') as publish, patch('mqtt_broker.live.json.loads') as loads:
+            hub.on_message(None, None, Mock(topic=topic, payload=payload))
+        publish.assert_not_called()
+        loads.assert_not_called()
+        with patch.object(hub, 'publish') as publish, patch.object(hub, 'subscriber_count', return_value=1):
+            hub.on_message(None, None, Mock(topic=topic, payload=payload))
+        uid, event = publish.call_args.args
+        self.assertEqual((uid, event['topic']), ('sensor-1', 'devices/sensor-1/data'))
+        self.assertEqual(event['receive_time'], IoTMessage.objects.get().receive_time)
+
+    @override_settings(MQTT_INGEST_REQUIRE_JWT=True)
+    def test_unauthorized_messages_skipped(self):
+        self.ingestor.store([
+            incoming(1, 'devices/sensor-1/data', {'temperature': 1}, token=create_device_token('sensor-1')),
+            incoming(2, 'devices/sensor-1/data', {'temperature': 2}, token='not-a-token'),
+            incoming(3, 'devices/sensor-1/data', {'temperature': 3}),
+            # Токен пользователя и токен другого устройства не подходят
+            incoming(4, 'devices/sensor-1/data', {'temperature': 4}, token=create_access_token(self.device.id)),
+            incoming(5, 'devices/sensor-1/data', {'temperature': 5}, token=create_device_token('sensor-2')),
+        ])
+        self.assertEqual(IoTMessage.objects.count(), 1)
+        self.assertEqual(self.ingestor.stats['unauthorized'], 4)
+
+    def test_long_messages_stored_compressed(self):
+        reading = {'temperature': 21.5, 'humidity': 40.2, 'pressure': 1013.25, 'battery': 3.7, 'sent_at': 1.5}
+        self.ingestor.store([incoming(1, 'devices/sensor-1/data', reading),
+                             incoming(2, 'devices/sensor-1/data', {'t': 1})])
+        long, short = IoTMessage.objects.order_by('id')
+        self.assertEqual((long.msg, short.body), ('', None))
+        self.assertLess(len(long.body), len(json.dumps(reading)))
+        self.assertEqual(json.loads(long.text), reading)
+        self.assertIn('"humidity": 40.2', str(long))
+
+    def test_content_type_decoding_and_negotiation(self):
+        batch = [
+            incoming(1, 'devices/register', {'device_id': 'sensor-2', 'accept': ['application/x-unknown', codec.JSON]},
+                     content_type=codec.JSON),
+            IncomingMessage(2, 1, 'devices/sensor-1/data', b'\x81', timezone.now(), None, 'application/x-unknown'),
+        ]
+        # Двоичная кодировка, если установлена, хранится в БД как JSON
+        for content_type in set(codec.supported()) - {codec.JSON}:
+            batch.append(incoming(3, 'devices/sensor-1/data', {'temperature': 20.5}, content_type=content_type))
+        self.ingestor.store(batch)
+        self.assertEqual(self.ingestor.stats['undecodable'], 1)
+        reply = json.loads(self.ingestor.client.publish.call_args.args[1])
+        self.assertEqual(reply['content_type'], codec.JSON)
+        for message in IoTMessage.objects.all():
+            self.assertEqual(json.loads(message.text), {'temperature': 20.5})
+
+
+@override_settings(AUDIT_LOG_ASYNC=False)
+class SpoolTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        IoTDevice.objects.create(device_name='sensor', uid='sensor-1')
+
+    def ingestor(self):
+        with patch('paho.mqtt.client.Client'):
+            ingestor = MessageIngestor(client_id='ingest-test')
+        ingestor.open_spool(self.directory.name)
+        self.addCleanup(lambda: ingestor.spool.close())
+        return ingestor
+
+    def batch(self, start, count):
+        return [incoming(i, 'devices/sensor-1/data', {'temperature': i}) for i in range(start, start + count)]
+
+    def test_acknowledged_while_database_down_and_replayed_once(self):
+        ingestor = self.ingestor()
+        with patch.object(ingestor, 'store', side_effect=OperationalError('database is locked')):
+            ingestor.flush(self.batch(0, 10))
+        # Пачка подтверждена брокеру, хотя в БД ее еще нет
+        self.assertEqual(ingestor.client.ack.call_count, 10)
+        self.assertEqual(IoTMessage.objects.count(), 0)
+        ingestor.spool.close()
+
+        # Перезапуск процесса: спул читается с диска, смещение - из БД
+        restarted = self.ingestor()
+        self.assertEqual(restarted.drain(force=True), 10)
+        self.assertEqual(restarted.drain(force=True), 0)
+        restarted.spool.close()
+        self.assertEqual(self.ingestor().drain(force=True), 0)
+        self.assertEqual(IoTMessage.objects.count(), 10)
+        self.assertEqual(
+            sorted(json.loads(message.text)['temperature'] for message in IoTMessage.objects.all()), list(range(10)),
+        )
+        self.assertEqual(SpoolOffset.objects.get(name='ingest-test').offset, restarted.spool_offset)
+
+    def test_lost_spool_directory_continues_from_stored_offset(self):
+        ingestor = self.ingestor()
+        ingestor.flush(self.batch(0, 10))
+        ingestor.spool.close()
+        stored = SpoolOffset.objects.get(name='ingest-test').offset
+        shutil.rmtree(self.directory.name)
+
+        restarted = self.ingestor()
+        self.assertEqual(restarted.spool.head, stored)
+        restarted.flush(self.batch(10, 5))
+        self.assertEqual(IoTMessage.objects.count(), 15)
+        restarted.spool.close()
+
+        # Каталог потерян, а БД при запуске недоступна: смещение из БД неизвестно
+        shutil.rmtree(self.directory.name)
+        with patch.object(MessageIngestor, 'stored_spool_offset', side_effect=OperationalError('database is locked')):
+            offline = self.ingestor()
+        with patch.object(offline, 'store', side_effect=OperationalError('database is locked')):
+            offline.flush(self.batch(15, 10))
+        self.assertEqual(offline.drain(force=True), 10)
+        self.assertEqual(IoTMessage.objects.count(), 25)
+
+    def test_source_address_survives_spool(self):
+        spool = Spool(self.directory.name)
+        self.addCleanup(spool.close)
+        spool.append([incoming(1, 'devices/sensor-1/data', {}, source='2001:db8::1'),
+                      incoming(2, 'devices/sensor-1/data', {})])
+        messages, offset = spool.read(0, 10)
+        self.assertEqual([message.source for message in messages], ['2001:db8::1', None])
+
+    def test_client_content_type_never_breaks_spool(self):
+        for value in ('application/jsön', 'x' * 300):
+            self.assertIsNone(codec.content_type_of(Mock(ContentType=value)))
+        self.assertEqual(codec.content_type_of(Mock(ContentType=codec.CBOR)), codec.CBOR)
+        spool = Spool(self.directory.name)
+        self.addCleanup(spool.close)
+        message = incoming(1, 'devices/sensor-1/data', {'temperature': 1})._replace(content_type='ö' * 300)
+        spool.append([message])
+        self.assertEqual(spool.read(0, 1)[0][0].content_type, 'ö' * 300)
+
+    def test_malformed_token_dropped_at_callback(self):
+        with patch('paho.mqtt.client.Client'):
+            ingestor = MessageIngestor()
+        token = create_access_token(1)
+        for value, expected in (('tökén', None), ('a.b.c' * 1000, None), (token, token)):
+            properties = Mock(UserProperty=[('Authorization', f'Bearer {value}')], ContentType=None)
+            ingestor.on_message(None, None, Mock(mid=1, qos=1, topic='devices/sensor-1/data', payload=b'{}',
+                                                  properties=properties))
+            message = ingestor._queue.get_nowait()
+            self.assertEqual(message.token, expected)
+        spool = Spool(self.directory.name)
+        self.addCleanup(spool.close)
+        spool.append([message._replace(token='tökén')])
+        self.assertEqual(spool.read(0, 1)[0][0].token, 'tökén')
+
+    def test_poison_record_skipped_and_offset_advanced(self):
+        ingestor = self.ingestor()
+        add = ingestor.rollups.add
+
+        def add_or_fail(device_id, received_at, payload):
+            if payload.get('temperature') == 3:
+                raise IntegrityError('NOT NULL constraint failed')
+            add(device_id, received_at, payload)
+
+        with patch.object(ingestor.rollups, 'add', side_effect=add_or_fail):
+            ingestor.flush(self.batch(0, 5))
+        self.assertEqual(ingestor.stats['rejected'], 1)
+        self.assertEqual(sorted(json.loads(message.text)['temperature'] for message in IoTMessage.objects.all()),
+                         [0, 1, 2, 4])
+        self.assertEqual(SpoolOffset.objects.get(name='ingest-test').offset, ingestor.spool.head)
+        self.assertEqual(ingestor.drain(force=True), 0)
+
+    def test_segments_rolled_and_released(self):
+        spool = Spool(self.directory.name, segment_size=512)
+        self.addCleanup(spool.close)
+        spool.append(self.batch(0, 20))
+        spool.sync()
+        self.assertGreater(len(os.listdir(self.directory.name)), 1)
+        messages, offset = spool.read(0, 100)
+        self.assertEqual([message.topic for message in messages], ['devices/sensor-1/data'] * 20)
+        self.assertEqual(offset, spool.head)
+        spool.release(offset)
+        self.assertEqual(len(os.listdir(self.directory.name)), 1)
+
+    def test_torn_record_discarded_on_recovery(self):
+        spool = Spool(self.directory.name)
+        spool.append(self.batch(0, 3))
+        spool.sync()
+        head = spool.head
+        spool.close()
+        segment = os.path.join(self.directory.name, os.listdir(self.directory.name)[0])
+        with open(segment, 'r+b') as file:
+            file.seek(head)
+            file.write(b'\x40\x00\x00\x00garbage')
+        spool = Spool(self.directory.name)
+        self.addCleanup(spool.close)
+        self.assertEqual(spool.head, head)
+        self.assertEqual(len(spool.read(0, 100)[0]), 3)
+        spool.append(self.batch(3, 1))
+        self.assertEqual(len(spool.read(0, 100)[0]), 4)
+
+
+@override_settings(AUDIT_LOG_ASYNC=False)
+class LastSeenTrackerTest(TestCase):
+    def setUp(self):
+        self.devices = [IoTDevice.objects.create(device_name=f'sensor-{i}', uid=f'sensor-{i}') for i in range(3)]
+        self.tracker = LastSeenTracker()
+
+    def test_flush_is_single_update_with_latest_values(self):
+        now = timezone.now()
+        for device in self.devices:
+            self.tracker.touch(device.id, now - timedelta(minutes=1))
+            self.tracker.touch(device.id, now)
+            self.tracker.touch(device.id, now - timedelta(minutes=2))
+        with self.assertNumQueries(1):
+            self.assertEqual(self.tracker.flush(force=True), 3)
+        self.assertEqual(set(IoTDevice.objects.values_list('last_seen', flat=True)), {now})
+        self.assertEqual(self.tracker.flush(force=True), 0)
+
+    def test_freshest_value_read_from_memory(self):
+        now = timezone.now()
+        self.tracker.touch(self.devices[0].id, now)
+        self.assertEqual(self.tracker.get_many([device.id for device in self.devices]), {self.devices[0].id: now})
+
+
+@override_settings(AUDIT_LOG_ASYNC=False, MQTT_DISPATCH_ACK_TIMEOUT=0)
+class CommandDispatcherTest(TestCase):
+    def setUp(self):
+        self.device = IoTDevice.objects.create(device_name='lamp', uid='lamp-1')
+        self.user = IoTUser.objects.create(username='operator')
+        self.dispatcher = CommandDispatcher(pool_size=2)
+        self.dispatcher._clients = [Mock(), Mock()]
+        for mid, client in enumerate(self.dispatcher._clients, start=1):
+            client.publish.return_value = Mock(rc=0, mid=mid)
+        self.success = ReasonCode(PacketTypes.PUBACK, identifier=0)
+
+    def send(self, message):
+        with patch.object(self.dispatcher, 'start'):
+            self.assertTrue(self.dispatcher.send(self.user, self.device, message))
+        return self.dispatcher._queue.get_nowait()
+
+    def statuses(self):
+        return list(UserToDeviceLog.objects.order_by('id').values_list('status', flat=True))
+
+    def test_delivery_confirmed_by_puback(self):
+        self.dispatcher.publish(0, self.send('on'))
+        self.dispatcher._clients[0].publish.assert_called_once_with('devices/lamp-1/command', 'on', qos=1)
+        self.dispatcher.on_publish(None, 0, 1, self.success, None)
+        self.assertEqual(self.statuses(), [STATUS_QUEUED, STATUS_DELIVERED])
+
+    def test_puback_before_mid_recorded(self):
+        self.dispatcher.on_publish(None, 1, 2, self.success, None)
+        self.dispatcher.publish(1, self.send('off'))
+        self.assertEqual(self.statuses(), [STATUS_QUEUED, STATUS_DELIVERED])
+        self.assertFalse(self.dispatcher._pending)
+
+    def test_unacknowledged_command_expires(self):
+        self.dispatcher.publish(0, self.send('on'))
+        self.dispatcher.expire()
+        self.assertEqual(self.statuses(), [STATUS_QUEUED, STATUS_UNCONFIRMED])
+        self.assertEqual(self.dispatcher.stats['unconfirmed'], 1)
+        # paho досылает команду, и запоздавший PUBACK все же записывает доставку
+        self.dispatcher.on_publish(None, 0, 1, self.success, None)
+        self.assertEqual(self.statuses(), [STATUS_QUEUED, STATUS_UNCONFIRMED, STATUS_DELIVERED])
+        self.assertFalse(self.dispatcher._early_acks)
+
+    def test_publish_error_fails_command_and_keeps_thread(self):
+        self.dispatcher._clients[0].publish.side_effect = ValueError('Publish topic cannot contain wildcards.')
+        self.dispatcher._queue.put_nowait(self.send('on'))
+        with patch.object(self.dispatcher, 'expire', side_effect=self.dispatcher._stopping.set):
+            self.dispatcher._run()
+        self.assertEqual(self.statuses(), [STATUS_QUEUED, STATUS_FAILED])
+
+    def test_stale_early_ack_discarded(self):
+        # PUBACK команды, уже истекшей по таймауту
+        self.dispatcher.on_publish(None, 0, 1, self.success, None)
+        with patch('mqtt_broker.dispatch.time.monotonic', return_value=time.monotonic() + EARLY_ACK_TTL + 1):
+            self.dispatcher.expire()
+        self.assertFalse(self.dispatcher._early_acks)
+        # После переполнения mid новая команда с тем же mid ждет собственного PUBACK
+        self.dispatcher.publish(0, self.send('on'))
+        self.assertEqual(self.statuses(), [STATUS_QUEUED])
+        self.assertEqual(len(self.dispatcher._pending), 1)
+
+
+class TopicRouterTest(SimpleTestCase):
+    def setUp(self):
+        self.router = TopicRouter()
+        self.router.add('devices/register', 'register')
+        self.router.add('devices/{uid}/data', 'data')
+        self.router.add('devices/+/#', 'device')
+        self.router.add('#', 'any')
+
+    def handlers(self, topic):
+        return [match.handler for match in self.router.match(topic)]
+
+    def test_wildcards_and_params(self):
+        self.assertEqual(self.handlers('devices/sensor-1/data'), ['data', 'device', 'any'])
+        self.assertEqual(self.router.match('devices/sensor-1/data')[0].params, {'uid': 'sensor-1'})
+        # a/# совпадает и с родительским уровнем
+        self.assertEqual(self.handlers('devices/sensor-1'), ['device', 'any'])
+        self.assertEqual(self.handlers('$SYS/broker/uptime'), [])
+        self.assertEqual(self.router.subscriptions, ['devices/register', 'devices/+/data', 'devices/+/#', '#'])
+
+    def test_resolve_most_specific(self):
+        self.assertEqual(self.router.resolve('devices/register').handler, 'register')
+        self.assertEqual(self.router.resolve('devices/sensor-1/data').handler, 'data')
+        self.assertEqual(self.router.resolve('devices/sensor-1/status').handler, 'device')
+        self.assertEqual(self.router.resolve('other').handler, 'any')
+
+    def test_dispatch_passes_params(self):
+        router = TopicRouter()
+        received = []
+        router.route('devices/{uid}/response')(lambda payload, uid: received.append((uid, payload)))
+        router.route('devices/#')(lambda payload: received.append(payload))
+        self.assertEqual(router.dispatch('devices/lamp-1/response', 'ok'), 2)
+        self.assertEqual(received, [('lamp-1', 'ok'), 'ok'])
+
+    def test_invalid_patterns(self):
+        for pattern in ('devices/#/data', 'devices/sensor+/data'):
+            with self.assertRaises(ValueError):
+                self.router.add(pattern, None)
+
+
+class IngestSupervisorTest(SimpleTestCase):
+    def test_shared_subscription(self):
+        ingestor = MessageIngestor(share_group='pdp-ingest')
+        client = Mock()
+        ingestor.on_connect(client, None, None, 0, None)
+        client.subscribe.assert_called_once_with([
+            ('$share/pdp-ingest/devices/+/data', 1), ('$share/pdp-ingest/devices/register', 1),
+        ])
+
+    @override_settings(MQTT_INGEST_RESTART_DELAY=1, MQTT_INGEST_RESTART_MAX_DELAY=4)
+    def test_restarts_crashed_worker_with_backoff(self):
+        supervisor = IngestSupervisor(workers=2)
+        alive, crashed = Mock(exitcode=None), Mock(exitcode=1)
+        alive.is_alive.return_value = True
+        crashed.is_alive.return_value = False
+        supervisor.workers[0].process, supervisor.workers[1].process = alive, crashed
+        worker = supervisor.workers[1]
+        worker.started_at = 1000.0
+        with patch.object(supervisor, '_spawn') as spawn, patch('mqtt_broker.supervisor.time.monotonic') as now:
+            now.return_value = 1000.5
+            self.assertEqual(supervisor.poll(), 1)
+            self.assertEqual(worker.restart_at, 1001.5)
+            now.return_value = 1002.0
+            supervisor.poll()
+        spawn.assert_called_once_with(worker)
+        self.assertEqual(supervisor.restarts, 1)
+        # Повторное быстрое падение - задержка уже удвоена
+        self.assertEqual(worker.delay, 2)
+
+
+class FleetSimulatorTest(SimpleTestCase):
+    def test_publish_packet_round_trip(self):
+        data = fleet.publish_packet('devices/a/data', b'{}', qos=1, packet_id=7, content_type=codec.JSON,
+                                    user_properties=[('Authorization', 'Bearer token')])
+        self.assertEqual(data[0], fleet.PUBLISH << 4 | 0x02)
+        length, position = fleet.decode_varint(data, 1)
+        self.assertEqual(length, len(data) - position)
+        topic, packet_id, qos, properties, payload = fleet.parse_publish(0x02, data[position:])
+        self.assertEqual((topic, packet_id, qos, payload), ('devices/a/data', 7, 1, b'{}'))
+        self.assertEqual(properties, {'content_type': codec.JSON, 'user': [('Authorization', 'Bearer token')]})
+        self.assertEqual(fleet.decode_varint(fleet.encode_varint(321), 0), (321, 2))
+
+    def test_bad_reply_and_lost_ack(self):
+        async def handle(reader, writer):
+            await fleet.read_packet(reader)
+            writer.write(fleet.packet(fleet.CONNACK, 0, b'\0\0\0'))
+            try:
+                while True:
+                    kind, flags, body = await fleet.read_packet(reader)
+                    if kind == fleet.SUBSCRIBE:
+                        writer.write(fleet.packet(fleet.SUBACK, 0, body[:2] + b'\0\1'))
+                    elif kind == fleet.PUBLISH:
+                        topic, packet_id, qos, properties, payload = fleet.parse_publish(flags, body)
+                        # Подтверждается только регистрация, ответ на нее - не JSON
+                        if topic == fleet.REGISTER_TOPIC:
+                            writer.write(fleet.puback_packet(packet_id))
+                            writer.write(fleet.publish_packet('devices/a/register', b'not json', 1, 1))
+            except asyncio.IncompleteReadError:
+                pass
+            writer.close()
+
+        async def run():
+            server = await asyncio.start_server(handle, '127.0.0.1', 0)
+            config = fleet.FleetConfig(port=server.sockets[0].getsockname()[1], timeout=1)
+            stats = fleet.FleetStats()
+            async with server:
+                connection = fleet.MQTTConnection('a', '127.0.0.1', config.port)
+                await connection.connect()
+                try:
+                    result = await fleet.register(connection, 'a', config, stats)
+                    with self.assertRaises(asyncio.TimeoutError):
+                        await connection.publish('devices/a/data', b'{}', qos=1, timeout=0.1)
+                    pending = dict(connection._pending)
+                finally:
+                    await connection.close()
+            return result, stats, pending
+
+        result, stats, pending = asyncio.run(run())
+        self.assertEqual(result, (None, codec.JSON))
+        self.assertEqual((stats.registered, stats.registration_errors), (0, 1))
+        self.assertEqual(pending, {})
+
+    def test_malformed_packet_counted_as_protocol_error(self):
+        async def handle(reader, writer):
+            await fleet.read_packet(reader)
+            writer.write(fleet.packet(fleet.CONNACK, 0, b'\0\0\0'))
+            await fleet.read_packet(reader)
+            # PUBLISH с топиком не в UTF-8 и свойством с неизвестным id
+            writer.write(fleet.packet(fleet.PUBLISH, 0, b'\0\2\xff\xfe\2\x7f\0'))
+            await reader.read()
+            writer.close()
+
+        async def run():
+            server = await asyncio.start_server(handle, '127.0.0.1', 0)
+            async with server:
+                connection = fleet.MQTTConnection('a', '127.0.0.1', server.sockets[0].getsockname()[1])
+                await connection.connect()
+                try:
+                    with self.assertRaises(ConnectionError):
+                        await connection.subscribe('devices/a/register', timeout=5)
+                    await asyncio.gather(connection._tasks[0])
+                finally:
+                    await connection.close()
+            return connection
+
+        connection = asyncio.run(run())
+        self.assertEqual(connection.protocol_errors, 1)
+        self.assertFalse(connection.connected)
+
+    def test_fleet_against_fake_broker(self):
+        published = []
+
+        async def handle(reader, writer):
+            await fleet.read_packet(reader)
+            writer.write(fleet.packet(fleet.CONNACK, 0, b'\0\0\0'))
+            try:
+                while True:
+                    kind, flags, body = await fleet.read_packet(reader)
+                    if kind == fleet.SUBSCRIBE:
+                        writer.write(fleet.packet(fleet.SUBACK, 0, body[:2] + b'\0\1'))
+                    elif kind == fleet.PUBLISH:
+                        topic, packet_id, qos, properties, payload = fleet.parse_publish(flags, body)
+                        writer.write(fleet.puback_packet(packet_id))
+                        if topic == fleet.REGISTER_TOPIC:
+                            uid = json.loads(payload)['device_id']
+                            reply = json.dumps({'jwt': f'token-{uid}', 'content_type': codec.JSON}).encode()
+                            writer.write(fleet.publish_packet(f'devices/{uid}/register', reply, 1, 1))
+                        else:
+                            published.append((topic, properties['user']))
+                    elif kind == fleet.DISCONNECT:
+                        break
+            except asyncio.IncompleteReadError:
+                pass
+            writer.close()
+
+        async def run():
+            server = await asyncio.start_server(handle, '127.0.0.1', 0)
+            config = fleet.FleetConfig(port=server.sockets[0].getsockname()[1], devices=10, rate=100, duration=1.0,
+                                       ramp=0.1, churn=30, timeout=5)
+            async with server:
+                return await fleet._simulate(config)
+
+        stats = asyncio.run(run())
+        self.assertEqual(stats.registered, 10)
+        self.assertEqual(stats.failed + stats.connect_errors, 0)
+        self.assertEqual(stats.connections, 10 + stats.reconnects)
+        self.assertEqual(stats.published, len(published))
+        self.assertEqual(stats.ack_latency.seen, stats.published)
+        self.assertGreater(stats.published, 50)
+        topic, user_properties = published[0]
+        uid = topic.split('/')[1]
+        self.assertEqual(user_properties, [('Authorization', f'Bearer token-{uid}')])